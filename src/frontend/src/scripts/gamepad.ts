@@ -2,6 +2,14 @@ const GAMEPAD_WS_URL = "ws://192.168.1.1:8765";
 const GAMEPAD_CLIENT_INFO = {client_type: "joystick"};
 let gamepad_ws: WebSocket;
 
+// binary joystick frame, has to match JOYSTICK_FORMAT in rpi/ws_server.py:
+// schema id (u8), sequence number (u32), send time (f64, seconds since the epoch),
+// left stick, right stick and dpad axes (6 x i16), button bitmask (u16)
+const JOYSTICK_SCHEMA_ID = 1;
+const JOYSTICK_FRAME_SIZE = 27;
+const JOYSTICK_AXIS_SCALE = 32767;
+let joystick_seq = 0;
+
 type Buttons = {
     north?: boolean,
     east?: boolean,
@@ -44,6 +52,50 @@ function getButtons(gamepad: Gamepad): Buttons {
   return buttons;
 }
 
+// in bit order
+const BUTTON_ORDER: (keyof Buttons)[] = [
+  "north",
+  "east",
+  "south",
+  "west",
+  "left_bumper",
+  "right_bumper",
+  "left_trigger",
+  "right_trigger",
+  "select",
+  "start",
+  "mode",
+  "left_thumb",
+  "right_thumb",
+];
+
+function encodeGamepad(
+  buttons: Buttons,
+  left_stick: number[],
+  right_stick: number[],
+  dpad: number[],
+): ArrayBuffer {
+  const buffer = new ArrayBuffer(JOYSTICK_FRAME_SIZE);
+  const view = new DataView(buffer);
+  view.setUint8(0, JOYSTICK_SCHEMA_ID);
+  view.setUint32(1, joystick_seq, true);
+  view.setFloat64(5, Date.now() / 1000, true);
+  const axes = [...left_stick, ...right_stick, ...dpad];
+  axes.forEach((axis, i) => {
+    const clamped = Math.max(-1, Math.min(1, axis));
+    view.setInt16(13 + i * 2, Math.round(clamped * JOYSTICK_AXIS_SCALE), true);
+  });
+  let button_mask = 0;
+  BUTTON_ORDER.forEach((name, bit) => {
+    if (buttons[name]) {
+      button_mask |= 1 << bit;
+    }
+  });
+  view.setUint16(25, button_mask, true);
+  joystick_seq = (joystick_seq + 1) >>> 0;
+  return buffer;
+}
+
 function getDpad(gamepad: Gamepad): number[] {
   let dpad_x = gamepad.buttons[15].value - gamepad.buttons[14].value;
   let dpad_y = gamepad.buttons[12].value - gamepad.buttons[13].value;
@@ -91,14 +143,14 @@ function mainLoop() {
   }
 
 
-  const gamepad_data = {
-    "buttons": getButtons(gamepad),
-    "left_stick": getLeftStick(gamepad),
-    "right_stick": getRightStick(gamepad),
-    "dpad": getDpad(gamepad),
-  };
-
-  gamepad_ws.send(JSON.stringify(gamepad_data));
+  gamepad_ws.send(
+    encodeGamepad(
+      getButtons(gamepad),
+      getLeftStick(gamepad),
+      getRightStick(gamepad),
+      getDpad(gamepad),
+    ),
+  );
 }
 
 function main() {
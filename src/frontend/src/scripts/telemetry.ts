@@ -0,0 +1,85 @@
+// decodes the binary telemetry frames sent by rpi/telemetry.py, the layout here has to
+// match the one over there
+import type { SensorData } from "@/stores/sensorData";
+
+const SCHEMA_ID = 2;
+
+const KEYFRAME = 0;
+const DELTA = 1;
+
+// schema id (u8), frame type (u8), sequence number (u32), timestamp (f64), flags (u16)
+const HEADER_SIZE = 16;
+
+const VALUE_FIELDS = [
+  "internal_temp",
+  "external_temp",
+  "depth",
+  "yaw",
+  "roll",
+  "pitch",
+  "x_accel",
+  "y_accel",
+  "z_accel",
+  "voltage_5V",
+  "current_5V",
+  "voltage_12V",
+  "current_12V",
+  "speed_multiplier",
+  "throttle_limit_factor",
+  "input_latency_p50",
+  "input_latency_p99",
+] as const;
+
+const ANCHOR_FLAGS = [
+  "depth_anchor_enabled",
+  "yaw_anchor_enabled",
+  "roll_anchor_enabled",
+  "pitch_anchor_enabled",
+] as const;
+const NUM_MOTOR_LOCK_FLAGS = 6;
+
+let keyframeValues: number[] | null = null;
+
+function decodeTelemetry(buffer: ArrayBuffer): SensorData | null {
+  const view = new DataView(buffer);
+  const schemaId = view.getUint8(0);
+  if (schemaId != SCHEMA_ID) {
+    console.log(`Unknown telemetry schema: ${schemaId}`);
+    return null;
+  }
+  const frameType = view.getUint8(1);
+  const flags = view.getUint16(14, true);
+
+  let values: number[];
+  if (frameType == KEYFRAME) {
+    values = VALUE_FIELDS.map((_, i) => view.getFloat32(HEADER_SIZE + i * 4, true));
+    keyframeValues = values;
+  } else if (frameType == DELTA && keyframeValues != null) {
+    values = [...keyframeValues];
+    const mask = view.getUint32(HEADER_SIZE, true);
+    let offset = HEADER_SIZE + 4;
+    for (let i = 0; i < VALUE_FIELDS.length; i++) {
+      if (mask & (1 << i)) {
+        values[i] = view.getFloat32(offset, true);
+        offset += 4;
+      }
+    }
+  } else {
+    // can't do anything with a delta until the first keyframe arrives
+    return null;
+  }
+
+  const data: { [key: string]: number | boolean | null } = { cpu_temp: null };
+  VALUE_FIELDS.forEach((name, i) => {
+    data[name] = isNaN(values[i]) ? null : values[i];
+  });
+  ANCHOR_FLAGS.forEach((name, bit) => {
+    data[name] = (flags & (1 << bit)) != 0;
+  });
+  const motorLockBits = ((1 << NUM_MOTOR_LOCK_FLAGS) - 1) << ANCHOR_FLAGS.length;
+  data.motor_lock_enabled = (flags & motorLockBits) != 0;
+
+  return data as SensorData;
+}
+
+export { decodeTelemetry }
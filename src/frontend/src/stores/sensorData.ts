@@ -20,7 +20,10 @@ export type SensorData = {
     yaw_anchor_enabled: boolean | null,
     roll_anchor_enabled: boolean | null,
     pitch_anchor_enabled: boolean | null,
-    motor_lock_enabled: boolean | null
+    motor_lock_enabled: boolean | null,
+    // joystick to thruster latency in milliseconds
+    input_latency_p50?: number | null,
+    input_latency_p99?: number | null
 }
 
 let base: SensorData = {
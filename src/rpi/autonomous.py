@@ -1,8 +1,10 @@
 import asyncio
+import atexit
 import cv2
 from enum import auto, Enum
-from functools import reduce
+from functools import cache, reduce
 import math
+import multiprocessing
 import numpy as np
 import os
 from pid import PID, RotationalPID
@@ -11,11 +13,13 @@ from queue import Queue
 from sklearn.linear_model import LinearRegression
 from sklearn.preprocessing import PolynomialFeatures
 from scipy.interpolate import splprep, splev
+from shared_frames import FrameRing, ResultSlot
+from square_detector import SquareDetector
+from square_tracker import DETECTION_INTERVAL, SquareTracker
 import sys
 import threading
-from time import time, sleep
+from time import monotonic, time, sleep
 from timer import Timer
-from ultralytics import YOLO
 import websockets
 import websockets.sync.client
 
@@ -26,11 +30,12 @@ def resource_path(relative_path):
     return os.path.join(base_path, relative_path)
 
 
-#  SQUARE_DETECTION_MODEL = YOLO(
-#      "square_detection_ncnn_model", task="detect", verbose=False
-#  )
-
-SQUARE_DETECTION_MODEL = YOLO("square_detection_ncnn_model", task="detect")
+SQUARE_DETECTION_MODEL_DIR = resource_path("square_detection_ncnn_model")
+# the frames are decoded straight to grayscale at half the camera's resolution, which
+# is still more than the 320 px the model runs at. the square's coordinates are scaled
+# back up so that they're always in the camera's full resolution
+DECODE_FLAGS = cv2.IMREAD_REDUCED_GRAYSCALE_2
+DECODE_SCALE = 2
 
 
 class WSServer:
@@ -53,42 +58,57 @@ class WSServer:
 
 
 class ImageHandler:
-    image = None
-    square_x = None
-    square_y = None
-    square_width = None
-    square_height = None
+    # frames are received, decoded and searched for the square in a separate process
+    # so that none of it competes with the control loop for the GIL. decoded frames
+    # come back through a ring in shared memory and the square's coordinates through
+    # a result slot, neither of which need any locking. the detector only runs on
+    # every few frames, the square is tracked through the ones in between
+    process = None
+    frame_ring = None
+    result_slot = None
+    # shared with the vision process, frames are skipped when it's not set
+    is_listening = multiprocessing.RawValue("b", 0)
+    # the sequence number of the last frame returned by pump_image()
+    last_frame_seq = -1
 
     # the image queue should only hold one image at a time
     image_queue = Queue(1)
-    is_listening = False
-
-    last_frame_time = 0
+    square_tracker = None
 
-    # process each image in a separate thread to avoid blocking. uses a queue that holds
-    # only the most recent image
+    # runs in the vision process, processes each image from the queue that holds only
+    # the most recent image
     @classmethod
     def image_processer(cls):
+        frame_seq = 0
         while True:
             message = cls.image_queue.get()
-            if not cls.is_listening:
+            if not cls.is_listening.value:
+                # the square could be anywhere by the time it's listening again
+                cls.square_tracker.reset()
                 cls.image_queue.task_done()
                 continue
             try:
-                buffer = np.asarray(bytearray(message), dtype="uint8")
-                img = cv2.imdecode(buffer, cv2.IMREAD_COLOR)
+                # decoded straight out of the message, without copying it first
+                gray = cv2.imdecode(
+                    np.frombuffer(message, dtype=np.uint8), DECODE_FLAGS
+                )
             except Exception as e:
                 print(f"Fuck: {e}")
+                gray = None
+            if gray is None:
+                cls.image_queue.task_done()
                 continue
-            gray = cv2.cvtColor(
-                cv2.cvtColor(img, cv2.COLOR_BGR2GRAY), cv2.COLOR_GRAY2BGR
-            )
-            x, y, width, height = find_square(gray, save_image=True)
-            cls.square_x = x
-            cls.square_y = y
-            cls.square_width = width
-            cls.square_height = height
-            cls.image = img
+
+            box = cls.square_tracker.update(gray)
+            x, y, width, height = box_to_square(box)
+            if x is not None:
+                x, y, width, height = (
+                    value * DECODE_SCALE for value in (x, y, width, height)
+                )
+            # the frame has to be in the ring before the result that points to it
+            cls.frame_ring.write(frame_seq, gray)
+            cls.result_slot.write(frame_seq, x, y, width, height)
+            frame_seq += 1
             cls.image_queue.task_done()
 
     @classmethod
@@ -104,34 +124,82 @@ class ImageHandler:
             except OSError:
                 sleep(0.5)
 
+    # entry point of the vision process
+    @classmethod
+    def vision_process(
+        cls, uri, frame_ring_name, result_slot_name, is_listening, detection_interval
+    ):
+        cls.frame_ring = FrameRing(name=frame_ring_name)
+        cls.result_slot = ResultSlot(name=result_slot_name)
+        cls.is_listening = is_listening
+        cls.square_tracker = SquareTracker(
+            lambda img: detect_square(img, save_image=True),
+            detection_interval=detection_interval,
+        )
+        threading.Thread(target=cls.image_receiver, args=(uri,), daemon=True).start()
+        cls.image_processer()
+
+    # detection_interval is how many frames the detector runs on at most, the square is
+    # tracked through the rest. 1 runs the detector on every frame
+    @classmethod
+    def start_process(cls, uri, detection_interval=DETECTION_INTERVAL):
+        cls.frame_ring = FrameRing()
+        cls.result_slot = ResultSlot()
+        cls.process = multiprocessing.Process(
+            target=cls.vision_process,
+            args=(
+                uri,
+                cls.frame_ring.name,
+                cls.result_slot.name,
+                cls.is_listening,
+                detection_interval,
+            ),
+            daemon=True,
+        )
+        cls.process.start()
+        atexit.register(cls.stop_process)
+
+    @classmethod
+    def stop_process(cls):
+        if cls.process is not None:
+            cls.process.terminate()
+            cls.process = None
+        for shared in (cls.frame_ring, cls.result_slot):
+            if shared is not None:
+                shared.close()
+                shared.unlink()
+        cls.frame_ring = None
+        cls.result_slot = None
+
     @classmethod
     async def image_handler(cls, uri):
-        # spawn a thread to process incoming images without blocking
-        threading.Thread(target=ImageHandler.image_processer, daemon=True).start()
-        threading.Thread(
-            target=ImageHandler.image_receiver, args=(uri,), daemon=True
-        ).start()
+        cls.start_process(uri)
 
+    # returns the newest frame along with the square's coordinates in it, each frame is
+    # only returned once. the frame is grayscale at a reduced resolution, but the
+    # coordinates are in the camera's full resolution
     @classmethod
     def pump_image(cls):
-        img = cls.image
-        square_x = cls.square_x
-        square_y = cls.square_y
-        square_width = cls.square_width
-        square_height = cls.square_height
-        cls.square_coords = None, None
-        cls.square_width = None
-        cls.square_height = None
-        cls.image = None
+        if cls.result_slot is None:
+            return None, None, None, None, None
+        frame_seq, square_x, square_y, square_width, square_height = (
+            cls.result_slot.read()
+        )
+        if frame_seq < 0 or frame_seq == cls.last_frame_seq:
+            return None, None, None, None, None
+        img = cls.frame_ring.read(frame_seq)
+        if img is None:
+            return None, None, None, None, None
+        cls.last_frame_seq = frame_seq
         return img, square_x, square_y, square_width, square_height
 
     @classmethod
     def start_listening(cls):
-        cls.is_listening = True
+        cls.is_listening.value = 1
 
     @classmethod
     def stop_listening(cls):
-        cls.is_listening = False
+        cls.is_listening.value = 0
 
 
 # the steps in the process of transplanting the brain coral, broken down into an enum
@@ -178,7 +246,10 @@ NUM_VERIFICATIONS = 10
 
 
 class CoralTransplanter:
-    def __init__(self, square_depth: float, yaw_angle: int):
+    # clock times the PIDs and every phase of the transplant, the controller passes in
+    # the control tick's so that it all runs on simulated time in the simulator
+    def __init__(self, square_depth: float, yaw_angle: int, clock=monotonic):
+        self.clock = clock
         # the red square is at a height of about 32 cm above the pool floor
         #  self.SQUARE_HEIGHT = 0.32
         # the ROV should be 30 cm above the height of the square when moving towards it
@@ -208,28 +279,36 @@ class CoralTransplanter:
         self.pitch_anchor = True
 
         self.yaw_pid = RotationalPID(
-            proportional_gain=0.025, integral_gain=0, derivative_gain=0
+            proportional_gain=0.025, integral_gain=0, derivative_gain=0, clock=clock
         )
         # the ROV should stay parallel to the pool floor
         self.roll_pid = RotationalPID(
-            0, proportional_gain=-0.022, integral_gain=-0.001, derivative_gain=0.0e-4
+            0,
+            proportional_gain=-0.022,
+            integral_gain=-0.001,
+            derivative_gain=0.0e-4,
+            clock=clock,
         )
         self.pitch_pid = RotationalPID(
-            15, proportional_gain=0.035, integral_gain=0.009, derivative_gain=0.005
+            15,
+            proportional_gain=0.035,
+            integral_gain=0.009,
+            derivative_gain=0.005,
+            clock=clock,
         )
         self.depth_pid = PID(
-            proportional_gain=3, integral_gain=0.1, derivative_gain=0.01
+            proportional_gain=3, integral_gain=0.1, derivative_gain=0.01, clock=clock
         )
 
         self.square_x_pid = PID(
-            proportional_gain=-0.002, integral_gain=0, derivative_gain=0
+            proportional_gain=-0.002, integral_gain=0, derivative_gain=0, clock=clock
         )
         self.square_y_pid = PID(
-            proportional_gain=0.1, integral_gain=0, derivative_gain=0
+            proportional_gain=0.1, integral_gain=0, derivative_gain=0, clock=clock
         )
 
-        self.approaching_timer = Timer()
-        self.estimating_timer = Timer()
+        self.approaching_timer = Timer(clock)
+        self.estimating_timer = Timer(clock)
 
         self.current_step = CoralState.STARTING
 
@@ -262,12 +341,13 @@ class CoralTransplanter:
                 CoralReturn.IN_PROGRESS,
             )
 
-        img_height, img_width = img.shape[:2]
+        # the square's coordinates are in the camera's full resolution
+        img_height, img_width = (size * DECODE_SCALE for size in img.shape[:2])
         img_center_x = img_width / 2
         self.square_x_pid.update_set_point(img_center_x)
 
         print(self.current_step)
-        print(f"Current Time: {time()}")
+        print(f"Current Time: {self.clock()}")
 
         if self.current_step == CoralState.STARTING:
             self.depth_pid.update_set_point(self.moving_depth)
@@ -331,9 +411,9 @@ class CoralTransplanter:
 
             if self.verify_count < NUM_VERIFICATIONS:
                 if square_x is not None and square_y is not None:
-                    self.prev_square_coords.append((square_x, square_y, time()))
+                    self.prev_square_coords.append((square_x, square_y, self.clock()))
                 else:
-                    self.prev_square_coords.append((None, None, time()))
+                    self.prev_square_coords.append((None, None, self.clock()))
                 self.verify_count += 1
             else:
                 #  coords_without_none = filter(
@@ -376,7 +456,7 @@ class CoralTransplanter:
             if square_x is not None and square_y is not None:
                 self.estimating_timer.stop()
                 self.estimating_timer.reset()
-                self.prev_square_coords.append((square_x, square_y, time()))
+                self.prev_square_coords.append((square_x, square_y, self.clock()))
                 print(f"X: {square_x} Set Point: {self.square_x_pid.set_point}")
                 yaw_velocity = self.square_x_pid.compute(square_x)
                 print(f"Yaw Velocity: {yaw_velocity}")
@@ -439,10 +519,10 @@ class CoralTransplanter:
                         #  and abs(prev_x - img_center_x) <= EPSILON * 1.5
                         #  and abs(prev_y - img_height) <= EPSILON * 1.5
                     ):
-                        self.start_time = time()
+                        self.start_time = self.clock()
                         self.current_step = CoralState.SLOW_DOWN
 
-                self.prev_square_coords.append((square_x, square_y, time()))
+                self.prev_square_coords.append((square_x, square_y, self.clock()))
                 #  self.square_x_pid.update_set_point(img_center_x)
 
             # check if the square disappeared off the bottom of the screen
@@ -481,16 +561,16 @@ class CoralTransplanter:
             z_velocity = -self.depth_pid.compute(depth)
             y_velocity = 0.2
 
-            if time() - self.start_time >= BLIND_MOVING_TIME:
-                self.start_time = time()
+            if self.clock() - self.start_time >= BLIND_MOVING_TIME:
+                self.start_time = self.clock()
                 self.current_step = CoralState.SETTING_DOWN
                 print("Moving on Next Step: Setting Down")
 
         # need to counter the ROV's forward momentum
         elif self.current_step == CoralState.SLOW_DOWN:
             y_velocity = 0.25
-            if time() - self.start_time >= SLOW_DOWN_TIME:
-                self.start_time = time()
+            if self.clock() - self.start_time >= SLOW_DOWN_TIME:
+                self.start_time = self.clock()
                 self.current_step = CoralState.SETTING_DOWN
         # step 8 is to set the coral head down on the red square
         elif self.current_step == CoralState.SETTING_DOWN:
@@ -504,7 +584,7 @@ class CoralTransplanter:
             # period of time
             if (
                 #  abs(self.square_depth - depth) <= EPSILON
-                time() - self.start_time
+                self.clock() - self.start_time
                 >= SETTING_DOWN_TIMEOUT
             ):
                 self.current_step = CoralState.FINISHED
@@ -550,22 +630,36 @@ class CoralTransplanter:
         )
 
 
-# Find the coordinates and dimensions of the square using YOLO
-def find_square(img: np.ndarray, save_image=False) -> (int, int, int, int):
-    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-    gray = cv2.cvtColor(gray, cv2.COLOR_GRAY2BGR)
-    results = SQUARE_DETECTION_MODEL.predict(
-        source=gray, save=False, imgsz=320, verbose=False, max_det=1, half=True
-    )
-    if len(results) > 0 and len(results[0]) > 0:
-        x1, y1, x2, y2 = [round(tensor.item()) for tensor in results[0].boxes.xyxy[0]]
-        center_x = round((x2 + x1) / 2)
-        center_y = round((y2 + y1) / 2)
-        width = x2 - x1
-        height = y2 - y1
+# the detector is only loaded the first time it's needed, so that only the vision
+# process has a copy of the model
+@cache
+def square_detector() -> SquareDetector:
+    return SquareDetector(SQUARE_DETECTION_MODEL_DIR)
+
+
+# Find the square's box (x1, y1, x2, y2, score) using YOLO, None if there isn't one
+# img can be grayscale (which is what the model was trained on) or BGR
+def detect_square(img: np.ndarray, save_image=False):
+    detections = square_detector().detect(img, max_detections=1)
+    if len(detections) > 0:
         if save_image:
+            x1, y1, x2, y2, score = detections[0]
+            x1, y1, x2, y2 = round(x1), round(y1), round(x2), round(y2)
             cv2.imwrite(f"./images/{time()}.jpg", img)
-            annotated_img = results[0].plot()
+            if img.ndim == 2:
+                annotated_img = cv2.cvtColor(img, cv2.COLOR_GRAY2BGR)
+            else:
+                annotated_img = img.copy()
+            cv2.rectangle(annotated_img, (x1, y1), (x2, y2), (0, 0, 255), 2)
+            cv2.putText(
+                annotated_img,
+                f"the_square {score:.2f}",
+                (x1, max(y1 - 5, 10)),
+                cv2.FONT_HERSHEY_SIMPLEX,
+                0.5,
+                (0, 0, 255),
+                1,
+            )
             #  cv2.circle(img, (center_x, center_y), 5, (255, 255, 255), -1)
             #  cv2.putText(
             #      img,
@@ -577,17 +671,33 @@ def find_square(img: np.ndarray, save_image=False) -> (int, int, int, int):
             #      2,
             #  )
             cv2.imwrite(f"./images/{time()}_annotated.jpg", annotated_img)
-        return center_x, center_y, width, height
+        return detections[0]
     else:
         if save_image:
             cv2.imwrite(f"./images/{time()}.jpg", img)
 
-    return None, None, None, None
+    return None
+
+
+# the center and dimensions of a box from detect_square() or SquareTracker
+def box_to_square(box) -> (int, int, int, int):
+    if box is None:
+        return None, None, None, None
+    x1, y1, x2, y2, _ = box
+    x1, y1, x2, y2 = round(x1), round(y1), round(x2), round(y2)
+    center_x = round((x2 + x1) / 2)
+    center_y = round((y2 + y1) / 2)
+    return center_x, center_y, x2 - x1, y2 - y1
+
+
+# Find the coordinates and dimensions of the square using YOLO
+def find_square(img: np.ndarray, save_image=False) -> (int, int, int, int):
+    return box_to_square(detect_square(img, save_image))
 
 
 async def main_loop():
     while True:
-        img = ImageHandler.pump_image()
+        img, *_ = ImageHandler.pump_image()
         if img is None:
             await asyncio.sleep(0.01)
             continue
@@ -0,0 +1,521 @@
+from autonomous import ImageHandler, CoralTransplanter, CoralReturn, SQUARE_HEIGHT
+import cv2
+import math
+from orientation import attitude_error, quaternion_to_euler
+from pid import PIDBank
+from time import time
+
+# set the current draw limit in amps.
+# speed_multiplier will be changed to compensate for overdraw.
+MAX_CURRENT = 25
+
+# the PIDs that hold the ROV in place, in the order of the flight recorder's
+# RECORDED_PIDS
+ANCHORS = ("depth", "yaw", "roll", "pitch")
+# which of the body's axes (x forward, y right, z down) each attitude anchor holds the
+# rotation about, and which way round. roll is measured the opposite way to the
+# rotation about x
+ATTITUDE_AXES = {"yaw": (2, 1), "roll": (0, -1), "pitch": (1, 1)}
+
+
+# a clock that only moves when it's told to, so that everything computed during a
+# control tick uses the same time. also lets a replay run on recorded time
+class TickClock:
+    def __init__(self, now=0):
+        self.now = now
+
+    def __call__(self) -> float:
+        return self.now
+
+
+# the latest sensor readings, each sensor is read by its own task at its own rate so
+# the values here may be from slightly different moments
+class Readings:
+    def __init__(self):
+        self.internal_temp = None
+        self.external_temp = None
+        # the depth and vertical velocity from the depth filter (m and m/s, positive
+        # down), and the last depth the sensor itself measured
+        self.depth = None
+        self.depth_rate = None
+        self.measured_depth = None
+        # unit quaternion (w, x, y, z) rotating the body frame (x forward, y right, z
+        # down) into north, east, down. the anchors hold this, yaw, roll and pitch are
+        # just for showing to the pilot
+        self.attitude = None
+        self.yaw = None
+        self.roll = None
+        self.pitch = None
+        self.x_accel = None
+        self.y_accel = None
+        self.z_accel = None
+        self.voltage_5V = None
+        self.current_5V = None
+        self.voltage_12V = None
+        self.current_12V = None
+
+    # sets the attitude and the angles shown to the pilot. yaw is the heading and
+    # pitch is positive nose up, like the IMU's euler angles, but roll is the other way
+    # around
+    def update_attitude(self, attitude):
+        self.attitude = attitude
+        if attitude is None:
+            self.yaw = self.roll = self.pitch = None
+            return
+        w, x, y, z = attitude
+        yaw, pitch, roll = quaternion_to_euler(x, y, z, w)
+        self.yaw = yaw % 360
+        self.pitch = pitch
+        self.roll = -roll
+
+
+# turns the joystick input and sensor readings into motor velocities, holds all the
+# state that has to persist between control ticks (anchors, locks, toggles, etc.)
+class Controller:
+    def __init__(self, has_depth_sensor=True, has_imu=True, clock=time):
+        self.has_depth_sensor = has_depth_sensor
+        self.has_imu = has_imu
+        # the PIDs' clock
+        self.clock = clock
+
+        # whether each anchor is on
+        self.depth_anchor = False
+        self.yaw_anchor = False
+        self.roll_anchor = False
+        self.pitch_anchor = False
+        # the depth (m) and attitudes (quaternions) that the anchors are holding. each
+        # attitude anchor has its own set point since they're turned on separately
+        self.depth_set_point = None
+        self.attitude_set_points = {"yaw": None, "roll": None, "pitch": None}
+        # adjust the z, yaw, roll and pitch velocities to keep the ROV stable, the
+        # outputs are in the order of ANCHORS. the depth D term works off the depth
+        # filter's velocity, which is smooth enough for a much bigger gain than
+        # differentiating the depth was (tuned in simulator.py)
+        # TODO - Need to tune the yaw PID parameters
+        self.anchor_pids = PIDBank(
+            ANCHORS,
+            proportional_gains=(2, 0.03, -0.03, 0.02),
+            integral_gains=(0.05, 0, -0.001, 0.007),
+            derivative_gains=(0.5, 0, 0, 0.005),
+            clock=clock,
+        )
+
+        # multiplier for velocity to set speed limit
+        self.speed_multiplier = 1
+
+        # lock the controls in a certain state, each velocity can have its own lock
+        self.motor_locks = {
+            "x": False,
+            "y": False,
+            "z": False,
+            "yaw": False,
+            "pitch": False,
+            "roll": False,
+        }
+
+        # whether the ROV is attempting to autonomously transplant a sample of coral
+        self.is_autonomous = False
+        self.coral_transplanter = None
+
+        self.locked_velocities = {
+            "x": 0,
+            "y": 0,
+            "z": 0,
+            "yaw": 0,
+            "pitch": 0,
+            "roll": 0,
+        }
+
+        # stores the last button press of the velocity toggle button
+        self.prev_speed_toggle = None
+        self.prev_depth_anchor_toggle = None
+        self.prev_roll_anchor_toggle = None
+        self.prev_pitch_anchor_toggle = None
+        self.prev_yaw_anchor_toggle = None
+        self.prev_motor_lock_toggle = None
+        self.prev_autonomous_toggle = None
+
+        self.prev_z_velocity = 0
+        self.prev_yaw_velocity = 0
+        self.prev_roll_velocity = 0
+        self.prev_pitch_velocity = 0
+
+        # the recorded depth of the red square for the autonomous brain coral
+        # transplantation task
+        self.square_depth = None
+
+        self.throttle_limit_factor = 0
+        self.set_throttle = self.speed_multiplier
+
+    # information sent to the web client
+    def status_info(self, readings: Readings) -> dict:
+        return {
+            "internal_temp": readings.internal_temp,
+            "external_temp": readings.external_temp,
+            "depth": readings.depth,
+            "yaw": readings.yaw,
+            "roll": readings.roll,
+            "pitch": readings.pitch,
+            "x_accel": readings.x_accel,
+            "y_accel": readings.y_accel,
+            "z_accel": readings.z_accel,
+            "voltage_5V": readings.voltage_5V,
+            "current_5V": readings.current_5V,
+            "voltage_12V": readings.voltage_12V,
+            "current_12V": readings.current_12V,
+            "speed_multiplier": self.speed_multiplier,
+            "depth_anchor_enabled": self.depth_anchor,
+            "yaw_anchor_enabled": self.yaw_anchor,
+            "roll_anchor_enabled": self.roll_anchor,
+            "pitch_anchor_enabled": self.pitch_anchor,
+            "motor_lock_enabled": self.motor_locks,
+            "throttle_limit_factor": self.throttle_limit_factor,
+        }
+
+    # (re)starts one of the anchors holding the given depth or attitude, output is the
+    # velocity it's taking over from
+    def set_anchor(self, name: str, set_point, output=0):
+        if name == "depth":
+            self.depth_set_point = set_point
+        else:
+            self.attitude_set_points[name] = set_point
+        self.anchor_pids.enable(name, output)
+
+    # the rotation (°) about one of the body's axes from the current attitude to the
+    # attitude anchor's set point
+    def attitude_anchor_error(self, name: str, attitude) -> float:
+        axis, sign = ATTITUDE_AXES[name]
+        return sign * attitude_error(attitude, self.attitude_set_points[name])[axis]
+
+    # runs a single control tick, returns the velocities that the motors should be
+    # driven at: (x, y, z, yaw, pitch, roll)
+    def step(self, joystick_data, readings: Readings) -> tuple:
+        depth = readings.depth
+        attitude = readings.attitude
+        yaw = readings.yaw
+        roll = readings.roll
+        pitch = readings.pitch
+        current_12V = readings.current_12V
+
+        # set all the velocities to 0 if there's no joystick connected
+        if joystick_data:
+            x_velocity = joystick_data["left_stick"][0] * self.speed_multiplier
+            y_velocity = joystick_data["left_stick"][1] * self.speed_multiplier
+            z_velocity = joystick_data["right_stick"][1] * self.speed_multiplier
+            yaw_velocity = joystick_data["right_stick"][0] * self.speed_multiplier
+            pitch_velocity = joystick_data["dpad"][1] * self.speed_multiplier
+            roll_velocity = joystick_data["dpad"][0] * self.speed_multiplier
+            speed_toggle = (
+                joystick_data["buttons"]["right_bumper"]
+                - joystick_data["buttons"]["left_bumper"]
+            )
+            depth_anchor_toggle = joystick_data["buttons"]["north"]
+            roll_anchor_toggle = joystick_data["buttons"]["east"]
+            pitch_anchor_toggle = joystick_data["buttons"]["south"]
+            yaw_anchor_toggle = joystick_data["buttons"]["west"]
+            motor_lock_toggle = joystick_data["buttons"]["start"]
+            autonomous_toggle = joystick_data["buttons"]["select"]
+            photo_trigger = joystick_data["buttons"]["left_trigger"]
+            record_depth_trigger = joystick_data["buttons"]["right_trigger"]
+        else:
+            x_velocity = 0
+            y_velocity = 0
+            z_velocity = 0
+            yaw_velocity = 0
+            pitch_velocity = 0
+            roll_velocity = 0
+            speed_toggle = 0
+            yaw_anchor_toggle = 0
+            roll_anchor_toggle = 0
+            depth_anchor_toggle = 0
+            pitch_anchor_toggle = 0
+            motor_lock_toggle = 0
+            autonomous_toggle = 0
+            photo_trigger = 0
+            record_depth_trigger = 0
+
+        # when the controller speed increases beyond 50% of the speed multiplier,
+        # temporarily turn off any stabilization
+        destable_thresh = self.speed_multiplier / 2
+
+        # adjust speed mutliplier based on current draw
+        if current_12V is not None and current_12V > MAX_CURRENT:
+            self.throttle_limit_factor += 0.1
+        else:
+            self.throttle_limit_factor = 0
+            self.speed_multiplier = self.set_throttle
+
+        # apply factor
+        self.speed_multiplier -= self.throttle_limit_factor
+
+        # re-enable the depth anchor at a new depth when the z velocity falls below the
+        # threshold
+        if (
+            self.depth_anchor
+            and abs(z_velocity) < destable_thresh
+            and abs(self.prev_z_velocity) > destable_thresh
+        ):
+            self.set_anchor("depth", depth)
+
+        # re-enable the yaw anchor at a new angle when the yaw velocity falls below the
+        # threshold
+        if (
+            self.yaw_anchor
+            and abs(yaw_velocity) < destable_thresh
+            and abs(self.prev_yaw_velocity) > destable_thresh
+        ):
+            self.set_anchor("yaw", attitude)
+
+        # re-enable the roll anchor at a new angle when the roll velocity falls below
+        # the threshold
+        if (
+            self.roll_anchor
+            and abs(roll_velocity) < destable_thresh
+            and abs(self.prev_roll_velocity) > destable_thresh
+        ):
+            self.set_anchor("roll", attitude)
+
+        # re-enable the pitch anchor at a new angle when the pitch velocity falls below
+        # the threshold
+        if (
+            self.pitch_anchor
+            and abs(pitch_velocity) < destable_thresh
+            and abs(self.prev_pitch_velocity) > destable_thresh
+        ):
+            self.set_anchor("pitch", attitude)
+
+        self.prev_z_velocity = z_velocity
+        self.prev_yaw_velocity = yaw_velocity
+        self.prev_roll_velocity = roll_velocity
+        self.prev_pitch_velocity = pitch_velocity
+
+        # the error of each anchor, NaN if it's off, its sensor isn't ready or the pilot
+        # is overriding it with the stick. the anchors should be temporarily disabled
+        # when their velocity is greater than a certain threshold in order to give the
+        # pilot control over that axis while the anchor is on
+        anchor_errors = [math.nan] * len(ANCHORS)
+        if (
+            self.depth_anchor
+            and depth is not None
+            and self.depth_set_point is not None
+            and abs(z_velocity) < destable_thresh
+        ):
+            anchor_errors[0] = self.depth_set_point - depth
+        if attitude is not None:
+            for i, anchored, velocity in (
+                (1, self.yaw_anchor, yaw_velocity),
+                (2, self.roll_anchor, roll_velocity),
+                (3, self.pitch_anchor, pitch_velocity),
+            ):
+                name = ANCHORS[i]
+                if (
+                    anchored
+                    and self.attitude_set_points[name] is not None
+                    and abs(velocity) < destable_thresh
+                ):
+                    anchor_errors[i] = self.attitude_anchor_error(name, attitude)
+
+        # the depth filter's velocity is much smoother than differentiating the depth,
+        # the other anchors work theirs out from the errors
+        anchor_rates = [math.nan] * len(ANCHORS)
+        if readings.depth_rate is not None:
+            anchor_rates[0] = readings.depth_rate
+
+        # set the velocities of the anchored axes according to their PID controllers,
+        # all evaluated together
+        outputs = self.anchor_pids.compute(anchor_errors, anchor_rates).tolist()
+        depth_output, yaw_output, roll_output, pitch_output = outputs
+        if not math.isnan(anchor_errors[0]):
+            z_velocity = -depth_output
+        if not math.isnan(anchor_errors[1]):
+            yaw_velocity = yaw_output
+        if not math.isnan(anchor_errors[2]):
+            roll_velocity = roll_output
+        if not math.isnan(anchor_errors[3]):
+            pitch_velocity = pitch_output
+
+        if self.motor_locks["x"]:
+            x_velocity = self.locked_velocities["x"]
+        if self.motor_locks["y"]:
+            y_velocity = self.locked_velocities["y"]
+        if self.motor_locks["z"]:
+            z_velocity = self.locked_velocities["z"]
+        if self.motor_locks["yaw"]:
+            yaw_velocity = self.locked_velocities["yaw"]
+        if self.motor_locks["pitch"]:
+            pitch_velocity = self.locked_velocities["pitch"]
+        if self.motor_locks["roll"]:
+            roll_velocity = self.locked_velocities["roll"]
+
+        # autonomous code should take precedence
+        if self.is_autonomous:
+            (
+                x_velocity,
+                y_velocity,
+                z_velocity,
+                yaw_velocity,
+                roll_velocity,
+                pitch_velocity,
+                return_code,
+            ) = self.coral_transplanter.next_step(depth, yaw, roll, pitch)
+            if return_code == CoralReturn.FINISHED:
+                self.is_autonomous = False
+                ImageHandler.stop_listening()
+                # stabilize after finishing
+                self.depth_anchor = True
+                self.pitch_anchor = True
+                # carry on from the autonomous code's velocities
+                self.set_anchor("depth", depth, output=-z_velocity)
+                self.set_anchor("pitch", attitude, output=pitch_velocity)
+                print("Autonomous task completed!")
+
+            elif return_code == CoralReturn.FAILED:
+                self.is_autonomous = False
+                ImageHandler.stop_listening()
+                print("Autonomous task failed! ;-;")
+
+        if photo_trigger:
+            try:
+                ImageHandler.start_listening()
+                img, *_ = ImageHandler.pump_image()
+                if img is not None:
+                    filename = f"test_images/{time()}.jpg"
+                    cv2.imwrite(filename, img)
+                    print(f"Saved image to {filename}")
+                else:
+                    print("Unable to save image!")
+            except Exception as e:
+                print(f"Photo trigger error: {e}")
+
+        # before beginning the autonomous coral transplantation task, the ROV should
+        # move over to the square and record the depth of the square
+        if record_depth_trigger:
+            self.square_depth = depth
+
+        # increase or decrease speed when the dpad buttons are pressed
+        if speed_toggle != self.prev_speed_toggle:
+            # make sure the speed doesn't exceed 1
+            if speed_toggle > 0 and self.speed_multiplier < 1:
+                self.set_throttle += 0.1
+            # make sure the speed doesn't fall below 0
+            if speed_toggle < 0 and self.speed_multiplier >= 0.2:
+                self.set_throttle -= 0.1
+            # just in case the speed multiplier ends up out of range
+            if self.speed_multiplier > 1:
+                self.speed_multiplier = 1
+            elif self.speed_multiplier < 0:
+                self.speed_multiplier = 0
+            print(f"Speed Multiplier: {self.speed_multiplier}")
+            self.prev_speed_toggle = speed_toggle
+
+        # toggle the depth anchor
+        if (
+            self.has_depth_sensor
+            and depth_anchor_toggle
+            and not self.prev_depth_anchor_toggle
+        ):
+            if self.depth_anchor:
+                print("Vertical anchor disabled!")
+                self.depth_anchor = False
+                self.anchor_pids.disable("depth")
+            elif depth is not None:
+                self.depth_anchor = True
+                self.set_anchor("depth", depth)
+                print(f"Vertical anchor enabled at: {self.depth_set_point} m")
+
+        # toggle the yaw anchor
+        if self.has_imu and yaw_anchor_toggle and not self.prev_yaw_anchor_toggle:
+            if self.yaw_anchor:
+                print("Yaw anchor disabled!")
+                self.yaw_anchor = False
+                self.anchor_pids.disable("yaw")
+            elif self.has_depth_sensor:
+                self.yaw_anchor = True
+                self.set_anchor("yaw", attitude)
+                print(f"Yaw anchor enabled at: {yaw}°")
+
+        # toggle the roll anchor
+        if self.has_imu and roll_anchor_toggle and not self.prev_roll_anchor_toggle:
+            if self.roll_anchor:
+                print("Roll anchor disabled!")
+                self.roll_anchor = False
+                self.anchor_pids.disable("roll")
+            elif self.has_depth_sensor:
+                self.roll_anchor = True
+                self.set_anchor("roll", attitude)
+                print(f"Roll anchor enabled at: {roll}°")
+
+        # toggle the pitch anchor
+        if self.has_imu and pitch_anchor_toggle and not self.prev_pitch_anchor_toggle:
+            if self.pitch_anchor:
+                print("Pitch anchor disabled!")
+                self.pitch_anchor = False
+                self.anchor_pids.disable("pitch")
+            elif self.has_depth_sensor:
+                self.pitch_anchor = True
+                self.set_anchor("pitch", attitude)
+                print(f"Pitch anchor enabled at: {pitch}°")
+
+        # toggle the motor lock
+        if motor_lock_toggle and not self.prev_motor_lock_toggle:
+            if any(self.motor_locks.values()):
+                self.motor_locks = {
+                    "x": False,
+                    "y": False,
+                    "z": False,
+                    "yaw": False,
+                    "pitch": False,
+                    "roll": False,
+                }
+                print("Motor lock disabled!")
+            else:
+                self.motor_locks = {
+                    "x": True,
+                    "y": True,
+                    "z": True,
+                    "yaw": True,
+                    "pitch": True,
+                    "roll": True,
+                }
+                self.locked_velocities["x"] = x_velocity
+                self.locked_velocities["y"] = y_velocity
+                self.locked_velocities["z"] = z_velocity
+                self.locked_velocities["yaw"] = yaw_velocity
+                self.locked_velocities["pitch"] = pitch_velocity
+                self.locked_velocities["roll"] = roll_velocity
+                print("Motor lock enabled!")
+
+        # toggle the autonomous control
+        if autonomous_toggle and not self.prev_autonomous_toggle:
+            if self.is_autonomous:
+                ImageHandler.stop_listening()
+                self.is_autonomous = False
+                print("Autonomous mode disabled!")
+            else:
+                ImageHandler.start_listening()
+                self.is_autonomous = True
+                if self.square_depth is not None:
+                    self.coral_transplanter = CoralTransplanter(
+                        self.square_depth, yaw, self.clock
+                    )
+                else:
+                    self.coral_transplanter = CoralTransplanter(
+                        depth - SQUARE_HEIGHT, yaw, self.clock
+                    )
+                print("Autonomous mode enabled!")
+
+        self.prev_depth_anchor_toggle = depth_anchor_toggle
+        self.prev_yaw_anchor_toggle = yaw_anchor_toggle
+        self.prev_roll_anchor_toggle = roll_anchor_toggle
+        self.prev_pitch_anchor_toggle = pitch_anchor_toggle
+        self.prev_motor_lock_toggle = motor_lock_toggle
+        self.prev_autonomous_toggle = autonomous_toggle
+
+        return (
+            x_velocity,
+            y_velocity,
+            z_velocity,
+            yaw_velocity,
+            pitch_velocity,
+            roll_velocity,
+        )
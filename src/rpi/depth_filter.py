@@ -0,0 +1,120 @@
+import numpy as np
+
+# how noisy the depth sensor's readings are (m), including the waves
+DEPTH_NOISE = 0.003
+# how far the IMU's vertical acceleration is from the real thing (m/s^2). it's what
+# makes the filter trust the depth sensor over the IMU in the long run
+ACCELERATION_NOISE = 0.1
+# how quickly the IMU's acceleration bias wanders (m/s^2 per √s)
+BIAS_DRIFT = 0.005
+# without the IMU the acceleration is assumed to be 0, give or take this much
+NO_IMU_ACCELERATION_NOISE = 1.0
+# how sure the filter is of itself when it's started from the first reading: depth (m),
+# vertical velocity (m/s) and acceleration bias (m/s^2)
+INITIAL_UNCERTAINTY = (DEPTH_NOISE, 0.2, 0.2)
+
+
+# a Kalman filter that fuses the depth sensor with the IMU's vertical acceleration. it
+# predicts the depth and vertical velocity forward with the acceleration on every
+# control tick and corrects them whenever the depth sensor finishes a conversion, so
+# both are available at the full control rate. the state is the depth (m, positive
+# down), the vertical velocity (m/s, positive down) and the bias of the IMU's
+# acceleration (m/s^2), which would otherwise make the velocity drift
+class DepthFilter:
+    def __init__(
+        self,
+        depth_noise=DEPTH_NOISE,
+        acceleration_noise=ACCELERATION_NOISE,
+        bias_drift=BIAS_DRIFT,
+    ):
+        self.depth_variance = depth_noise**2
+        self.acceleration_noise = acceleration_noise
+        self.bias_drift = bias_drift
+
+        self.state = np.zeros(3)
+        self.covariance = np.zeros((3, 3))
+        self.initialized = False
+        self.last_time = None
+        # the acceleration measured at the last prediction, used until the next one
+        self.acceleration = None
+
+        self.transition = np.eye(3)
+        self.process_noise = np.zeros((3, 3))
+
+    @property
+    def depth(self):
+        return float(self.state[0]) if self.initialized else None
+
+    @property
+    def velocity(self):
+        return float(self.state[1]) if self.initialized else None
+
+    # forgets everything, e.g. when the depth sensor stops responding
+    def reset(self):
+        self.initialized = False
+        self.last_time = None
+        self.acceleration = None
+
+    # moves the state forward to now with the acceleration measured over the last tick,
+    # acceleration is the IMU's vertical acceleration (m/s^2, positive down) now, or
+    # None if there's no IMU
+    def predict(self, now: float, acceleration=None):
+        if not self.initialized:
+            return
+        d_time = now - self.last_time
+        self.last_time = now
+        if d_time > 0:
+            self.advance(d_time)
+        self.acceleration = acceleration
+
+    def advance(self, d_time: float):
+        half_d_time_squared = 0.5 * d_time * d_time
+        if self.acceleration is not None:
+            # the real acceleration is the measured one minus the bias
+            acceleration = self.acceleration - self.state[2]
+            noise = self.acceleration_noise
+        else:
+            acceleration = 0
+            noise = NO_IMU_ACCELERATION_NOISE
+
+        state = self.state
+        state[0] += state[1] * d_time + acceleration * half_d_time_squared
+        state[1] += acceleration * d_time
+
+        # depth, velocity and bias after d_time from each of them before
+        transition = self.transition
+        transition[0, 1] = d_time
+        if self.acceleration is not None:
+            transition[0, 2] = -half_d_time_squared
+            transition[1, 2] = -d_time
+        else:
+            # the bias can't be seen without the IMU
+            transition[0, 2] = 0
+            transition[1, 2] = 0
+
+        # white noise on the acceleration over the whole tick, plus the bias wandering
+        gain = (half_d_time_squared, d_time, 0)
+        process_noise = np.outer(gain, gain, out=self.process_noise)
+        process_noise *= noise**2
+        process_noise[2, 2] = self.bias_drift**2 * d_time
+
+        covariance = transition @ self.covariance @ transition.T
+        covariance += process_noise
+        self.covariance = covariance
+
+    # corrects the state with a depth reading (m) taken at now
+    def update(self, now: float, depth: float):
+        if not self.initialized:
+            self.state[:] = (depth, 0, 0)
+            self.covariance = np.diag(np.square(INITIAL_UNCERTAINTY))
+            self.initialized = True
+            self.last_time = now
+            return
+        self.predict(now, self.acceleration)
+
+        covariance = self.covariance
+        innovation = depth - self.state[0]
+        innovation_variance = covariance[0, 0] + self.depth_variance
+        kalman_gain = covariance[:, 0] / innovation_variance
+        self.state += kalman_gain * innovation
+        self.covariance = covariance - np.outer(kalman_gain, covariance[0])
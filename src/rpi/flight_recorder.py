@@ -0,0 +1,307 @@
+import glob
+import numpy as np
+import os
+import sys
+from time import monotonic, strftime, time
+from ws_server import JOYSTICK_BUTTONS
+
+# records are written into preallocated, memory-mapped files, each holding this many
+# control ticks (10 minutes at 100 Hz, about 14 MB). when a file fills up the recorder
+# moves on to a new one and deletes the oldest once there are more than MAX_FILES,
+# counting the files of every session, so the SD card never fills up
+RECORDS_PER_FILE = 60_000
+MAX_FILES = 12
+# every run of the ROV gets its own session directory in here
+RECORDINGS_DIR = os.path.expanduser("~/.cache/jona-rov/recordings")
+
+MAGIC = b"JONAFR"
+VERSION = 3
+
+HEADER_DTYPE = np.dtype(
+    [
+        ("magic", "S6"),
+        ("version", "<u2"),
+        ("record_size", "<u4"),
+        ("capacity", "<u4"),
+        # how many of the records have actually been written
+        ("count", "<u4"),
+        # to convert the monotonic timestamps of the records into wall clock time
+        ("start_wall_time", "<f8"),
+        ("start_monotonic", "<f8"),
+    ]
+)
+# leave some room in the header for later additions
+HEADER_SIZE = 64
+
+# the PIDs whose terms are recorded, in order (controller.ANCHORS)
+RECORDED_PIDS = ("depth", "yaw", "roll", "pitch")
+
+# bits of the flags field
+FLAG_DEPTH_ANCHOR = 1 << 0
+FLAG_YAW_ANCHOR = 1 << 1
+FLAG_ROLL_ANCHOR = 1 << 2
+FLAG_PITCH_ANCHOR = 1 << 3
+# the motor locks take up bits 4 to 9 in the order of MOTOR_LOCKS
+FLAG_MOTOR_LOCK_SHIFT = 4
+MOTOR_LOCKS = ("x", "y", "z", "yaw", "pitch", "roll")
+FLAG_AUTONOMOUS = 1 << 10
+# whether there was any (recent) joystick input this tick
+FLAG_JOYSTICK = 1 << 11
+
+# one control tick. missing sensor values are stored as NaN
+RECORD_DTYPE = np.dtype(
+    [
+        # time the tick was scheduled for, on the scheduler's clock (monotonic on the
+        # ROV, simulated time in the simulator)
+        ("time", "<f8"),
+        # how late the tick started on the scheduler's clock, and how long it really
+        # took, in seconds
+        ("jitter", "<f4"),
+        ("runtime", "<f4"),
+        # sensor readings
+        # depth is from the depth filter, measured_depth is the depth sensor's last
+        # reading
+        ("depth", "<f4"),
+        ("depth_rate", "<f4"),
+        ("measured_depth", "<f4"),
+        ("external_temp", "<f4"),
+        ("internal_temp", "<f4"),
+        ("yaw", "<f4"),
+        ("roll", "<f4"),
+        ("pitch", "<f4"),
+        # (w, x, y, z), see Readings.attitude
+        ("attitude", "<f4", 4),
+        ("linear_acceleration", "<f4", 3),
+        ("voltage_5V", "<f4"),
+        ("current_5V", "<f4"),
+        ("voltage_12V", "<f4"),
+        ("current_12V", "<f4"),
+        # joystick input: left stick, right stick and dpad axes, buttons as a bitmask
+        ("joystick_seq", "<u4"),
+        ("joystick_axes", "<f4", 6),
+        ("joystick_buttons", "<u2"),
+        ("flags", "<u2"),
+        ("speed_multiplier", "<f4"),
+        # P, I and D terms of each of RECORDED_PIDS
+        ("pid_terms", "<f4", (len(RECORDED_PIDS), 3)),
+        # x, y, z, yaw, pitch, roll velocities given to the motors
+        ("velocities", "<f4", 6),
+        # the 8 motor outputs after mixing and limiting
+        ("motor_outputs", "<f4", 8),
+    ]
+)
+
+
+class FlightRecorder:
+    def __init__(
+        self,
+        recordings_dir=RECORDINGS_DIR,
+        records_per_file=RECORDS_PER_FILE,
+        max_files=MAX_FILES,
+    ):
+        self.recordings_dir = recordings_dir
+        self.directory = new_session_directory(recordings_dir)
+        self.records_per_file = records_per_file
+        self.max_files = max_files
+
+        self.file_num = -1
+        self.header = None
+        self.records = None
+        self.index = 0
+        self.open_next_file()
+
+    def open_next_file(self):
+        self.close()
+        self.file_num += 1
+        path = os.path.join(self.directory, f"{self.file_num:05}.jfr")
+        size = HEADER_SIZE + RECORD_DTYPE.itemsize * self.records_per_file
+        # preallocate the whole file so writing a record never has to grow it
+        with open(path, "wb") as f:
+            f.truncate(size)
+
+        self.header = np.memmap(path, dtype=HEADER_DTYPE, mode="r+", shape=(1,))
+        self.records = np.memmap(
+            path,
+            dtype=RECORD_DTYPE,
+            mode="r+",
+            offset=HEADER_SIZE,
+            shape=(self.records_per_file,),
+        )
+        header = self.header[0]
+        header["magic"] = MAGIC
+        header["version"] = VERSION
+        header["record_size"] = RECORD_DTYPE.itemsize
+        header["capacity"] = self.records_per_file
+        header["count"] = 0
+        header["start_wall_time"] = time()
+        header["start_monotonic"] = monotonic()
+        self.index = 0
+
+        prune_recordings(self.recordings_dir, self.max_files)
+
+    # returns the next empty record to be filled in by the caller
+    def next_record(self):
+        if self.index >= self.records_per_file:
+            self.open_next_file()
+        record = self.records[self.index]
+        self.index += 1
+        self.header[0]["count"] = self.index
+        return record
+
+    def record_tick(
+        self,
+        scheduled_time: float,
+        start_time: float,
+        runtime: float,
+        readings,
+        joystick_data,
+        controller,
+        velocities: tuple,
+        motor_outputs: list,
+    ):
+        record = self.next_record()
+        record["time"] = scheduled_time
+        record["jitter"] = start_time - scheduled_time
+        record["runtime"] = runtime
+
+        record["depth"] = readings.depth
+        record["depth_rate"] = readings.depth_rate
+        record["measured_depth"] = readings.measured_depth
+        record["external_temp"] = readings.external_temp
+        record["internal_temp"] = readings.internal_temp
+        record["yaw"] = readings.yaw
+        record["roll"] = readings.roll
+        record["pitch"] = readings.pitch
+        record["attitude"] = readings.attitude
+        record["linear_acceleration"] = (
+            readings.x_accel,
+            readings.y_accel,
+            readings.z_accel,
+        )
+        record["voltage_5V"] = readings.voltage_5V
+        record["current_5V"] = readings.current_5V
+        record["voltage_12V"] = readings.voltage_12V
+        record["current_12V"] = readings.current_12V
+
+        flags = 0
+        if joystick_data:
+            flags |= FLAG_JOYSTICK
+            record["joystick_seq"] = joystick_data.get("seq", 0)
+            record["joystick_axes"] = (
+                *joystick_data["left_stick"],
+                *joystick_data["right_stick"],
+                *joystick_data["dpad"],
+            )
+            buttons = joystick_data["buttons"]
+            record["joystick_buttons"] = sum(
+                1 << bit for bit, name in enumerate(JOYSTICK_BUTTONS) if buttons.get(name)
+            )
+        else:
+            record["joystick_seq"] = 0
+            record["joystick_axes"] = 0
+            record["joystick_buttons"] = 0
+
+        if controller.depth_anchor:
+            flags |= FLAG_DEPTH_ANCHOR
+        if controller.yaw_anchor:
+            flags |= FLAG_YAW_ANCHOR
+        if controller.roll_anchor:
+            flags |= FLAG_ROLL_ANCHOR
+        if controller.pitch_anchor:
+            flags |= FLAG_PITCH_ANCHOR
+        for bit, name in enumerate(MOTOR_LOCKS, start=FLAG_MOTOR_LOCK_SHIFT):
+            if controller.motor_locks[name]:
+                flags |= 1 << bit
+        if controller.is_autonomous:
+            flags |= FLAG_AUTONOMOUS
+        record["flags"] = flags
+        record["speed_multiplier"] = controller.speed_multiplier
+
+        # the controller's anchors are in the same order as RECORDED_PIDS
+        record["pid_terms"] = controller.anchor_pids.terms
+
+        record["velocities"] = velocities
+        record["motor_outputs"] = motor_outputs
+
+    def flush(self):
+        if self.records is not None:
+            self.records.flush()
+            self.header.flush()
+
+    def close(self):
+        self.flush()
+        self.header = None
+        self.records = None
+
+
+# creates a directory for a new session, named after when it started. a session that
+# starts in the same second as another gets a suffix rather than writing over it (the
+# suffix still sorts after the first one)
+def new_session_directory(recordings_dir: str) -> str:
+    os.makedirs(recordings_dir, exist_ok=True)
+    name = strftime("%Y-%m-%d-%H%M%S")
+    suffix = 0
+    while True:
+        directory = os.path.join(
+            recordings_dir, name if suffix == 0 else f"{name}-{suffix:02}"
+        )
+        try:
+            os.mkdir(directory)
+            return directory
+        except FileExistsError:
+            suffix += 1
+
+
+# deletes the oldest files of every session in recordings_dir until there are only
+# max_files left, along with any sessions that end up empty. the session directories
+# are named after when they started, so they sort oldest first
+def prune_recordings(recordings_dir: str, max_files: int):
+    paths = sorted(glob.glob(os.path.join(recordings_dir, "*", "*.jfr")))
+    for path in paths[: max(len(paths) - max_files, 0)]:
+        os.remove(path)
+        session = os.path.dirname(path)
+        if not os.listdir(session):
+            os.rmdir(session)
+
+
+# reads every file of a recorded session, in order, into a single structured array
+# (e.g. load_session(path)["depth"] is an array of all the recorded depths). also
+# returns the wall clock time corresponding to a monotonic time of 0
+def load_session(directory: str) -> (np.ndarray, float):
+    chunks = []
+    wall_time_offset = None
+    for path in sorted(glob.glob(os.path.join(directory, "*.jfr"))):
+        header = np.fromfile(path, dtype=HEADER_DTYPE, count=1)[0]
+        if header["magic"] != MAGIC:
+            print(f"Not a flight recording: {path}")
+            continue
+        if header["version"] != VERSION or header["record_size"] != RECORD_DTYPE.itemsize:
+            print(f"Unsupported flight recording version: {path}")
+            continue
+        if wall_time_offset is None:
+            wall_time_offset = header["start_wall_time"] - header["start_monotonic"]
+        records = np.fromfile(
+            path, dtype=RECORD_DTYPE, count=header["count"], offset=HEADER_SIZE
+        )
+        chunks.append(records)
+
+    if not chunks:
+        return np.empty(0, dtype=RECORD_DTYPE), None
+    return np.concatenate(chunks), wall_time_offset
+
+
+def main():
+    if len(sys.argv) < 2:
+        print("Usage: python flight_recorder.py <session directory>")
+        return
+    records, wall_time_offset = load_session(sys.argv[1])
+    print(f"{len(records)} records")
+    if len(records) > 0:
+        duration = records["time"][-1] - records["time"][0]
+        print(f"Duration: {duration:.1f} s")
+        print(f"Max runtime: {np.max(records['runtime']) * 1000:.2f} ms")
+        print(f"Depth: {np.nanmin(records['depth']):.2f}..{np.nanmax(records['depth']):.2f} m")
+
+
+if __name__ == "__main__":
+    main()
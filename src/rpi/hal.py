@@ -0,0 +1,487 @@
+from imu import (
+    BURST_FORMAT,
+    BURST_LENGTH,
+    GYRO_DATA_REGISTER,
+    IMU,
+    parse_burst,
+    sensor_quaternion,
+)
+from motors import PCA9685Outputs, PCA9685PWM, pca9685_frequency
+from ms5837 import DENSITY_FRESHWATER, MODEL_02BA, MS5837, MS5837_02BA
+from power_monitoring import ADC_RANGE, ADS1015ADC, MAX_DATA_RATE
+import struct
+import threading
+from time import monotonic, sleep
+
+try:
+    from smbus2 import SMBus
+except ImportError:
+    # ms5837.py already complains about this
+    pass
+
+# the I2C bus the depth sensor is on
+DEPTH_SENSOR_BUS = 1
+
+# every device can be backed by:
+# real  - the actual hardware on the Pi, optionally recording an I2C trace of it
+# fake  - in-memory devices that read back whatever they were last set to
+# trace - plays back an I2C trace recorded from the real hardware
+BACKENDS = ("real", "fake", "trace")
+
+# an I2C trace is TRACE_MAGIC followed by a record for each read from or write to a
+# device: TRACE_RECORD_FORMAT followed by the data that was read or written
+TRACE_MAGIC = b"JONAI2C\x01"
+# monotonic time (f64), device (u8), read or write (u8), register (u8), length (u8)
+TRACE_RECORD_FORMAT = "<dBBBB"
+TRACE_RECORD_SIZE = struct.calcsize(TRACE_RECORD_FORMAT)
+TRACE_DEVICES = ("depth", "imu", "adc", "pwm")
+TRACE_READ = 0
+TRACE_WRITE = 1
+
+
+class TraceWriter:
+    def __init__(self, path: str):
+        self.path = path
+        self.file = open(path, "wb")
+        self.file.write(TRACE_MAGIC)
+        self.device_ids = {device: i for i, device in enumerate(TRACE_DEVICES)}
+        # the ADC is read from its own thread
+        self.lock = threading.Lock()
+        self.count = 0
+
+    def record(self, device: str, operation: int, register: int, data: bytes):
+        header = struct.pack(
+            TRACE_RECORD_FORMAT,
+            monotonic(),
+            self.device_ids[device],
+            operation,
+            register,
+            len(data),
+        )
+        with self.lock:
+            self.file.write(header)
+            self.file.write(data)
+            self.count += 1
+
+    def close(self):
+        with self.lock:
+            if not self.file.closed:
+                self.file.close()
+
+
+class TracePlayer:
+    def __init__(self, path: str, loop=True):
+        # (device, register) -> data of every read/write, in order. reads are played
+        # back per register so e.g. the depth sensor's calibration PROM is still read
+        # from the right place when the trace loops around
+        self.reads = {}
+        self.writes = {}
+        self.read_index = {}
+        self.write_index = {}
+        # whether to go back to the start of the trace once it runs out
+        self.loop = loop
+
+        with open(path, "rb") as f:
+            buffer = f.read()
+        if not buffer.startswith(TRACE_MAGIC):
+            raise ValueError(f"Not an I2C trace: {path}")
+        offset = len(TRACE_MAGIC)
+        while offset + TRACE_RECORD_SIZE <= len(buffer):
+            _, device, operation, register, length = struct.unpack_from(
+                TRACE_RECORD_FORMAT, buffer, offset
+            )
+            offset += TRACE_RECORD_SIZE
+            data = buffer[offset : offset + length]
+            offset += length
+            records = self.reads if operation == TRACE_READ else self.writes
+            records.setdefault((TRACE_DEVICES[device], register), []).append(data)
+
+    # the data of the next recorded read from a device's register
+    def next_read(self, device: str, register: int) -> bytes:
+        key = (device, register)
+        reads = self.reads.get(key)
+        if not reads:
+            raise OSError(f"No {device} reads of register {register:#x} in the trace")
+        index = self.read_index.get(key, 0)
+        if index >= len(reads):
+            if not self.loop:
+                raise OSError(f"The {device} trace has run out")
+            index = 0
+        self.read_index[key] = index + 1
+        return reads[index]
+
+    # the data of the next recorded write to a device's register, None if there is none
+    def next_write(self, device: str, register: int):
+        key = (device, register)
+        writes = self.writes.get(key)
+        if not writes:
+            return None
+        index = self.write_index.get(key, 0)
+        if index >= len(writes):
+            if not self.loop:
+                return None
+            index = 0
+        self.write_index[key] = index + 1
+        return writes[index]
+
+
+# wraps an SMBus, recording everything that goes over it
+class TracingSMBus:
+    def __init__(self, bus, trace: TraceWriter, device: str):
+        self.bus = bus
+        self.trace = trace
+        self.device = device
+
+    def write_byte(self, address: int, value: int):
+        self.bus.write_byte(address, value)
+        self.trace.record(self.device, TRACE_WRITE, value, b"")
+
+    def read_word_data(self, address: int, register: int) -> int:
+        value = self.bus.read_word_data(address, register)
+        self.trace.record(self.device, TRACE_READ, register, struct.pack("<H", value))
+        return value
+
+    def read_i2c_block_data(self, address: int, register: int, length: int) -> list:
+        data = self.bus.read_i2c_block_data(address, register, length)
+        self.trace.record(self.device, TRACE_READ, register, bytes(data))
+        return data
+
+
+# an SMBus that answers reads from a trace, writes go nowhere
+class PlaybackSMBus:
+    def __init__(self, player: TracePlayer, device: str):
+        self.player = player
+        self.device = device
+
+    def write_byte(self, address: int, value: int):
+        pass
+
+    def read_word_data(self, address: int, register: int) -> int:
+        return struct.unpack("<H", self.player.next_read(self.device, register))[0]
+
+    def read_i2c_block_data(self, address: int, register: int, length: int) -> list:
+        return list(self.player.next_read(self.device, register)[:length])
+
+
+# pretends to be an MS5837 on the other end of an SMBus, so the real driver (and its
+# compensation maths) runs on top of it
+class FakeMS5837Bus:
+    # calibration coefficients from the example in the MS5837-02BA datasheet
+    PROM = [0, 46372, 43981, 29059, 27842, 31553, 28165]
+
+    def __init__(self, depth=0, temperature=20, model=MODEL_02BA):
+        self.model = model
+        self.fluid_density = DENSITY_FRESHWATER
+        self.prom = list(self.PROM)
+        self.prom[0] |= MS5837(model, bus=self)._crc4(list(self.prom)) << 12
+        self.D1 = 0
+        self.D2 = 0
+        self.conversion = 0
+        self.set(depth, temperature)
+
+    # works out the raw pressure and temperature values the sensor would give at this
+    # depth (m) and temperature (°C)
+    def set(self, depth: float, temperature: float):
+        sensor = MS5837(self.model, bus=self)
+        sensor._C = self.prom
+
+        # temperature only depends on D2 (ignoring the second order compensation),
+        # one correction step takes care of that too
+        D2 = (temperature * 100 - 2000) * 8388608 / self.prom[6] + self.prom[5] * 256
+        sensor._D1 = 0
+        sensor._D2 = round(D2)
+        sensor._calculate()
+        D2 += (temperature - sensor.temperature()) * 100 * 8388608 / self.prom[6]
+        sensor._D2 = round(D2)
+
+        # for a given D2 the pressure is linear in D1
+        sensor._calculate()
+        pressure_at_0 = sensor.pressure()
+        sensor._D1 = 1 << 23
+        sensor._calculate()
+        pressure_slope = (sensor.pressure() - pressure_at_0) / (1 << 23)
+        pressure = (depth * self.fluid_density * 9.80665 + 101300) / 100
+
+        D1 = round((pressure - pressure_at_0) / pressure_slope)
+        self.D1 = min(max(D1, 0), 0xFFFFFF)
+        self.D2 = min(max(sensor._D2, 0), 0xFFFFFF)
+
+    def write_byte(self, address: int, value: int):
+        self.conversion = value
+
+    def read_word_data(self, address: int, register: int) -> int:
+        c = self.prom[(register - MS5837._MS5837_PROM_READ) // 2]
+        # SMBus words are little-endian, the sensor sends them big-endian
+        return ((c & 0xFF) << 8) | (c >> 8)
+
+    def read_i2c_block_data(self, address: int, register: int, length: int) -> list:
+        if self.conversion & 0xF0 == MS5837._MS5837_CONVERT_D1_256:
+            value = self.D1
+        else:
+            value = self.D2
+        return [(value >> 16) & 0xFF, (value >> 8) & 0xFF, value & 0xFF]
+
+
+# wraps an IMU, recording every burst read
+class TracingIMU:
+    def __init__(self, imu: IMU, trace: TraceWriter):
+        self.imu = imu
+        self.trace = trace
+
+    def read(self):
+        snapshot = self.imu.read()
+        self.trace.record("imu", TRACE_READ, GYRO_DATA_REGISTER, bytes(self.imu.buffer))
+        return snapshot
+
+
+# an IMU whose measurements are set directly. they're still packed into a burst and
+# parsed like the real thing, so they're quantized the same way
+class FakeIMU:
+    def __init__(self):
+        self.buffer = bytearray(BURST_LENGTH)
+        # level, the IMU is mounted so that a level ROV reads a pitch of 90°
+        self.set(
+            euler=(0, 0, 90),
+            quaternion=sensor_quaternion((1, 0, 0, 0)),
+            gravity=(0, 0, 9.8),
+        )
+
+    def set(
+        self,
+        gyro=(0, 0, 0),
+        euler=(0, 0, 0),
+        quaternion=(1, 0, 0, 0),
+        linear_acceleration=(0, 0, 0),
+        gravity=(0, 0, 0),
+        temperature=20,
+    ):
+        # the inverse of the scaling in parse_burst()
+        struct.pack_into(
+            BURST_FORMAT,
+            self.buffer,
+            0,
+            *(round(v * 16) for v in gyro),
+            *(round(v * 16) for v in euler),
+            *(round(v * (1 << 14)) for v in quaternion),
+            *(round(v * 100) for v in linear_acceleration),
+            *(round(v * 100) for v in gravity),
+            round(temperature),
+        )
+
+    def read(self):
+        return parse_burst(self.buffer, monotonic())
+
+
+class PlaybackIMU:
+    def __init__(self, player: TracePlayer):
+        self.player = player
+
+    def read(self):
+        return parse_burst(
+            self.player.next_read("imu", GYRO_DATA_REGISTER), monotonic()
+        )
+
+
+class TracingADC:
+    def __init__(self, adc, trace: TraceWriter):
+        self.adc = adc
+        self.range = adc.range
+        self.trace = trace
+
+    def read(self, channel: int) -> int:
+        value = self.adc.read(channel)
+        self.trace.record("adc", TRACE_READ, channel, struct.pack("<h", value))
+        return value
+
+
+# an ADC that reads back whatever its channels were set to. it waits as long as a
+# real conversion would take so the power monitor's scanning thread doesn't hog the
+# interpreter
+class FakeADC:
+    def __init__(self, sample_period=1 / MAX_DATA_RATE):
+        self.range = ADC_RANGE
+        self.sample_period = sample_period
+        self.values = [0, 0, 0, 0]
+        self.set_rails()
+
+    def set_voltage(self, channel: int, voltage: float):
+        self.values[channel] = round(voltage / self.range * 2**15)
+
+    # sets the channels to what the power monitor's voltage dividers and current
+    # sensors would output
+    def set_rails(self, voltage_5V=5, current_5V=0, voltage_12V=12, current_12V=0):
+        self.set_voltage(0, voltage_12V / 4)
+        self.set_voltage(1, voltage_5V)
+        self.set_voltage(2, (current_12V + 36.7) * voltage_5V / 73.3)
+        self.set_voltage(3, (current_5V + 36.7) * voltage_5V / 73.3)
+
+    def read(self, channel: int) -> int:
+        if self.sample_period > 0:
+            sleep(self.sample_period)
+        return self.values[channel]
+
+
+class PlaybackADC:
+    def __init__(self, player: TracePlayer, sample_period=1 / MAX_DATA_RATE):
+        self.player = player
+        self.range = ADC_RANGE
+        self.sample_period = sample_period
+
+    def read(self, channel: int) -> int:
+        if self.sample_period > 0:
+            sleep(self.sample_period)
+        return struct.unpack("<h", self.player.next_read("adc", channel))[0]
+
+
+class TracingPWM:
+    def __init__(self, pwm, trace: TraceWriter):
+        self.pwm = pwm
+        self.trace = trace
+
+    def set_pulse_widths(self, channels, pulse_widths):
+        burst = self.pwm.set_pulse_widths(channels, pulse_widths)
+        if burst is not None:
+            register, data = burst
+            self.trace.record("pwm", TRACE_WRITE, register, data)
+        return burst
+
+    def pulse_width(self, channel: int):
+        return self.pwm.pulse_width(channel)
+
+
+# a PWM controller that just remembers what each channel was set to
+class FakePWM(PCA9685Outputs):
+    def __init__(self, num_channels=16):
+        # the same frequency the real one uses, so the counts are the same too
+        super().__init__(pca9685_frequency(), num_channels)
+
+    def write_registers(self, register: int, data: bytes):
+        pass
+
+
+# a fake PWM controller that also checks that every burst is written with the same
+# data, in the same order, as in the trace
+class PlaybackPWM(FakePWM):
+    def __init__(self, player: TracePlayer, num_channels=16):
+        super().__init__(num_channels)
+        self.player = player
+        self.mismatches = 0
+
+    def write_registers(self, register: int, data: bytes):
+        expected = self.player.next_write("pwm", register)
+        if expected is not None and expected != data:
+            self.mismatches += 1
+
+
+class RealBackend:
+    name = "real"
+
+    # if trace_path is given, all the I2C traffic of the devices is recorded there
+    def __init__(self, trace_path=None):
+        self.trace = TraceWriter(trace_path) if trace_path is not None else None
+
+    def depth_sensor(self):
+        if self.trace is None:
+            return MS5837_02BA(DEPTH_SENSOR_BUS)
+        return MS5837_02BA(
+            TracingSMBus(SMBus(DEPTH_SENSOR_BUS), self.trace, "depth")
+        )
+
+    def imu(self):
+        imu = IMU()
+        return imu if self.trace is None else TracingIMU(imu, self.trace)
+
+    def adc(self):
+        adc = ADS1015ADC()
+        return adc if self.trace is None else TracingADC(adc, self.trace)
+
+    def pwm(self):
+        pwm = PCA9685PWM()
+        return pwm if self.trace is None else TracingPWM(pwm, self.trace)
+
+    def close(self):
+        if self.trace is not None:
+            self.trace.close()
+
+
+class FakeBackend:
+    name = "fake"
+
+    # the fake devices are kept around so their values can be set from outside
+    def __init__(self):
+        self.depth_bus = FakeMS5837Bus()
+        self.fake_imu = FakeIMU()
+        self.fake_adc = FakeADC()
+        self.fake_pwm = FakePWM()
+
+    def depth_sensor(self):
+        return MS5837_02BA(self.depth_bus)
+
+    def imu(self):
+        return self.fake_imu
+
+    def adc(self):
+        return self.fake_adc
+
+    def pwm(self):
+        return self.fake_pwm
+
+    def close(self):
+        pass
+
+
+class TraceBackend:
+    name = "trace"
+
+    def __init__(self, trace_path: str, loop=True):
+        self.player = TracePlayer(trace_path, loop)
+        self.playback_pwm = PlaybackPWM(self.player)
+
+    def depth_sensor(self):
+        return MS5837_02BA(PlaybackSMBus(self.player, "depth"))
+
+    def imu(self):
+        return PlaybackIMU(self.player)
+
+    def adc(self):
+        return PlaybackADC(self.player)
+
+    def pwm(self):
+        return self.playback_pwm
+
+    def close(self):
+        if self.playback_pwm.mismatches:
+            print(
+                f"{self.playback_pwm.mismatches} PWM writes didn't match the trace"
+            )
+
+
+# for "real" the trace (if any) is where to record to, for "trace" it's what to play
+def open_backend(name: str, trace_path=None):
+    if name == "real":
+        return RealBackend(trace_path)
+    elif name == "fake":
+        return FakeBackend()
+    elif name == "trace":
+        if trace_path is None:
+            raise ValueError("The trace backend needs a trace to play back")
+        return TraceBackend(trace_path)
+    raise ValueError(f"Unknown backend: {name}, should be one of {BACKENDS}")
+
+
+def main():
+    backend = FakeBackend()
+    depth_sensor = backend.depth_sensor()
+    depth_sensor.init()
+    for depth in (0, 0.5, 1, 2.5):
+        backend.depth_bus.set(depth, 18)
+        depth_sensor.read()
+        print(
+            f"Set: {depth} m Read: {depth_sensor.depth():.3f} m "
+            f"{depth_sensor.temperature():.2f}°C"
+        )
+    print(f"IMU: {backend.imu().read().euler}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,163 @@
+try:
+    import adafruit_bno055
+    import board
+except ImportError:
+    # parse_burst() and the fake IMUs in hal.py still work without the driver
+    print("Try pip install adafruit-circuitpython-bno055")
+import numpy as np
+from orientation import matrix_to_quaternion, quaternion_multiply
+import struct
+from time import monotonic, sleep
+
+# the BNO055's output registers are laid out back to back starting at the gyroscope
+# data, so everything the control loop needs can be read in a single auto-increment
+# burst instead of one I2C transaction per property
+GYRO_DATA_REGISTER = 0x14
+# gyro (3), euler (3), quaternion (4), linear acceleration (3), gravity (3) as signed
+# 16-bit little-endian integers, followed by the temperature as a signed byte
+BURST_FORMAT = "<3h3h4h3h3hb"
+BURST_LENGTH = struct.calcsize(BURST_FORMAT)
+
+# scale factors from the datasheet (default unit selection)
+_GYRO_SCALE = 1 / 16  # degrees per second
+_EULER_SCALE = 1 / 16  # degrees
+_QUATERNION_SCALE = 1 / (1 << 14)
+_ACCEL_SCALE = 1 / 100  # m/s^2
+
+# the BNO055's quaternion rotates its own axes (x, y, z as printed on the board) into
+# east, north, up. the controller works in the ROV's body frame (x forward, y right,
+# z down) relative to north, east, down, like the simulator
+ENU_TO_NED = matrix_to_quaternion([[0, 1, 0], [1, 0, 0], [0, 0, -1]])
+# the IMU is mounted on its side so that a level ROV reads a pitch of 90°: its x axis
+# points right, its y axis up and its z axis backward. if it's ever remounted, this is
+# the only thing that needs to change. takes a vector in the body frame to the IMU's
+BODY_TO_SENSOR = np.array([[0, 1, 0], [0, 0, -1], [-1, 0, 0]])
+MOUNTING_CORRECTION = matrix_to_quaternion(BODY_TO_SENSOR)
+# both corrections together, as a matrix that takes the IMU's quaternion straight to
+# the ROV's attitude: ENU_TO_NED * q * MOUNTING_CORRECTION
+ATTITUDE_CORRECTION = np.column_stack(
+    [
+        quaternion_multiply(quaternion_multiply(ENU_TO_NED, axis), MOUNTING_CORRECTION)
+        for axis in np.eye(4)
+    ]
+)
+# the quaternion reads all zeros until the sensor fusion has started
+MIN_QUATERNION_NORM = 0.5
+
+
+# all of the IMU's measurements from a single moment
+class IMUSnapshot:
+    def __init__(
+        self,
+        timestamp: float,
+        gyro: tuple,
+        euler: tuple,
+        quaternion: tuple,
+        linear_acceleration: tuple,
+        gravity: tuple,
+        temperature: int,
+    ):
+        self.timestamp = timestamp
+        # angular velocity around x, y, z in degrees per second
+        self.gyro = gyro
+        # heading, roll, pitch in degrees
+        self.euler = euler
+        # w, x, y, z
+        self.quaternion = quaternion
+        # acceleration without gravity in m/s^2
+        self.linear_acceleration = linear_acceleration
+        self.gravity = gravity
+        # in degrees celsius
+        self.temperature = temperature
+
+    # the ROV's attitude as a unit quaternion (w, x, y, z) rotating the body frame into
+    # north, east, down, None if the IMU isn't ready yet
+    @property
+    def attitude(self):
+        return body_attitude(self.quaternion)
+
+    @property
+    def yaw(self) -> float:
+        return self.euler[0]
+
+    @property
+    def roll(self) -> float:
+        return self.euler[1]
+
+    @property
+    def pitch(self) -> float:
+        return self.euler[2]
+
+
+class IMU:
+    def __init__(self, i2c=None):
+        # the adafruit driver is still used to reset and configure the sensor, only the
+        # reading of the measurements is done here
+        self.bno055 = adafruit_bno055.BNO055_I2C(i2c if i2c is not None else board.I2C())
+        self.buffer = bytearray(BURST_LENGTH)
+
+    def read(self) -> IMUSnapshot:
+        with self.bno055.i2c_device as i2c:
+            i2c.write_then_readinto(bytes((GYRO_DATA_REGISTER,)), self.buffer)
+        timestamp = monotonic()
+        return parse_burst(self.buffer, timestamp)
+
+
+# the ROV's attitude from the IMU's quaternion, see ATTITUDE_CORRECTION
+def body_attitude(quaternion):
+    attitude = ATTITUDE_CORRECTION @ quaternion
+    norm = np.linalg.norm(attitude)
+    if norm < MIN_QUATERNION_NORM:
+        return None
+    return attitude / norm
+
+
+# the downward component (m/s^2) of the IMU's linear acceleration, given the ROV's
+# attitude (see body_attitude)
+def vertical_acceleration(attitude, linear_acceleration) -> float:
+    w, x, y, z = attitude
+    # the body's x, y, z axes' contributions to down are the last row of the attitude's
+    # rotation matrix
+    down_x = 2 * (x * z - w * y)
+    down_y = 2 * (y * z + w * x)
+    down_z = 1 - 2 * (x * x + y * y)
+    # and the IMU's x, y, z axes are the body's y, -z, -x
+    sensor_x, sensor_y, sensor_z = linear_acceleration
+    return down_y * sensor_x - down_z * sensor_y - down_x * sensor_z
+
+
+# the quaternion the IMU reads at the given attitude of the ROV, e.g. for faking it
+def sensor_quaternion(attitude) -> np.ndarray:
+    # ATTITUDE_CORRECTION is orthogonal, so its transpose undoes it
+    return ATTITUDE_CORRECTION.T @ attitude
+
+
+def parse_burst(buffer, timestamp: float) -> IMUSnapshot:
+    values = struct.unpack_from(BURST_FORMAT, buffer)
+    return IMUSnapshot(
+        timestamp,
+        gyro=tuple(v * _GYRO_SCALE for v in values[0:3]),
+        euler=tuple(v * _EULER_SCALE for v in values[3:6]),
+        quaternion=tuple(v * _QUATERNION_SCALE for v in values[6:10]),
+        linear_acceleration=tuple(v * _ACCEL_SCALE for v in values[10:13]),
+        gravity=tuple(v * _ACCEL_SCALE for v in values[13:16]),
+        temperature=values[16],
+    )
+
+
+def main():
+    imu = IMU()
+    while True:
+        snapshot = imu.read()
+        # the attitude from the quaternion should agree with the euler angles (pitch
+        # 90° off), if it doesn't MOUNTING_CORRECTION is wrong
+        print(
+            f"Euler: {snapshot.euler} Attitude: {snapshot.attitude} "
+            f"Linear Acceleration: {snapshot.linear_acceleration} Gyro: "
+            f"{snapshot.gyro} Temperature: {snapshot.temperature}"
+        )
+        sleep(0.1)
+
+
+if __name__ == "__main__":
+    main()
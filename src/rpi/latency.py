@@ -0,0 +1,62 @@
+from collections import deque
+
+# how many of the most recent samples each stage keeps
+LATENCY_WINDOW = 512
+
+# the stages a joystick message goes through on its way to the thrusters:
+# network - browser sending it to WSServer receiving it (needs the clocks in sync)
+# queue   - WSServer receiving it to the control tick picking it up
+# control - the control tick picking it up to the PIDs and mixer being done
+# motors  - the PIDs and mixer being done to the PWM writes being done
+# total   - WSServer receiving it to the PWM writes being done
+STAGES = ("network", "queue", "control", "motors", "total")
+
+
+def percentile(sorted_samples: list, fraction: float) -> float:
+    index = round(fraction * (len(sorted_samples) - 1))
+    return sorted_samples[index]
+
+
+class LatencyTracker:
+    def __init__(self, window=LATENCY_WINDOW):
+        self.samples = {stage: deque(maxlen=window) for stage in STAGES}
+        self.traced = 0
+
+    def record(self, stage: str, seconds: float):
+        self.samples[stage].append(seconds)
+
+    # records every stage of a single joystick message. the times are monotonic
+    # except for sent_time and received_wall_time, which are seconds since the epoch
+    def trace(
+        self,
+        received_time: float,
+        consumed_time: float,
+        computed_time: float,
+        written_time: float,
+        sent_time=None,
+        received_wall_time=None,
+    ):
+        if sent_time is not None and received_wall_time is not None:
+            self.record("network", received_wall_time - sent_time)
+        self.record("queue", consumed_time - received_time)
+        self.record("control", computed_time - consumed_time)
+        self.record("motors", written_time - computed_time)
+        self.record("total", written_time - received_time)
+        self.traced += 1
+
+    # p50, p90, p99 and max of a stage in milliseconds, None if there's no samples
+    def percentiles(self, stage: str):
+        samples = sorted(self.samples[stage])
+        if not samples:
+            return None
+        return {
+            "p50": round(percentile(samples, 0.5) * 1000, 3),
+            "p90": round(percentile(samples, 0.9) * 1000, 3),
+            "p99": round(percentile(samples, 0.99) * 1000, 3),
+            "max": round(samples[-1] * 1000, 3),
+        }
+
+    def stats(self) -> dict:
+        stats = {stage: self.percentiles(stage) for stage in STAGES}
+        stats["traced"] = self.traced
+        return stats
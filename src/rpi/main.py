@@ -1,480 +1,233 @@
-import adafruit_bno055
+import argparse
 import asyncio
 import autonomous
-from autonomous import ImageHandler, CoralTransplanter, CoralReturn, SQUARE_HEIGHT
-import board
-import cv2
-import json
+from autonomous import ImageHandler
+from controller import Controller, Readings, TickClock
+from depth_filter import DepthFilter
+from flight_recorder import RECORDINGS_DIR, FlightRecorder
+from hal import BACKENDS, RealBackend, open_backend
+from imu import vertical_acceleration
+from latency import LatencyTracker
 from motors import Motors
-from ms5837 import MS5837_02BA
-from orientation import quaternion_to_euler
-from pid import PID, RotationalPID
+from ms5837 import OSR_1024, OSR_8192, conversion_time
 from power_monitoring import PowerMonitor
-from time import time
+from scheduler import Scheduler
+from time import monotonic
 import threading
 import websockets
 from ws_server import WSServer
 
-# how far the joystick needs to be moved before stabilization is temporarily
-# disabled (0..1)
-destable_thresh = 0.5
-
-# set the current draw limit in amps. 
-# speed_multiplier will be changed to compensate for overdraw.
-MAX_CURRENT = 25 
-
-async def main_server():
-    motors = Motors()
-    # each motors needs to receive a neutral signal for at least two
-    # seconds, otherwise they won't work
-    await asyncio.sleep(2)
+# how often each subsystem should run (Hz)
+CONTROL_RATE = 100
+TELEMETRY_RATE = 20
+# if the joystick hasn't sent anything in this long (s), assume it's gone and stop
+# listening to it rather than driving on its last input
+JOYSTICK_TIMEOUT = 1
+# the depth sensor alternates between pressure and temperature conversions, one per
+# tick. temperature changes slowly, so it doesn't need as much oversampling
+DEPTH_OVERSAMPLING = OSR_8192
+TEMPERATURE_OVERSAMPLING = OSR_1024
+# slightly slower than the conversion time so a conversion is always done by the time
+# the next tick comes around
+DEPTH_RATE = 0.9 / conversion_time(DEPTH_OVERSAMPLING)
+
+
+# backend decides whether the devices are the real hardware, fakes or a trace being
+# played back (see hal.py). the simulator passes in its own scheduler, with its own
+# tasks already added, to run everything on simulated time. every control tick is
+# recorded to a new session in recordings_dir
+async def main_server(backend=None, scheduler=None, recordings_dir=RECORDINGS_DIR):
+    if backend is None:
+        backend = RealBackend()
+    if scheduler is None:
+        scheduler = Scheduler()
+
+    motors = Motors(backend.pwm())
+    if backend.name == "real":
+        # each motors needs to receive a neutral signal for at least two
+        # seconds, otherwise they won't work
+        await asyncio.sleep(2)
 
     depth_sensor = None
     try:
-        depth_sensor = MS5837_02BA(1)
+        depth_sensor = backend.depth_sensor()
         depth_sensor.init()
     except OSError:
         print("Unable to connect to depth sensor!")
 
     imu = None
     try:
-        imu = adafruit_bno055.BNO055_I2C(board.I2C())
+        imu = backend.imu()
     except OSError:
         print("Unable to connect IMU!")
 
     power_monitor = None
     try:
-        power_monitor = PowerMonitor()
+        power_monitor = PowerMonitor(adc=backend.adc())
+        # the power monitor scans the ADC in its own thread, the control loop only
+        # ever looks at the latest snapshot
+        power_monitor.start_scanning()
     except OSError:
         print("Unable to connect to power monitor!")
 
-    depth_anchor = False
-    # adjust the y-velocity to have the ROV remain at a constant depth
-    depth_pid = PID(proportional_gain=2, integral_gain=0.05, derivative_gain=0.01)
-
-    yaw_anchor = False
-    # adjust the yaw velocity to keep the ROV stable
-    # TODO - Need to tune the PID parameters
-    yaw_pid = RotationalPID(proportional_gain=0.03, integral_gain=0, derivative_gain=0)
-
-    roll_anchor = False
-    # adjust the roll velocity to keep the ROV stable
-    roll_pid = RotationalPID(
-        proportional_gain=-0.03, integral_gain=-0.001, derivative_gain=0.0e-4
+    # the PIDs all use the time the control tick was scheduled for
+    tick_clock = TickClock(scheduler.clock())
+    controller = Controller(
+        has_depth_sensor=depth_sensor is not None,
+        has_imu=imu is not None,
+        clock=tick_clock,
     )
-
-    pitch_anchor = False
-    # adjust the pitch velocity to keep the ROV stable
-    pitch_pid = RotationalPID(
-        proportional_gain=0.02, integral_gain=0.007, derivative_gain=0.005
-    )
-
-    # multiplier for velocity to set speed limit
-    speed_multiplier = 1
-
-    # lock the controls in a certain state, each velocity can have its own lock
-    motor_locks = {
-        "x": False,
-        "y": False,
-        "z": False,
-        "yaw": False,
-        "pitch": False,
-        "roll": False,
-    }
-
-    # whether the ROV is attempting to autonomously transplant a sample of coral
-    is_autonomous = False
-    coral_transplanter = None
-
-    locked_velocities = {
-        "x": 0,
-        "y": 0,
-        "z": 0,
-        "yaw": 0,
-        "pitch": 0,
-        "roll": 0,
-    }
-
-    # stores the last button press of the velocity toggle button
-    prev_speed_toggle = None
-    prev_depth_anchor_toggle = None
-    prev_roll_anchor_toggle = None
-    prev_pitch_anchor_toggle = None
-    prev_yaw_anchor_toggle = None
-    prev_motor_lock_toggle = None
-    prev_autonomous_toggle = None
-
-    prev_z_velocity = 0
-    prev_yaw_velocity = 0
-    prev_roll_velocity = 0
-    prev_pitch_velocity = 0
-
-    # the recorded depth of the red square for the autonomous brain coral
-    # transplantation task
-    square_depth = None
-
-    throttle_limit_factor = 0
-    set_throttle = speed_multiplier
-
-    print("Server started!")
-    while True:
-        joystick_data = WSServer.pump_joystick_data()
-        can_read_depth = True
-        if depth_sensor is not None:
-            try:
-                depth_sensor.read()
-            except OSError:
-                can_read_depth = False
-                print("Unable to read from depth sensor!")
-
-        # read sensor information
-        internal_temp = imu.temperature if imu is not None else None
-        external_temp = depth_sensor.temperature() if depth_sensor is not None else None
-        cpu_temp = None
-        depth = (
-            depth_sensor.depth()
-            if depth_sensor is not None and can_read_depth
-            else None
-        )
-        yaw = imu.euler[0] if imu is not None else None
-        roll = imu.euler[1] if imu is not None else None
-        pitch = imu.euler[2] - 90 if imu is not None else None
-        x_accel = imu.linear_acceleration[0] if imu is not None else None
-        y_accel = imu.linear_acceleration[1] if imu is not None else None
-        z_accel = imu.linear_acceleration[2] if imu is not None else None
-        voltage_5V = power_monitor.voltage_5V() if power_monitor is not None else None
-        current_5V = power_monitor.current_5V() if power_monitor is not None else None
-        voltage_12V = power_monitor.voltage_12V() if power_monitor is not None else None
-        current_12V = power_monitor.current_12V() if power_monitor is not None else None
-
-        # send data to web client
-        if WSServer.web_client_main is not None:
-            status_info = {
-                "internal_temp": internal_temp,
-                "external_temp": external_temp,
-                "depth": depth,
-                "yaw": yaw,
-                "roll": roll,
-                "pitch": pitch,
-                "x_accel": x_accel,
-                "y_accel": y_accel,
-                "z_accel": z_accel,
-                "voltage_5V": voltage_5V,
-                "current_5V": current_5V,
-                "voltage_12V": voltage_12V,
-                "current_12V": current_12V,
-                "speed_multiplier": speed_multiplier,
-                "depth_anchor_enabled": depth_anchor,
-                "yaw_anchor_enabled": yaw_anchor,
-                "roll_anchor_enabled": roll_anchor,
-                "pitch_anchor_enabled": pitch_anchor,
-                "motor_lock_enabled": motor_locks,
-                "throttle_limit_factor": throttle_limit_factor,
-            }
-            await WSServer.web_client_main.send(json.dumps(status_info))
-
-        # set all the velocities to 0 if there's no joystick connected
-        if joystick_data:
-            x_velocity = joystick_data["left_stick"][0] * speed_multiplier
-            y_velocity = joystick_data["left_stick"][1] * speed_multiplier
-            z_velocity = joystick_data["right_stick"][1] * speed_multiplier
-            yaw_velocity = joystick_data["right_stick"][0] * speed_multiplier
-            pitch_velocity = joystick_data["dpad"][1] * speed_multiplier
-            roll_velocity = joystick_data["dpad"][0] * speed_multiplier
-            speed_toggle = (
-                joystick_data["buttons"]["right_bumper"]
-                - joystick_data["buttons"]["left_bumper"]
+    readings = Readings()
+    # smooths the depth and works out the vertical velocity at the control rate
+    depth_filter = DepthFilter()
+    # how long it takes for joystick input to make it to the thrusters
+    latency = LatencyTracker()
+    # the arrival time of the last joystick message that was traced
+    last_traced_time = None
+    # records every control tick to disk
+    flight_recorder = FlightRecorder(recordings_dir)
+
+    def read_depth(now):
+        try:
+            # the conversions are timed by the clock itself rather than now, which is
+            # when the task was due. a task that was started late would otherwise make
+            # the next conversion look longer than it's really been and the ADC would
+            # be read before it's done. the simulator's clock is simulated time
+            updated = depth_sensor.update(
+                DEPTH_OVERSAMPLING, TEMPERATURE_OVERSAMPLING, scheduler.clock()
             )
-            depth_anchor_toggle = joystick_data["buttons"]["north"]
-            roll_anchor_toggle = joystick_data["buttons"]["east"]
-            pitch_anchor_toggle = joystick_data["buttons"]["south"]
-            yaw_anchor_toggle = joystick_data["buttons"]["west"]
-            motor_lock_toggle = joystick_data["buttons"]["start"]
-            autonomous_toggle = joystick_data["buttons"]["select"]
-            photo_trigger = joystick_data["buttons"]["left_trigger"]
-            record_depth_trigger = joystick_data["buttons"]["right_trigger"]
-        else:
-            x_velocity = 0
-            y_velocity = 0
-            z_velocity = 0
-            yaw_velocity = 0
-            pitch_velocity = 0
-            roll_velocity = 0
-            speed_toggle = 0
-            yaw_anchor_toggle = 0
-            roll_anchor_toggle = 0
-            depth_anchor_toggle = 0
-            pitch_anchor_toggle = 0
-            motor_lock_toggle = 0
-            autonomous_toggle = 0
-            photo_trigger = 0
-            record_depth_trigger = 0
-
-        # when the controller speed increases beyond 50% of the speed multiplier,
-        # temporarily turn off any stabilization
-        destable_thresh = speed_multiplier / 2
-
-        # adjust speed mutliplier based on current draw
-        if (current_12V > MAX_CURRENT):
-            previous_speed_multiplier = speed_multiplier
-            throttle_limit_factor += 0.1
+        except OSError:
+            readings.measured_depth = None
+            depth_filter.reset()
+            print("Unable to read from depth sensor!")
+            return
+        if not updated:
+            return
+        readings.external_temp = depth_sensor.temperature()
+        readings.measured_depth = depth_sensor.depth()
+        depth_filter.update(now, readings.measured_depth)
+
+    def control(now):
+        # when the tick started on the same clock as now, for the jitter, and in real
+        # time, for how long it takes
+        start_time = scheduler.clock()
+        real_start_time = monotonic()
+        tick_clock.now = now
+        # the IMU's vertical acceleration, for the depth filter
+        acceleration = None
+        if imu is not None:
+            # everything comes from one burst read so all the values are coherent
+            snapshot = imu.read()
+            readings.internal_temp = snapshot.temperature
+            # the mounting of the IMU is corrected for on the quaternion, its euler
+            # angles aren't used
+            readings.update_attitude(snapshot.attitude)
+            readings.x_accel, readings.y_accel, readings.z_accel = (
+                snapshot.linear_acceleration
+            )
+            if readings.attitude is not None:
+                acceleration = vertical_acceleration(
+                    readings.attitude, snapshot.linear_acceleration
+                )
+
+        depth_filter.predict(now, acceleration)
+        readings.depth = depth_filter.depth
+        readings.depth_rate = depth_filter.velocity
+
+        power = power_monitor.snapshot if power_monitor is not None else None
+        if power is not None:
+            readings.voltage_5V = power.voltage_5V
+            readings.current_5V = power.current_5V
+            readings.voltage_12V = power.voltage_12V
+            readings.current_12V = power.current_12V
+
+        nonlocal last_traced_time
+        consumed_time = monotonic()
+        received_time = WSServer.joystick_message_time
+        received_wall_time = WSServer.joystick_message_wall_time
+        joystick_age = WSServer.joystick_age()
+        if joystick_age is not None and joystick_age < JOYSTICK_TIMEOUT:
+            joystick_data = WSServer.pump_joystick_data()
         else:
-            throttle_limit_factor = 0
-            speed_multiplier = set_throttle
-	     
-        # apply factor
-        speed_multiplier -= throttle_limit_factor
-
-        # re-enable the depth anchor at a new depth when the z velocity falls below the
-        # threshold
-        if (
-            depth_anchor
-            and abs(z_velocity) < destable_thresh
-            and abs(prev_z_velocity) > destable_thresh
-        ):
-            depth_pid.update_set_point(depth)
-
-        # re-enable the yaw anchor at a new angle when the yaw velocity falls below the
-        # threshold
-        if (
-            yaw_anchor
-            and abs(yaw_velocity) < destable_thresh
-            and abs(prev_yaw_velocity) > destable_thresh
-        ):
-            yaw_pid.update_set_point(yaw)
-
-        # re-enable the roll anchor at a new angle when the roll velocity falls below the
-        # threshold
-        if (
-            roll_anchor
-            and abs(roll_velocity) < destable_thresh
-            and abs(prev_roll_velocity) > destable_thresh
-        ):
-            roll_pid.update_set_point(roll)
-
-        # re-enable the pitch anchor at a new angle when the pitch velocity falls below the
-        # threshold
-        if (
-            pitch_anchor
-            and abs(pitch_velocity) < destable_thresh
-            and abs(prev_pitch_velocity) > destable_thresh
-        ):
-            pitch_pid.update_set_point(pitch)
-
-        prev_z_velocity = z_velocity
-        prev_yaw_velocity = yaw_velocity
-        prev_roll_velocity = roll_velocity
-        prev_pitch_velocity = pitch_velocity
-
-        # set the z velocity according to the depth PID controller based on
-        # current depth, the depth anchor should be temporarily disabled
-        # when the z velocity is greater than a certain threshold in order to
-        # give the pilot control over the depth when the depth anchor is on
-        if depth_anchor and depth is not None and abs(z_velocity) < destable_thresh:
-            z_velocity = -depth_pid.compute(depth)
-
-        # set the yaw velocity according to the yaw PID controller based on
-        # current yaw angle
-        if yaw_anchor and yaw is not None and abs(yaw_velocity) < destable_thresh:
-            yaw_velocity = yaw_pid.compute(yaw)
-
-        # set the roll velocity according to the roll PID controller based on
-        # current roll angle
-        if roll_anchor and roll is not None and abs(roll_velocity) < destable_thresh:
-            roll_velocity = roll_pid.compute(roll)
-
-        # set the pitch velocity according to the pitch PID controller based on
-        # current pitch angle
-        if pitch_anchor and pitch is not None and abs(pitch_velocity) < destable_thresh:
-            pitch_velocity = pitch_pid.compute(pitch)
-
-        if motor_locks["x"]:
-            print("x")
-            x_velocity = locked_velocities["x"]
-        if motor_locks["y"]:
-            print("y")
-            y_velocity = locked_velocities["y"]
-        if motor_locks["z"]:
-            print("z")
-            z_velocity = locked_velocities["z"]
-        if motor_locks["yaw"]:
-            yaw_velocity = locked_velocities["yaw"]
-        if motor_locks["pitch"]:
-            pitch_velocity = locked_velocities["pitch"]
-        if motor_locks["roll"]:
-            roll_velocity = locked_velocities["roll"]
-
-        # autonomous code should take precedence
-        if is_autonomous:
-            (
-                x_velocity,
-                y_velocity,
-                z_velocity,
-                yaw_velocity,
-                roll_velocity,
-                pitch_velocity,
-                return_code,
-            ) = coral_transplanter.next_step(depth, yaw, roll, pitch)
-            if return_code == CoralReturn.FINISHED:
-                is_autonomous = False
-                ImageHandler.stop_listening()
-                # stabilize after finishing
-                depth_anchor = True
-                pitch_anchor = True
-                depth_pid.update_set_point(depth)
-                pitch_pid.update_set_point(pitch)
-                print("Autonomous task completed!")
-
-            elif return_code == CoralReturn.FAILED:
-                is_autonomous = False
-                ImageHandler.stop_listening()
-                print("Autonomous task failed! ;-;")
-
-        if photo_trigger:
-            try:
-                ImageHandler.start_listening()
-                img, _ = ImageHandler.pump_image()
-                if img is not None:
-                    filename = f"test_images/{time()}.jpg"
-                    cv2.imwrite(filename, img)
-                    print(f"Saved image to {filename}")
-                else:
-                    print("Unable to save image!")
-            except Exception as e:
-                print(f"Photo trigger error: {e}") # Add handling specificities .. . .
-
-        # before beginning the autonomous coral transplantation task, the ROV should
-        # move over to the square and record the depth of the square
-        if record_depth_trigger:
-            square_depth = depth
+            joystick_data = None
+        velocities = controller.step(joystick_data, readings)
+        # the mixer is part of working out what to do, only the PWM write is timed as
+        # the motors' stage
+        motors.mix(*velocities)
+        computed_time = monotonic()
 
         # run the motors!
-        motors.drive_motors(
-            x_velocity,
-            y_velocity,
-            z_velocity,
-            yaw_velocity,
-            pitch_velocity,
-            roll_velocity,
-        )
-
-        # increase or decrease speed when the dpad buttons are pressed
-        if speed_toggle != prev_speed_toggle:
-            # make sure the speed doesn't exceed 1
-            if speed_toggle > 0 and speed_multiplier < 1:
-                #speed_multiplier += 0.2
-                set_throttle += 0.1
-            # make sure the speed doesn't fall below 0
-            if speed_toggle < 0 and speed_multiplier >= 0.2:
-                #speed_multiplier -= 0.2
-                set_throttle -= 0.1
-            # just in case the speed multiplier ends up out of range
-            if speed_multiplier > 1:
-                speed_multiplier = 1
-            elif speed_multiplier < 0:
-                speed_multiplier = 0
-            print(f"Speed Multiplier: {speed_multiplier}")
-            prev_speed_toggle = speed_toggle
-
-        # toggle the depth anchor
-        if (
-            depth_sensor is not None
-            and depth_anchor_toggle
-            and not prev_depth_anchor_toggle
-        ):
-            if depth_anchor:
-                print("Vertical anchor disabled!")
-                depth_anchor = False
-            elif depth_sensor is not None:
-                depth_anchor = True
-                depth_pid.update_set_point(depth_sensor.depth())
-                print(f"Vertical anchor enabled at: {depth_pid.set_point} m")
-
-        # toggle the yaw anchor
-        if imu is not None and yaw_anchor_toggle and not prev_yaw_anchor_toggle:
-            if yaw_anchor:
-                print("Yaw anchor disabled!")
-                yaw_anchor = False
-            elif depth_sensor is not None:
-                yaw_anchor = True
-                yaw_pid.update_set_point(yaw)
-                print(f"Yaw anchor enabled at: {yaw_pid.set_point}°")
-
-        # toggle the roll anchor
-        if imu is not None and roll_anchor_toggle and not prev_roll_anchor_toggle:
-            if roll_anchor:
-                print("Roll anchor disabled!")
-                roll_anchor = False
-            elif depth_sensor is not None:
-                roll_anchor = True
-                roll_pid.update_set_point(roll)
-                print(f"Roll anchor enabled at: {roll_pid.set_point}°")
-
-        # toggle the pitch anchor
-        if imu is not None and pitch_anchor_toggle and not prev_pitch_anchor_toggle:
-            if pitch_anchor:
-                print("Pitch anchor disabled!")
-                pitch_anchor = False
-            elif depth_sensor is not None:
-                pitch_anchor = True
-                pitch_pid.update_set_point(pitch)
-                print(f"Pitch anchor enabled at: {pitch_pid.set_point}°")
-
-        # toggle the motor lock
-        if motor_lock_toggle and not prev_motor_lock_toggle:
-            if any(motor_locks.values()):
-                motor_locks = {
-                    "x": False,
-                    "y": False,
-                    "z": False,
-                    "yaw": False,
-                    "pitch": False,
-                    "roll": False,
-                }
-                print("Motor lock disabled!")
-            else:
-                motor_locks = {
-                    "x": True,
-                    "y": True,
-                    "z": True,
-                    "yaw": True,
-                    "pitch": True,
-                    "roll": True,
-                }
-                locked_velocities["x"] = x_velocity
-                locked_velocities["y"] = y_velocity
-                locked_velocities["z"] = z_velocity
-                locked_velocities["yaw"] = yaw_velocity
-                locked_velocities["pitch"] = pitch_velocity
-                locked_velocities["roll"] = roll_velocity
-                print("Motor lock enabled!")
+        motors.write_motors()
+        written_time = monotonic()
+
+        # only trace each joystick message once, the first tick that acts on it
+        if joystick_data is not None and received_time != last_traced_time:
+            last_traced_time = received_time
+            latency.trace(
+                received_time,
+                consumed_time,
+                computed_time,
+                written_time,
+                joystick_data.get("sent_time"),
+                received_wall_time,
+            )
 
-        # toggle the autonomous control
-        if autonomous_toggle and not prev_autonomous_toggle:
-            if is_autonomous:
-                ImageHandler.stop_listening()
-                is_autonomous = False
-                print("Autonomous mode disabled!")
-            else:
-                ImageHandler.start_listening()
-                is_autonomous = True
-                if square_depth is not None:
-                    coral_transplanter = CoralTransplanter(square_depth, yaw)
-                else:
-                    coral_transplanter = CoralTransplanter(depth - SQUARE_HEIGHT, yaw)
-                print("Autonomous mode enabled!")
+        flight_recorder.record_tick(
+            now,
+            start_time,
+            monotonic() - real_start_time,
+            readings,
+            joystick_data,
+            controller,
+            velocities,
+            motors.motor_velocities,
+        )
 
-        prev_depth_anchor_toggle = depth_anchor_toggle
-        prev_yaw_anchor_toggle = yaw_anchor_toggle
-        prev_roll_anchor_toggle = roll_anchor_toggle
-        prev_pitch_anchor_toggle = pitch_anchor_toggle
-        prev_motor_lock_toggle = motor_lock_toggle
-        prev_autonomous_toggle = autonomous_toggle
+    def publish_telemetry(now):
+        # the web clients are sent the data by their own tasks, so a slow client
+        # can't delay the control loop
+        if WSServer.subscribers:
+            status_info = controller.status_info(readings)
+            total_latency = latency.percentiles("total")
+            if total_latency is not None:
+                status_info["input_latency_p50"] = total_latency["p50"]
+                status_info["input_latency_p99"] = total_latency["p99"]
+            WSServer.publish(status_info, now)
+
+    scheduler.add_task("control", CONTROL_RATE, control)
+    if depth_sensor is not None:
+        scheduler.add_task("depth", DEPTH_RATE, read_depth)
+    scheduler.add_task("telemetry", TELEMETRY_RATE, publish_telemetry)
+    WSServer.stats_providers["scheduler"] = scheduler.stats
+    WSServer.stats_providers["subscribers"] = WSServer.subscriber_stats
+    WSServer.stats_providers["latency"] = latency.stats
 
-        await asyncio.sleep(0.01)
+    print("Server started!")
+    await scheduler.run()
 
 
 def main():
+    parser = argparse.ArgumentParser(description="Run the ROV")
+    parser.add_argument(
+        "--backend",
+        choices=BACKENDS,
+        default="real",
+        help="use the real hardware, fake devices or play back an I2C trace",
+    )
+    parser.add_argument(
+        "--trace",
+        default=None,
+        help="where to record an I2C trace of the real hardware to, or the trace to "
+        "play back",
+    )
+    parser.add_argument(
+        "--recordings",
+        default=RECORDINGS_DIR,
+        help="where the flight recorder keeps its sessions",
+    )
+    args = parser.parse_args()
+    backend = open_backend(args.backend, args.trace)
+
     loop = asyncio.get_event_loop()
     #  auto_ws_server = websockets.serve(
     #      autonomous.WSServer.handler, "0.0.0.0", 3009, ping_interval=None
@@ -483,16 +236,17 @@ def main():
     asyncio.ensure_future(ws_server)
     #  asyncio.ensure_future(auto_ws_server)
     #  asyncio.ensure_future(ImageHandler.image_handler("ws://192.168.1.9:3000"))
-    threading.Thread(target=ImageHandler.image_processer, daemon=True).start()
-    threading.Thread(
-        target=ImageHandler.image_receiver, args=("ws://192.168.1.9:3000",), daemon=True
-    ).start()
+    # the vision process has to be started before any other threads are
+    ImageHandler.start_process("ws://192.168.1.9:3000")
 
     #  threading.Thread(
     #      target=ImageHandler.image_handler, args=("ws://192.168.1.9:3000",), daemon=True
     #  ).start()
-    asyncio.ensure_future(main_server())
-    loop.run_forever()
+    asyncio.ensure_future(main_server(backend, recordings_dir=args.recordings))
+    try:
+        loop.run_forever()
+    finally:
+        backend.close()
 
 
 if __name__ == "__main__":
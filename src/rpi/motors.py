@@ -1,102 +1,388 @@
-from adafruit_servokit import ServoKit
+try:
+    from adafruit_pca9685 import PCA9685
+    import board
+except ImportError:
+    # the mixing math in MotorMixer still works without the PWM driver (e.g. when
+    # replaying a recording on a laptop)
+    print("Try pip install adafruit-circuitpython-pca9685")
+from abc import ABC, abstractmethod
 import math
+import numpy as np
 from orientation import cartesian_to_spherical
+import os
 import time
 
 
-class Motors:
+# how much each motor is driven by each of the ROV's velocities. the columns are in the
+# same order as MotorMixer.mix's arguments: x (right), y (forward), z (up), yaw (turn
+# right), pitch (nose up) and roll (right side down)
+ALLOCATION_MATRIX = np.array(
+    [
+        [-1, -1, 0, -1, 0, 0],
+        [1, -1, 0, 1, 0, 0],
+        [-1, 1, 0, 1, 0, 0],
+        [1, 1, 0, -1, 0, 0],
+        [0, 0, -1, 0, 1, -1],
+        [0, 0, -1, 0, 1, 1],
+        [0, 0, -1, 0, -1, -1],
+        [0, 0, -1, 0, -1, 1],
+    ],
+    dtype=float,
+)
+SPEED_LIMIT = 0.7
+
+
+# scales motor velocities down so that none of them go over the speed limit. the whole
+# vector is scaled rather than clipping each motor, so the ROV still moves in the
+# direction it was told to, just slower. works on a single set of 8 velocities or on
+# an (N, 8) array of them, in place
+def desaturate(motor_velocities: np.ndarray, speed_limit=SPEED_LIMIT) -> np.ndarray:
+    if motor_velocities.ndim == 1:
+        # the common case of a single tick, which is a lot cheaper without keepdims
+        peak = np.abs(motor_velocities).max()
+        if peak > speed_limit:
+            motor_velocities *= speed_limit / peak
+        return motor_velocities
+    peak = np.max(np.abs(motor_velocities), axis=-1, keepdims=True)
+    motor_velocities *= speed_limit / np.maximum(peak, speed_limit)
+    return motor_velocities
+
+
+# turns an (N, 6) array of ROV velocities (in the same order as the columns of
+# ALLOCATION_MATRIX) into an (N, 8) array of motor velocities, for running lots of
+# ticks at once in the simulator or benchmarks
+def allocate(velocities: np.ndarray, speed_limit=SPEED_LIMIT) -> np.ndarray:
+    motor_velocities = np.asarray(velocities, dtype=float) @ ALLOCATION_MATRIX.T
+    return desaturate(motor_velocities, speed_limit)
+
+
+# turns the velocities of the ROV into the velocities of each motor, without driving
+# any actual motors
+class MotorMixer:
     def __init__(self):
-        # After calibrating with the oscilloscope, the correct reference clock
-        # speed for the particular PCA9685 should be 24.725 MHz, rather than the
-        # standard 25 MHz. If the motors don't work for some reason, check the
-        # reference clock. Magic number for V2: 24_725_000 Magic number for V3: 25_445_990
-        self.kit = ServoKit(channels=16, reference_clock_speed=25_445_990)
         self.num_motors = 8
-        # a table that maps the motor number to the correct channel on the PWM
-        # controller
-        self.motor_channel_table = {
-            0: 9,
-            1: 11,
-            2: 13,
-            3: 10,
-            4: 8,
-            5: 15,
-            6: 12,
-            7: 14,
-        }
-        self.motor_velocities = [0, 0, 0, 0, 0, 0, 0, 0]
-        self.speed_limit = 0.7
-        # set the correct pulse range (1100 microseconds to 1900 microseconds)
-        for motor_num in range(self.num_motors):
-            self.kit.servo[self.motor_channel_table[motor_num]].set_pulse_width_range(
-                1100, 1900
-            )
+        self.motor_velocities = np.zeros(self.num_motors)
+        self.speed_limit = SPEED_LIMIT
+        # reused every tick so mix() doesn't allocate anything
+        self.velocities = np.zeros(ALLOCATION_MATRIX.shape[1])
+
+    # computes the motor velocities, stored in self.motor_velocities
+    def mix(
+        self,
+        x_velocity=0,
+        y_velocity=0,
+        z_velocity=0,
+        yaw_velocity=0,
+        pitch_velocity=0,
+        roll_velocity=0,
+    ) -> np.ndarray:
+        self.velocities[:] = (
+            x_velocity,
+            y_velocity,
+            z_velocity,
+            yaw_velocity,
+            pitch_velocity,
+            roll_velocity,
+        )
+        ALLOCATION_MATRIX.dot(self.velocities, out=self.motor_velocities)
+
+        self.limit_speed()
+        return self.motor_velocities
+
+    # make sure the motors don't exceed the speed limit
+    def limit_speed(self):
+        desaturate(self.motor_velocities, self.speed_limit)
+
+
+# After calibrating with the oscilloscope, the correct reference clock
+# speed for the particular PCA9685 should be 24.725 MHz, rather than the
+# standard 25 MHz. If the motors don't work for some reason, check the
+# reference clock. Magic number for V2: 24_725_000 Magic number for V3: 25_445_990
+REFERENCE_CLOCK_SPEED = 25_445_990
+PWM_FREQUENCY = 50  # Hz
+PCA9685_ADDRESS = 0x40
+# the first of the 4 registers (ON_L, ON_H, OFF_L, OFF_H) of each channel, the rest of
+# the channels follow straight after
+LED0_ON_L = 0x06
+REGISTERS_PER_CHANNEL = 4
+# setting this bit in OFF_H turns a channel fully off, which is how they start up
+FULL_OFF = 0x10
+# the ESCs go from full reverse at 1100 µs to full forward at 1900 µs
+MIN_PULSE = 1100
+MAX_PULSE = 1900
+NEUTRAL_PULSE = (MIN_PULSE + MAX_PULSE) / 2
+PULSE_RANGE = (MAX_PULSE - MIN_PULSE) / 2
+
+
+# the PWM frequency that the adafruit PCA9685 library thinks it set. it rounds the
+# prescaler differently when setting it and reading it back, but the reference clocks
+# above were calibrated against its pulse maths, so the same frequency is used here
+def pca9685_frequency(
+    reference_clock_speed=REFERENCE_CLOCK_SPEED, frequency=PWM_FREQUENCY
+) -> float:
+    prescale = int(reference_clock_speed / 4096 / frequency + 0.5)
+    return reference_clock_speed / 4096 / prescale
+
+
+# works out the 12 bit counts of a PCA9685's channels from their pulse widths and
+# writes every channel that changed in a single auto-increment burst. the actual I2C
+# write is left to write_registers, so hal.py can fake it
+class PCA9685Outputs(ABC):
+    def __init__(self, frequency: float, num_channels=16):
+        self.frequency = frequency
+        # the OFF count last written to each channel, -1 if it never was
+        self.counts = np.full(num_channels, -1)
+        self.bursts = 0
+
+    # writes data to the registers starting at register, in one I2C transaction
+    @abstractmethod
+    def write_registers(self, register: int, data: bytes):
+        pass
+
+    def to_counts(self, pulse_widths: np.ndarray) -> np.ndarray:
+        counts = np.rint(np.asarray(pulse_widths) * (self.frequency * 4096 / 1e6))
+        return np.clip(counts, 0, 4095).astype(int)
+
+    # sets the pulse width (µs) of each of the channels, returns the register and data
+    # that were written or None if nothing changed
+    def set_pulse_widths(self, channels: np.ndarray, pulse_widths: np.ndarray):
+        counts = self.to_counts(pulse_widths)
+        changed = channels[counts != self.counts[channels]]
+        if len(changed) == 0:
+            return None
+        # only remembered once they've actually been written, if the write fails the
+        # same counts have to be tried again rather than skipped as unchanged
+        new_counts = self.counts.copy()
+        new_counts[channels] = counts
+
+        # one burst from the first to the last channel that changed, the channels in
+        # between are just rewritten with what they already were
+        first = changed.min()
+        span = new_counts[first : changed.max() + 1]
+        data = np.zeros((len(span), REGISTERS_PER_CHANNEL), dtype=np.uint8)
+        data[:, 2] = span & 0xFF
+        data[:, 3] = np.where(span < 0, FULL_OFF, span >> 8)
+        register = LED0_ON_L + first * REGISTERS_PER_CHANNEL
+        data = data.tobytes()
+        self.write_registers(register, data)
+        self.counts = new_counts
+        self.bursts += 1
+        return register, data
+
+    # the pulse width (µs) a channel is outputting, None if it was never set
+    def pulse_width(self, channel: int):
+        if self.counts[channel] < 0:
+            return None
+        return self.counts[channel] / 4096 / self.frequency * 1e6
+
+
+# the PCA9685 PWM controller the motors are connected to. hal.py has a fake and a
+# trace playback PWM controller with the same interface
+class PCA9685PWM(PCA9685Outputs):
+    def __init__(self, reference_clock_speed=REFERENCE_CLOCK_SPEED, i2c=None):
+        super().__init__(pca9685_frequency(reference_clock_speed))
+        self.pca = PCA9685(
+            i2c if i2c is not None else board.I2C(),
+            address=PCA9685_ADDRESS,
+            reference_clock_speed=reference_clock_speed,
+        )
+        # this also turns on register auto-increment, which the bursts rely on
+        self.pca.frequency = PWM_FREQUENCY
+
+    def write_registers(self, register: int, data: bytes):
+        with self.pca.i2c_device as i2c:
+            i2c.write(bytes((register,)) + data)
+
+
+# maps the motor number to the correct channel on the PWM controller
+MOTOR_CHANNEL_TABLE = {
+    0: 9,
+    1: 11,
+    2: 13,
+    3: 10,
+    4: 8,
+    5: 15,
+    6: 12,
+    7: 14,
+}
+
+
+SLOPE = math.sqrt(3)
+TAU = 2 * math.pi
+HALF_PI = math.pi / 2
+
+
+# the fastest the ROV can move in the direction (θ, ϕ) of a spherical vector, as
+# (x, y, z). MaxSpeedEnvelope tabulates this for working out lots of directions at once
+def find_max_speed(z_rotate, x_rotate) -> (float, float, float):
+    # everything stays in radians, converting back and forth to degrees just to
+    # compare the angles was most of the cost
+    z_rotate %= TAU
+    x_rotate = (x_rotate + HALF_PI) % TAU
+    tan_z = math.tan(z_rotate)
+
+    # find max x and y speed on horizontal plane
+    if z_rotate < HALF_PI:
+        x_coord = (SLOPE * 2) / (tan_z + SLOPE)
+        y_coord = -SLOPE * (x_coord) + (SLOPE * 2)
+
+    elif z_rotate < math.pi:
+        x_coord = (SLOPE * 2) / (tan_z - SLOPE)
+        y_coord = SLOPE * (x_coord) + (SLOPE * 2)
+
+    elif z_rotate < 3 * HALF_PI:
+        x_coord = -(SLOPE * 2) / (tan_z + SLOPE)
+        y_coord = -SLOPE * (x_coord) - (SLOPE * 2)
+
+    else:
+        x_coord = -(SLOPE * 2) / (tan_z - SLOPE)
+        y_coord = SLOPE * (x_coord) - (SLOPE * 2)
+
+    xy_dist = math.hypot(x_coord, y_coord)
+
+    # max angle before hitting ceiling
+    max_x_rotate = math.atan(4 / xy_dist)
+    tan_x = math.tan(x_rotate)
+
+    # check if x_rotate hits ceiling
+    if (
+        x_rotate < max_x_rotate
+        or math.pi - max_x_rotate < x_rotate < math.pi + max_x_rotate
+        or x_rotate > 3 * HALF_PI + max_x_rotate
+    ):
+        # if it doesn't, find z_coord according to x_rotate and xy_dist, so the vector
+        # still points in the direction that was asked for
+        z_coord = -xy_dist * tan_x
+
+    else:
+        # check for if we are going relatively down or up
+        if x_rotate > math.pi:
+            z_coord = -4
+        else:
+            z_coord = 4
+
+        # scale x and y coords accordingly, without flipping them around
+        scale = 4 / abs(tan_x) / xy_dist
+        x_coord *= scale
+        y_coord *= scale
+
+    return (x_coord, y_coord, z_coord)
+
+
+# 2 cos(π/3) and 2 sin(π/3)
+A_SCALAR_DIVISOR = 1.0
+B_SCALAR_DIVISOR = math.sqrt(3)
+
+
+def find_motor_scalars(x_coord, y_coord, z_coord) -> (float, float, float):
+    z_scalar = z_coord
+    a_scalar = -x_coord / A_SCALAR_DIVISOR + y_coord / B_SCALAR_DIVISOR
+    b_scalar = -x_coord / A_SCALAR_DIVISOR - y_coord / B_SCALAR_DIVISOR
+    return (a_scalar, -b_scalar, z_scalar)
+
+
+# the resolution of the max speed table, in cells over 360° of θ and 180° of ϕ
+ENVELOPE_THETA_STEPS = 360
+ENVELOPE_PHI_STEPS = 180
+# bump this whenever find_max_speed changes so old cached tables aren't used
+ENVELOPE_VERSION = 1
+ENVELOPE_CACHE = os.path.expanduser("~/.cache/jona-rov/max_speed_envelope.npz")
+
+
+# find_max_speed over a grid of (θ, ϕ), worked out once and cached to disk. looking up
+# a direction interpolates between the 4 nearest grid points
+class MaxSpeedEnvelope:
+    def __init__(
+        self,
+        theta_steps=ENVELOPE_THETA_STEPS,
+        phi_steps=ENVELOPE_PHI_STEPS,
+        cache_path=ENVELOPE_CACHE,
+    ):
+        self.theta_steps = theta_steps
+        self.phi_steps = phi_steps
+        self.theta_step = TAU / theta_steps
+        self.phi_step = math.pi / phi_steps
+
+        self.table = self.load(cache_path)
+        if self.table is None:
+            self.table = self.tabulate()
+            self.save(cache_path)
+
+    # (theta_steps + 1, phi_steps + 1, 3), the last θ row is the same as the first
+    def tabulate(self) -> np.ndarray:
+        table = np.empty((self.theta_steps + 1, self.phi_steps + 1, 3))
+        for i in range(self.theta_steps + 1):
+            for j in range(self.phi_steps + 1):
+                table[i, j] = find_max_speed(i * self.theta_step, j * self.phi_step)
+        return table
+
+    def load(self, path: str):
+        try:
+            with np.load(path) as cache:
+                version = int(cache["version"])
+                table = cache["table"]
+        except (OSError, KeyError, ValueError):
+            return None
+        shape = (self.theta_steps + 1, self.phi_steps + 1, 3)
+        if version != ENVELOPE_VERSION or table.shape != shape:
+            return None
+        return table
+
+    def save(self, path: str):
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            np.savez(path, version=ENVELOPE_VERSION, table=self.table)
+        except OSError as e:
+            # it can always be worked out again next time
+            print(f"Couldn't cache the max speed envelope: {e}")
+
+    # find_max_speed for arrays of directions at once, to within the table's
+    # resolution, e.g. for path planning. returns an (N, 3) array. a single direction
+    # is quicker to work out exactly than to look up
+    def lookup(self, thetas: np.ndarray, phis: np.ndarray) -> np.ndarray:
+        t = np.mod(thetas, TAU) / self.theta_step
+        p = np.clip(phis, 0, math.pi) / self.phi_step
+        i = np.minimum(t.astype(int), self.theta_steps - 1)
+        j = np.minimum(p.astype(int), self.phi_steps - 1)
+        t = (t - i)[:, None]
+        p = (p - j)[:, None]
+        table = self.table
+        return (table[i, j] * (1 - p) + table[i, j + 1] * p) * (1 - t) + (
+            table[i + 1, j] * (1 - p) + table[i + 1, j + 1] * p
+        ) * t
+
+
+class Motors(MotorMixer):
+    def __init__(self, pwm=None):
+        super().__init__()
+        self.pwm = pwm if pwm is not None else PCA9685PWM()
+        self.motor_channel_table = MOTOR_CHANNEL_TABLE
+        # the PWM channel of each motor, in motor order
+        self.channels = np.array(
+            [self.motor_channel_table[motor] for motor in range(self.num_motors)]
+        )
         self.stop_all()
 
+    # maps velocities from -1..1 where -1 is full throttle reverse and 1 is full
+    # throttle forward to pulse widths from MIN_PULSE to MAX_PULSE
+    def to_pulse_widths(self, velocities: np.ndarray) -> np.ndarray:
+        return np.clip(NEUTRAL_PULSE + velocities * PULSE_RANGE, MIN_PULSE, MAX_PULSE)
+
     def drive_motor(self, motor_num: int, velocity: float):
-        # maps the velocity from -1..1 where -1 is full throttle reverse and
-        # 1 is full throttle forward to an angle where 0 degrees is full
-        # throttle reverse and 180 degrees is full throttle forward
-        angle = int(velocity * 90) + 90
-        self.kit.servo[self.motor_channel_table[motor_num]].angle = angle
-
-    # move the ROV left or right
-    def calc_yaw_velocity(self, velocity: float):
-        # positive velocity - ROV moves right
-        # negative velocity - ROV moves left
-        self.motor_velocities[0] -= velocity
-        self.motor_velocities[1] += velocity
-        self.motor_velocities[2] += velocity
-        self.motor_velocities[3] -= velocity
-
-    # move the ROV forward or backward
-    def calc_y_velocity(self, velocity: float):
-        # positive velocity - ROV moves forward
-        # negative velocity - ROV moves backward
-        self.motor_velocities[0] -= velocity
-        self.motor_velocities[1] -= velocity
-        self.motor_velocities[2] += velocity
-        self.motor_velocities[3] += velocity
-
-    # move the ROV up or down
-    def calc_z_velocity(self, velocity: float):
-        # positive velocity - ROV moves up
-        # negative velocity - ROV moves down
-        self.motor_velocities[4] -= velocity
-        self.motor_velocities[5] -= velocity
-        self.motor_velocities[6] -= velocity
-        self.motor_velocities[7] -= velocity
-
-    # turn the ROV left or right
-    def calc_x_velocity(self, velocity: float):
-        # positive velocity - ROV turns right
-        # negative velocity - ROV turns left
-        self.motor_velocities[0] -= velocity
-        self.motor_velocities[1] += velocity
-        self.motor_velocities[2] -= velocity
-        self.motor_velocities[3] += velocity
-
-    # make the ROV pitch upward or downward
-    def calc_pitch_velocity(self, velocity: float):
-        # positive velocity - ROV pitches up
-        # negative velocity - ROV pitches down
-        self.motor_velocities[4] += velocity
-        self.motor_velocities[5] += velocity
-        self.motor_velocities[6] -= velocity
-        self.motor_velocities[7] -= velocity
-
-    # make the ROV do a barrel roll
-    def calc_roll_velocity(self, velocity: float):
-        # positive velocity - ROV rolls to the right, maybe
-        # negative velocity - ROV rolls to the left, maybe
-        self.motor_velocities[4] -= velocity
-        self.motor_velocities[5] += velocity
-        self.motor_velocities[6] -= velocity
-        self.motor_velocities[7] += velocity
+        self.pwm.set_pulse_widths(
+            self.channels[motor_num : motor_num + 1],
+            self.to_pulse_widths(np.array([velocity])),
+        )
+
+    # sends all of self.motor_velocities to the motors at once
+    def write_motors(self):
+        self.pwm.set_pulse_widths(
+            self.channels, self.to_pulse_widths(self.motor_velocities)
+        )
 
     def stop_all(self):
-        for motor_num in range(len(self.motor_velocities)):
-            self.drive_motor(motor_num, 0)
+        self.motor_velocities[:] = 0
+        self.write_motors()
 
     def drive_motors(
         self,
@@ -107,25 +393,16 @@ class Motors:
         pitch_velocity=0,
         roll_velocity=0,
     ):
-        # reset all the velocities to 0
-        for i in range(len(self.motor_velocities)):
-            self.motor_velocities[i] = 0
-
-        self.calc_x_velocity(x_velocity)
-        self.calc_y_velocity(y_velocity)
-        self.calc_z_velocity(z_velocity)
-        self.calc_yaw_velocity(yaw_velocity)
-        self.calc_pitch_velocity(pitch_velocity)
-        self.calc_roll_velocity(roll_velocity)
-
-        for motor_num in range(len(self.motor_velocities)):
-            if self.motor_velocities[motor_num] > self.speed_limit:
-                self.motor_velocities[motor_num] = self.speed_limit
-            elif self.motor_velocities[motor_num] < -self.speed_limit:
-                self.motor_velocities[motor_num] = -self.speed_limit
-
-        for motor_num, velocity in enumerate(self.motor_velocities):
-            self.drive_motor(motor_num, velocity)
+        self.mix(
+            x_velocity,
+            y_velocity,
+            z_velocity,
+            yaw_velocity,
+            pitch_velocity,
+            roll_velocity,
+        )
+
+        self.write_motors()
 
     def test_motors(self):
         try:
@@ -138,74 +415,10 @@ class Motors:
             self.stop_all()
 
     def find_max_speed(self, z_rotate, x_rotate) -> (float, float, float):
-        SLOPE = math.sqrt(3)
-        x_coord = 0
-        y_coord = 0
-        z_coord = 0
-
-        #  z_rotate = math.radians(z_rotate % 360)
-        #  x_rotate = math.radians((x_rotate + 90) % 360)
-        z_rotate = math.radians(math.degrees(z_rotate) % 360)
-        x_rotate = math.radians((math.degrees(x_rotate) + 90) % 360)
-        print(f"x_rotate: {math.degrees(x_rotate)}")
-
-        # find max x and y speed on horizontal plane
-        if math.degrees(z_rotate) < 90:
-            x_coord = (SLOPE * 2) / (math.tan(z_rotate) + SLOPE)
-            y_coord = -SLOPE * (x_coord) + (SLOPE * 2)
-
-        elif math.degrees(z_rotate) < 180:
-            x_coord = (SLOPE * 2) / (math.tan(z_rotate) - SLOPE)
-            y_coord = SLOPE * (x_coord) + (SLOPE * 2)
-
-        elif math.degrees(z_rotate) < 270:
-            x_coord = -(SLOPE * 2) / (math.tan(z_rotate) + SLOPE)
-            y_coord = -SLOPE * (x_coord) - (SLOPE * 2)
-
-        elif math.degrees(z_rotate) < 360:
-            x_coord = -(SLOPE * 2) / (math.tan(z_rotate) - SLOPE)
-            y_coord = SLOPE * (x_coord) - (SLOPE * 2)
-
-        xy_dist = math.sqrt(y_coord**2 + x_coord**2)
-
-        # max angle before hitting ceiling
-        max_x_rotate = math.atan((4 / xy_dist))
-
-        # check if x_rotate hits ceiling
-        if (
-            x_rotate < max_x_rotate
-            or (
-                x_rotate > math.radians(180) - max_x_rotate
-                and x_rotate < math.radians(180) + max_x_rotate
-            )
-            or x_rotate > math.radians(270) + max_x_rotate
-        ):
-            # if it doesn't, find z_coord according to x_rotate and xy_dist
-            z_coord = xy_dist * math.sin(x_rotate)
-
-        else:
-            # check for if we are going relatively down or up
-            if x_rotate > math.radians(180):
-                z_coord = -4
-            else:
-                z_coord = 4
-
-            # scale x and y coords accordingly
-            new_xy_dist = 4 / math.tan(x_rotate)
-            x_coord *= new_xy_dist / xy_dist
-            y_coord *= new_xy_dist / xy_dist
-
-        return (x_coord, y_coord, z_coord)
+        return find_max_speed(z_rotate, x_rotate)
 
     def find_motor_scalars(self, x_coord, y_coord, z_coord) -> (float, float, float):
-        z_scalar = z_coord
-        a_scalar = -x_coord / (2 * math.cos(math.pi / 3)) + y_coord / (
-            2 * math.sin(math.pi / 3)
-        )
-        b_scalar = -x_coord / (2 * math.cos(math.pi / 3)) - y_coord / (
-            2 * math.sin(math.pi / 3)
-        )
-        return (a_scalar, -b_scalar, z_scalar)
+        return find_motor_scalars(x_coord, y_coord, z_coord)
 
     # moves the ROV according to a vector specified in spherical form (r, θ, ϕ)
     def drive_vector(self, translation_vector: tuple, rotation_vector: tuple):
@@ -218,30 +431,20 @@ class Motors:
         print(f"r: {r} theta: {math.degrees(theta)} phi: {math.degrees(phi)}")
 
         yaw, roll, pitch = rotation_vector
-        max_speed_coords = self.find_max_speed(theta, phi)
-        a, b, z = self.find_motor_scalars(
+        max_speed_coords = find_max_speed(theta, phi)
+        a, b, z = find_motor_scalars(
             max_speed_coords[0] * r / 2,
             max_speed_coords[1] * r / 2,
             max_speed_coords[2] * r / 4,
         )
         print(f"a: {a:.2f} b: {b:.2f} z: {z:.2f}")
-        self.motor_velocities = [-b, -a, a, b, -z, -z, -z, -z]
-
-        self.calc_yaw_velocity(yaw)
-        self.calc_roll_velocity(roll)
-        self.calc_pitch_velocity(pitch)
+        self.motor_velocities = np.array([-b, -a, a, b, -z, -z, -z, -z])
+        self.motor_velocities += ALLOCATION_MATRIX @ (0, 0, 0, yaw, pitch, roll)
 
         print(self.motor_velocities)
 
-        # make sure the motors don't exceed the speed limit
-        for motor_num in range(len(self.motor_velocities)):
-            if self.motor_velocities[motor_num] > self.speed_limit:
-                self.motor_velocities[motor_num] = self.speed_limit
-            elif self.motor_velocities[motor_num] < -self.speed_limit:
-                self.motor_velocities[motor_num] = -self.speed_limit
-
-        for motor_num, velocity in enumerate(self.motor_velocities):
-            self.drive_motor(motor_num, velocity)
+        self.limit_speed()
+        self.write_motors()
 
 
 def main():
@@ -3,7 +3,7 @@ try:
 except:
     print('Try sudo apt-get install python-smbus2')
     
-from time import sleep
+from time import monotonic, sleep
 
 # Models
 MODEL_02BA = 0
@@ -36,6 +36,11 @@ UNITS_Centigrade = 1
 UNITS_Farenheit  = 2
 UNITS_Kelvin     = 3
 
+# Maximum conversion time increases linearly with oversampling
+# max time (seconds) ~= 2.2e-6(x) where x = OSR = (2^8, 2^9, ..., 2^13)
+# We use 2.5e-6 for some overhead
+def conversion_time(oversampling):
+    return 2.5e-6 * 2**(8+oversampling)
     
 class MS5837(object):
     
@@ -50,12 +55,16 @@ class MS5837(object):
     def __init__(self, model=MODEL_30BA, bus=1):
         self._model = model
         
-        try:
-            self._bus = smbus.SMBus(bus)
-        except:
-            print("Bus %d is not available."%bus)
-            print("Available busses are listed as /dev/i2c*")
-            self._bus = None
+        # bus can also be an already opened SMBus-like object (see hal.py)
+        if not isinstance(bus, int):
+            self._bus = bus
+        else:
+            try:
+                self._bus = smbus.SMBus(bus)
+            except:
+                print("Bus %d is not available."%bus)
+                print("Available busses are listed as /dev/i2c*")
+                self._bus = None
         
         self._fluidDensity = DENSITY_FRESHWATER
         self._pressure = 0
@@ -63,6 +72,12 @@ class MS5837(object):
         self._D1 = 0
         self._D2 = 0
         
+        # State of the non-blocking conversion pipeline used by update()
+        self._pending = None
+        self._pending_ready = 0
+        self._have_D1 = False
+        self._have_D2 = False
+        
     def init(self):
         if self._bus is None:
             "No bus!"
@@ -100,10 +115,7 @@ class MS5837(object):
         # Request D1 conversion (pressure)
         self._bus.write_byte(self._MS5837_ADDR, self._MS5837_CONVERT_D1_256 + 2*oversampling)
     
-        # Maximum conversion time increases linearly with oversampling
-        # max time (seconds) ~= 2.2e-6(x) where x = OSR = (2^8, 2^9, ..., 2^13)
-        # We use 2.5e-6 for some overhead
-        sleep(2.5e-6 * 2**(8+oversampling))
+        sleep(conversion_time(oversampling))
         
         d = self._bus.read_i2c_block_data(self._MS5837_ADDR, self._MS5837_ADC_READ, 3)
         self._D1 = d[0] << 16 | d[1] << 8 | d[2]
@@ -112,7 +124,7 @@ class MS5837(object):
         self._bus.write_byte(self._MS5837_ADDR, self._MS5837_CONVERT_D2_256 + 2*oversampling)
     
         # As above
-        sleep(2.5e-6 * 2**(8+oversampling))
+        sleep(conversion_time(oversampling))
  
         d = self._bus.read_i2c_block_data(self._MS5837_ADDR, self._MS5837_ADC_READ, 3)
         self._D2 = d[0] << 16 | d[1] << 8 | d[2]
@@ -123,6 +135,62 @@ class MS5837(object):
         
         return True
     
+    # Non-blocking alternative to read(), meant to be called once per loop tick.
+    # Collects the result of the conversion started on a previous call (if it has
+    # had time to finish), then starts the next one, alternating between pressure
+    # (D1) and temperature (D2). Returns True when a new compensated reading is
+    # available through pressure()/temperature()/depth().
+    def update(self, oversampling=OSR_8192, temperature_oversampling=None, now=None):
+        if self._bus is None:
+            print("No bus!")
+            return False
+        
+        if temperature_oversampling is None:
+            temperature_oversampling = oversampling
+        
+        for osr in (oversampling, temperature_oversampling):
+            if osr < OSR_256 or osr > OSR_8192:
+                print("Invalid oversampling option!")
+                return False
+        
+        if now is None:
+            now = monotonic()
+        
+        updated = False
+        if self._pending is not None:
+            # Conversion still in progress, try again next tick
+            if now < self._pending_ready:
+                return False
+            
+            d = self._bus.read_i2c_block_data(self._MS5837_ADDR, self._MS5837_ADC_READ, 3)
+            value = d[0] << 16 | d[1] << 8 | d[2]
+            if self._pending == self._MS5837_CONVERT_D1_256:
+                self._D1 = value
+                self._have_D1 = True
+                next_conversion = self._MS5837_CONVERT_D2_256
+            else:
+                self._D2 = value
+                self._have_D2 = True
+                next_conversion = self._MS5837_CONVERT_D1_256
+            
+            # Need at least one of each before the compensation means anything
+            if self._have_D1 and self._have_D2:
+                self._calculate()
+                updated = True
+        else:
+            next_conversion = self._MS5837_CONVERT_D1_256
+        
+        if next_conversion == self._MS5837_CONVERT_D1_256:
+            osr = oversampling
+        else:
+            osr = temperature_oversampling
+        
+        self._bus.write_byte(self._MS5837_ADDR, next_conversion + 2*osr)
+        self._pending = next_conversion
+        self._pending_ready = now + conversion_time(osr)
+        
+        return updated
+    
     def setFluidDensity(self, denisty):
         self._fluidDensity = denisty
         
@@ -1,5 +1,5 @@
 import numpy as np
-from math import asin, atan2, acos, cos, degrees, hypot, sin
+from math import asin, atan2, acos, cos, degrees, hypot, sin, sqrt
 
 
 # converts vector in cartesian coordinates (x, y, z) to spherical coordinates (r, θ, ϕ)
@@ -22,69 +22,95 @@ def spherical_to_cartesian(vector: tuple) -> tuple:
     return x, y, z
 
 
-# rotates a vector supplied in cartesian (x, y, z) coordinates by specified Euler angles
-def rotate_vector(vector: tuple, yaw: float, pitch: float, roll: float) -> tuple:
-    a = -yaw
-    b = -pitch
-    c = -roll
-
-    vector = np.array([[vector[0]], [vector[1]], [vector[2]]])
+# converts an (N, 3) array of cartesian vectors to an (N, 3) array of (r, θ, ϕ)
+def cartesian_to_spherical_batch(vectors: np.ndarray) -> np.ndarray:
+    vectors = np.asarray(vectors, dtype=float)
+    x, y, z = vectors[:, 0], vectors[:, 1], vectors[:, 2]
+    spherical = np.empty_like(vectors)
+    r = np.sqrt(x * x + y * y + z * z)
+    spherical[:, 0] = r
+    spherical[:, 1] = np.arctan2(y, x)
+    # vectors of length 0 point sideways, like cartesian_to_spherical
+    with np.errstate(divide="ignore", invalid="ignore"):
+        spherical[:, 2] = np.where(r != 0, np.arccos(z / r), acos(0))
+    return spherical
+
+
+# converts an (N, 3) array of (r, θ, ϕ) to an (N, 3) array of cartesian vectors
+def spherical_to_cartesian_batch(vectors: np.ndarray) -> np.ndarray:
+    vectors = np.asarray(vectors, dtype=float)
+    r, theta, phi = vectors[:, 0], vectors[:, 1], vectors[:, 2]
+    cartesian = np.empty_like(vectors)
+    r_sin_phi = r * np.sin(phi)
+    cartesian[:, 0] = r_sin_phi * np.cos(theta)
+    cartesian[:, 1] = r_sin_phi * np.sin(theta)
+    cartesian[:, 2] = r * np.cos(phi)
+    return cartesian
+
+
+# the matrix that rotate_vector rotates by for the given Euler angles (radians). if out
+# is given the matrix is written into it instead of a new array
+def euler_to_matrix(yaw: float, pitch: float, roll: float, out=None) -> np.ndarray:
+    if out is None:
+        out = np.empty((3, 3))
+    cos_a, sin_a = cos(yaw), -sin(yaw)
+    cos_b, sin_b = cos(pitch), -sin(pitch)
+    cos_c, sin_c = cos(roll), -sin(roll)
+
+    out[0, 0] = cos_a * cos_b
+    out[0, 1] = cos_a * sin_b * sin_c - sin_a * cos_c
+    out[0, 2] = cos_a * sin_b * cos_c + sin_a * sin_c
+    out[1, 0] = sin_a * cos_b
+    out[1, 1] = sin_a * sin_b * sin_c + cos_a * cos_c
+    out[1, 2] = sin_a * sin_b * cos_c - cos_a * sin_c
+    out[2, 0] = -sin_b
+    out[2, 1] = cos_b * sin_c
+    out[2, 2] = cos_b * cos_c
+    return out
+
+
+# a rotation that's worked out once (e.g. for each IMU sample) and then used to rotate
+# as many vectors as needed, without allocating a new matrix every time
+class Rotation:
+    def __init__(self):
+        self.matrix = np.eye(3)
+
+    def set_euler(self, yaw: float, pitch: float, roll: float):
+        euler_to_matrix(yaw, pitch, roll, self.matrix)
+        return self
+
+    # q is a unit quaternion (w, x, y, z)
+    def set_quaternion(self, q: np.ndarray):
+        quaternion_to_matrix(q, self.matrix)
+        return self
+
+    # rotates a single (3,) vector or an (N, 3) array of them
+    def apply(self, vectors: np.ndarray, out=None) -> np.ndarray:
+        return np.matmul(vectors, self.matrix.T, out=out)
+
+    # the opposite rotation, e.g. from the world frame back to the body frame
+    def apply_inverse(self, vectors: np.ndarray, out=None) -> np.ndarray:
+        return np.matmul(vectors, self.matrix, out=out)
+
+    # rotates an (N, 3) array of (r, θ, ϕ)
+    def apply_spherical(self, vectors: np.ndarray) -> np.ndarray:
+        return cartesian_to_spherical_batch(
+            self.apply(spherical_to_cartesian_batch(vectors))
+        )
 
-    rotation_matrix = np.matrix(
-        [
-            [
-                cos(a) * cos(b),
-                cos(a) * sin(b) * sin(c) - sin(a) * cos(c),
-                cos(a) * sin(b) * cos(c) + sin(a) * sin(c),
-            ],
-            [
-                sin(a) * cos(b),
-                sin(a) * sin(b) * sin(c) + cos(a) * cos(c),
-                sin(a) * sin(b) * cos(c) - cos(a) * sin(c),
-            ],
-            [-sin(b), cos(b) * sin(c), cos(b) * cos(c)],
-        ]
-    )
 
-    rotated_vector = np.matmul(rotation_matrix, vector).A1
-    return (
-        round(rotated_vector[0], 4),
-        round(rotated_vector[1], 4),
-        round(rotated_vector[2], 4),
-    )
+# rotates a vector supplied in cartesian (x, y, z) coordinates by specified Euler angles
+def rotate_vector(vector: tuple, yaw: float, pitch: float, roll: float) -> tuple:
+    x, y, z = (euler_to_matrix(yaw, pitch, roll) @ vector).tolist()
+    return (round(x, 4), round(y, 4), round(z, 4))
 
 
 # rotates a vector supplied in spherical (r, θ, ϕ) coordinates by specified Euler angles
 def rotate_vector_spherical(
     vector: tuple, yaw: float, pitch: float, roll: float
 ) -> tuple:
-    a = -yaw
-    b = -pitch
-    c = -roll
-
-    cartesian = spherical_to_cartesian(vector)
-    vector = np.array([[cartesian[0]], [cartesian[1]], [cartesian[2]]])
-
-    rotation_matrix = np.matrix(
-        [
-            [
-                cos(a) * cos(b),
-                cos(a) * sin(b) * sin(c) - sin(a) * cos(c),
-                cos(a) * sin(b) * cos(c) + sin(a) * sin(c),
-            ],
-            [
-                sin(a) * cos(b),
-                sin(a) * sin(b) * sin(c) + cos(a) * cos(c),
-                sin(a) * sin(b) * cos(c) - cos(a) * sin(c),
-            ],
-            [-sin(b), cos(b) * sin(c), cos(b) * cos(c)],
-        ]
-    )
-
-    rotated_vector = np.matmul(rotation_matrix, vector).A1
-    return cartesian_to_spherical(
-        (rotated_vector[0], rotated_vector[1], rotated_vector[2])
-    )
+    rotated = euler_to_matrix(yaw, pitch, roll) @ spherical_to_cartesian(vector)
+    return cartesian_to_spherical(rotated.tolist())
 
 
 def quaternion_to_euler(x, y, z, w):
@@ -108,3 +134,97 @@ def quaternion_to_euler(x, y, z, w):
     yaw = atan2(t3, t4)
 
     return degrees(yaw), degrees(roll), degrees(pitch)  # in radians
+
+
+# multiplies two quaternions given as (w, x, y, z)
+def quaternion_multiply(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    aw, ax, ay, az = a
+    bw, bx, by, bz = b
+    return np.array(
+        [
+            aw * bw - ax * bx - ay * by - az * bz,
+            aw * bx + ax * bw + ay * bz - az * by,
+            aw * by - ax * bz + ay * bw + az * bx,
+            aw * bz + ax * by - ay * bx + az * bw,
+        ]
+    )
+
+
+# the rotation matrix of a unit quaternion given as (w, x, y, z). if out is given the
+# matrix is written into it instead of a new array
+def quaternion_to_matrix(q: np.ndarray, out=None) -> np.ndarray:
+    if out is None:
+        out = np.empty((3, 3))
+    # plain floats are a lot quicker to do arithmetic on than numpy scalars
+    w, x, y, z = np.asarray(q, dtype=float).tolist()
+    out[0, 0] = 1 - 2 * (y * y + z * z)
+    out[0, 1] = 2 * (x * y - w * z)
+    out[0, 2] = 2 * (x * z + w * y)
+    out[1, 0] = 2 * (x * y + w * z)
+    out[1, 1] = 1 - 2 * (x * x + z * z)
+    out[1, 2] = 2 * (y * z - w * x)
+    out[2, 0] = 2 * (x * z - w * y)
+    out[2, 1] = 2 * (y * z + w * x)
+    out[2, 2] = 1 - 2 * (x * x + y * y)
+    return out
+
+
+# the unit quaternion (w, x, y, z) of a rotation matrix
+def matrix_to_quaternion(m) -> np.ndarray:
+    m = np.asarray(m, dtype=float)
+    trace = m[0, 0] + m[1, 1] + m[2, 2]
+    # pick whichever component is largest to divide by, so it's never close to 0
+    if trace > 0:
+        s = 2 * sqrt(trace + 1)
+        q = (
+            s / 4,
+            (m[2, 1] - m[1, 2]) / s,
+            (m[0, 2] - m[2, 0]) / s,
+            (m[1, 0] - m[0, 1]) / s,
+        )
+    elif m[0, 0] > m[1, 1] and m[0, 0] > m[2, 2]:
+        s = 2 * sqrt(1 + m[0, 0] - m[1, 1] - m[2, 2])
+        q = (
+            (m[2, 1] - m[1, 2]) / s,
+            s / 4,
+            (m[0, 1] + m[1, 0]) / s,
+            (m[0, 2] + m[2, 0]) / s,
+        )
+    elif m[1, 1] > m[2, 2]:
+        s = 2 * sqrt(1 + m[1, 1] - m[0, 0] - m[2, 2])
+        q = (
+            (m[0, 2] - m[2, 0]) / s,
+            (m[0, 1] + m[1, 0]) / s,
+            s / 4,
+            (m[1, 2] + m[2, 1]) / s,
+        )
+    else:
+        s = 2 * sqrt(1 + m[2, 2] - m[0, 0] - m[1, 1])
+        q = (
+            (m[1, 0] - m[0, 1]) / s,
+            (m[0, 2] + m[2, 0]) / s,
+            (m[1, 2] + m[2, 1]) / s,
+            s / 4,
+        )
+    return np.array(q)
+
+
+# the rotation (in degrees, around the x, y and z axes of the current frame) that would
+# take the current attitude to the set point, both unit quaternions (w, x, y, z). this
+# works the same at any attitude, there are no Euler angles to wrap around or lock up
+def attitude_error(current, set_point) -> (float, float, float):
+    aw, ax, ay, az = current
+    bw, bx, by, bz = set_point
+    # conjugate(current) * set_point
+    w = aw * bw + ax * bx + ay * by + az * bz
+    x = aw * bx - ax * bw - ay * bz + az * by
+    y = aw * by + ax * bz - ay * bw - az * bx
+    z = aw * bz - ax * by + ay * bx - az * bw
+    # q and -q are the same rotation, take the short way around
+    if w < 0:
+        w, x, y, z = -w, -x, -y, -z
+    sin_half_angle = sqrt(x * x + y * y + z * z)
+    if sin_half_angle < 1e-9:
+        return (0.0, 0.0, 0.0)
+    scale = degrees(2 * atan2(sin_half_angle, w)) / sin_half_angle
+    return (x * scale, y * scale, z * scale)
@@ -1,4 +1,5 @@
 import math
+import numpy as np
 import time
 
 
@@ -10,66 +11,201 @@ class PID:
         proportional_gain=0,
         integral_gain=0,
         derivative_gain=0,
+        clock=time.monotonic,
     ):
         self.set_point = set_point
         self.proportional_gain = proportional_gain
         self.integral_gain = integral_gain
         self.derivative_gain = derivative_gain
 
+        # where the current time comes from, the control loop passes in a clock that
+        # returns the time of the current tick so that every PID sees the same time
+        self.clock = clock
+
         self.integral = 0
-        self.last_time = time.time()
+        self.last_time = self.clock()
         self.last_error = set_point
 
+        # the individual terms of the last output, kept around for logging
+        self.proportional_term = 0
+        self.integral_term = 0
+        self.derivative_term = 0
+
     def compute(self, process_value):
-        current_time = time.time()
-        d_time = time.time() - self.last_time
+        # difference between the target value and measured value
+        return self.compute_error(self.set_point - process_value)
+
+    # runs the PID on an error that's already been worked out, for set points that
+    # can't just be subtracted
+    def compute_error(self, error):
+        current_time = self.clock()
+        d_time = current_time - self.last_time
         self.last_time = current_time
 
-        # difference between the target value and measured value
-        error = self.set_point - process_value
         # compute the integral ∫e(t) dt
         self.integral += error * d_time
         # compute the derivative de/dt
-        d_error = (error - self.last_error) / d_time
+        # the set point may have been changed earlier in the same tick
+        d_error = (error - self.last_error) / d_time if d_time > 0 else 0
         self.last_error = error
 
         # add the P, I, and the D together
-        output = (
-            self.proportional_gain * error
-            + self.integral_gain * self.integral
-            + self.derivative_gain * d_error
-        )
+        self.proportional_term = self.proportional_gain * error
+        self.integral_term = self.integral_gain * self.integral
+        self.derivative_term = self.derivative_gain * d_error
+        output = self.proportional_term + self.integral_term + self.derivative_term
         return output
 
     def update_set_point(self, set_point):
         self.set_point = set_point
         self.integral = 0
-        self.last_time = time.time()
-        self.last_error = set_point
+        self.last_time = self.clock()
+        # the set point is always where the ROV is when it's changed, so there's no
+        # error yet. using the set point here kicked the derivative on the next tick
+        self.last_error = 0
 
 
 class RotationalPID(PID):
     def compute(self, angle):
-        current_time = time.time()
-        d_time = time.time() - self.last_time
-        self.last_time = current_time
-
         # find the signed smallest difference between the angles
-        error = angle_between(self.set_point, angle)
-        # compute the integral ∫e(t) dt
-        self.integral += error * d_time
-        # compute the derivative
-        d_error = (error - self.last_error) / d_time
-        self.last_error = error
+        return self.compute_error(angle_between(self.set_point, angle))
 
-        # add the P, I, and the D together
-        output = (
-            self.proportional_gain * error
-            + self.integral_gain * self.integral
-            + self.derivative_gain * d_error
+
+# how much the rate of each measurement is smoothed before it's used for the D term (s),
+# the depth sensor in particular is too noisy to differentiate directly
+DERIVATIVE_TIME_CONSTANT = 0.05
+# the velocities given to the motors only go from -1 to 1
+OUTPUT_LIMIT = 1
+
+
+# several PIDs evaluated together, one row of each array per loop, so that every loop
+# sees the same time and the control tick only does one pass over them. loops are
+# referred to by name, in the order they were given. unlike PID:
+# - the integral is clamped so the I term can't wind up past the output limit
+# - the D term is on the (low-pass filtered) rate of the measurement rather than of
+#   the error, so moving the set point doesn't kick it
+# - enabling a loop can start it at whatever output was being used before, so taking
+#   over from the pilot or the autonomous code doesn't jolt the ROV
+class PIDBank:
+    def __init__(
+        self,
+        names: tuple,
+        proportional_gains,
+        integral_gains=0,
+        derivative_gains=0,
+        output_limit=OUTPUT_LIMIT,
+        derivative_time_constant=DERIVATIVE_TIME_CONSTANT,
+        clock=time.monotonic,
+    ):
+        self.names = names
+        self.index = {name: i for i, name in enumerate(names)}
+        size = len(names)
+        self.proportional_gains = np.full(size, proportional_gains, dtype=float)
+        self.integral_gains = np.full(size, integral_gains, dtype=float)
+        self.derivative_gains = np.full(size, derivative_gains, dtype=float)
+        # to turn a clamped I term back into an integral, 0 for loops without one
+        self.inverse_integral_gains = np.divide(
+            1,
+            self.integral_gains,
+            out=np.zeros(size),
+            where=self.integral_gains != 0,
         )
+        self.output_limit = output_limit
+        self.derivative_time_constant = derivative_time_constant
+        self.clock = clock
+
+        self.enabled = np.zeros(size, dtype=bool)
+        self.integral = np.zeros(size)
+        self.last_error = np.zeros(size)
+        # loops that have just been (re)started or held and have no usable last error
+        self.fresh = np.ones(size, dtype=bool)
+        # filtered rate of change of each measurement
+        self.rate = np.zeros(size)
+        self.last_time = None
+
+        # the P, I and D terms of the last output of each loop, kept around for logging
+        self.terms = np.zeros((size, 3))
+        self.output = np.zeros(size)
+        self.active = np.zeros(size, dtype=bool)
+        self.raw_rate = np.zeros(size)
+
+    # starts a loop (again) from scratch, e.g. when its set point is changed. output is
+    # what was driving the axis until now, the I term picks up from there
+    def enable(self, name: str, output=0):
+        i = self.index[name]
+        self.enabled[i] = True
+        self.fresh[i] = True
+        self.rate[i] = 0
+        integral_term = min(max(output, -self.output_limit), self.output_limit)
+        self.integral[i] = integral_term * self.inverse_integral_gains[i]
+        self.terms[i] = 0
+        self.output[i] = 0
+
+    def disable(self, name: str):
+        i = self.index[name]
+        self.enabled[i] = False
+        self.terms[i] = 0
+        self.output[i] = 0
+
+    # errors are the set point minus the measurement of each loop, a NaN error holds
+    # that loop where it is for this tick (e.g. the sensor isn't ready, or the pilot
+    # is overriding it) and its output is 0. rates are the rate of change of each
+    # measurement if there's a better source for it than the errors (e.g. a filter),
+    # NaN for the loops without one. returns the output of every loop
+    def compute(self, errors, rates=None) -> np.ndarray:
+        current_time = self.clock()
+        d_time = current_time - self.last_time if self.last_time is not None else 0
+        self.last_time = current_time
+
+        errors = np.asarray(errors, dtype=float)
+        active = np.isfinite(errors, out=self.active)
+        active &= self.enabled
+        error = np.where(active, errors, 0)
+
+        if d_time > 0:
+            # compute the integral ∫e(t) dt
+            self.integral += error * d_time
+            # the rate of the measurement is the opposite of the rate of the error, as
+            # long as the set point stays put. enable() is called whenever it moves,
+            # which starts the loop over without a last error. the same goes for a loop
+            # coming back from being held, whose last error could be from a while ago
+            raw_rate = np.subtract(self.last_error, error, out=self.raw_rate)
+            raw_rate /= d_time
+            differentiable = ~self.fresh
+            if rates is not None:
+                measured = np.isfinite(rates)
+                np.copyto(raw_rate, rates, where=measured)
+                differentiable |= measured
+            # low-pass filter the rate of the loops that can be differentiated
+            raw_rate -= self.rate
+            raw_rate *= d_time / (self.derivative_time_constant + d_time)
+            raw_rate *= active & differentiable
+            self.rate += raw_rate
+        np.copyto(self.last_error, error, where=active)
+        # held loops start their rate over too, rather than coming back with a stale one
+        np.logical_not(active, out=self.fresh)
+        self.rate *= active
+
+        proportional_term, integral_term, derivative_term = self.terms.T
+        np.multiply(self.proportional_gains, error, out=proportional_term)
+        # anti-windup: the I term is never allowed past the output limit
+        np.multiply(self.integral_gains, self.integral, out=integral_term)
+        np.minimum(integral_term, self.output_limit, out=integral_term)
+        np.maximum(integral_term, -self.output_limit, out=integral_term)
+        np.multiply(integral_term, self.inverse_integral_gains, out=self.integral)
+        # the D term opposes the measurement moving
+        np.multiply(self.derivative_gains, self.rate, out=derivative_term)
+        np.negative(derivative_term, out=derivative_term)
+        self.terms *= active[:, None]
+
+        output = self.terms.sum(axis=1, out=self.output)
+        np.minimum(output, self.output_limit, out=output)
+        np.maximum(output, -self.output_limit, out=output)
         return output
 
+    def __getitem__(self, name: str) -> float:
+        return float(self.output[self.index[name]])
+
 
 def angle_between(x, y):
     a = (x - y) % 360
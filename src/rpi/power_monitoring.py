@@ -1,47 +1,151 @@
-import board
-import busio
-import adafruit_ads1x15.ads1015 as ADS
-from adafruit_ads1x15.analog_in import AnalogIn
+try:
+    import board
+    import busio
+    import adafruit_ads1x15.ads1015 as ADS
+    from adafruit_ads1x15.ads1x15 import Mode
+    from adafruit_ads1x15.analog_in import AnalogIn
+except ImportError:
+    # PowerMonitor still works with the fake ADCs in hal.py without the driver
+    print("Try pip install adafruit-circuitpython-ads1x15")
+import threading
 import time
 
+# fastest data rate the ADS1015 supports (samples per second)
+MAX_DATA_RATE = 3300
+# a gain of 2/3 gives a full scale range of +-6.144 V
+GAIN = 2 / 3
+ADC_RANGE = 4.096 / GAIN
+# how many full scans of the four channels are averaged into one snapshot
+DECIMATION = 8
+# how many snapshots are made per second. the ADC shares the I2C bus with the IMU and
+# the motors, so it's only scanned as often as the readings are actually looked at
+SCAN_RATE = 10
+# how long to wait before trying again when the ADC can't be read (s)
+RETRY_DELAY = 0.5
+
+
+# the voltages and currents of both rails, all from the same scan
+class PowerSnapshot:
+    def __init__(
+        self,
+        timestamp: float,
+        voltage_5V: float,
+        current_5V: float,
+        voltage_12V: float,
+        current_12V: float,
+    ):
+        self.timestamp = timestamp
+        self.voltage_5V = voltage_5V
+        self.current_5V = current_5V
+        self.voltage_12V = voltage_12V
+        self.current_12V = current_12V
+
+
+# the four channels of the ADS1015. read() returns the raw, signed 16 bit value of a
+# channel, the same as the adafruit AnalogIn.value. hal.py has a fake and a trace
+# playback ADC with the same interface
+class ADS1015ADC:
+    def __init__(self, i2c=None, data_rate=MAX_DATA_RATE):
+        # in continuous mode the ADC keeps converting the selected channel, so reading
+        # a channel is just a read of the conversion register
+        ads = ADS.ADS1015(
+            i2c if i2c is not None else busio.I2C(board.SCL, board.SDA),
+            data_rate=data_rate,
+            mode=Mode.CONTINUOUS,
+        )
+        ads.gain = GAIN
+        self.range = 4.096 / ads.gain
+        self.channels = (
+            AnalogIn(ads, ADS.P0),
+            AnalogIn(ads, ADS.P1),
+            AnalogIn(ads, ADS.P2),
+            AnalogIn(ads, ADS.P3),
+        )
+
+    def read(self, channel: int) -> int:
+        return self.channels[channel].value
+
 
 class PowerMonitor:
-    def __init__(self):
-        ads = ADS.ADS1015(busio.I2C(board.SCL, board.SDA))
-        ads.gain = 2 / 3
-        self.ads_range = 4.096 / ads.gain
-        self.channel0 = AnalogIn(ads, ADS.P0)
-        self.channel1 = AnalogIn(ads, ADS.P1)
-        self.channel2 = AnalogIn(ads, ADS.P2)
-        self.channel3 = AnalogIn(ads, ADS.P3)
+    def __init__(self, decimation=DECIMATION, scan_rate=SCAN_RATE, adc=None):
+        self.adc = adc if adc is not None else ADS1015ADC()
+        self.ads_range = self.adc.range
+
+        self.decimation = decimation
+        self.scan_period = 1 / scan_rate
+        # the most recent averaged readings, updated by the scanning thread
+        self.snapshot = None
 
     def voltage_5V(self) -> float:
-        return self.channel1.value / 2**15 * self.ads_range
+        return self.adc.read(1) / 2**15 * self.ads_range
 
     def current_5V(self) -> float:
         return (
-            73.3 * self.channel3.value / 2**15 * self.ads_range / self.voltage_5V()
+            73.3 * self.adc.read(3) / 2**15 * self.ads_range / self.voltage_5V()
             - 36.7
         )
 
     def voltage_12V(self) -> float:
-        return self.channel0.value / 2**15 * self.ads_range * 4
+        return self.adc.read(0) / 2**15 * self.ads_range * 4
 
     def current_12V(self) -> float:
         return (
-            73.3 * self.channel2.value / 2**15 * self.ads_range / self.voltage_5V()
+            73.3 * self.adc.read(2) / 2**15 * self.ads_range / self.voltage_5V()
             - 36.7
         )
 
+    # converts the raw values of the four channels into a snapshot
+    def make_snapshot(
+        self, value0: float, value1: float, value2: float, value3: float
+    ) -> PowerSnapshot:
+        voltage_5V = value1 / 2**15 * self.ads_range
+        voltage_12V = value0 / 2**15 * self.ads_range * 4
+        # the current sensors' output is ratiometric to the 5V rail
+        current_5V = 73.3 * value3 / 2**15 * self.ads_range / voltage_5V - 36.7
+        current_12V = 73.3 * value2 / 2**15 * self.ads_range / voltage_5V - 36.7
+        return PowerSnapshot(
+            time.monotonic(), voltage_5V, current_5V, voltage_12V, current_12V
+        )
+
+    # cycles through the four channels as fast as the ADC allows, averaging a few
+    # scans into a new snapshot scan_rate times a second and leaving the bus alone in
+    # between. runs forever, should be run in its own thread
+    def scan(self):
+        read = self.adc.read
+        next_time = time.monotonic()
+        while True:
+            # if a scan ran late, the next one isn't rushed to catch up
+            next_time = max(next_time + self.scan_period, time.monotonic())
+            try:
+                sums = [0, 0, 0, 0]
+                for _ in range(self.decimation):
+                    for channel in range(4):
+                        sums[channel] += read(channel)
+                self.snapshot = self.make_snapshot(
+                    *(total / self.decimation for total in sums)
+                )
+            except OSError:
+                print("Unable to read from power monitor!")
+                next_time = time.monotonic() + RETRY_DELAY
+            except ZeroDivisionError:
+                # the 5V rail reads 0 V while the power is coming up
+                next_time = time.monotonic() + RETRY_DELAY
+            time.sleep(max(next_time - time.monotonic(), 0))
+
+    def start_scanning(self):
+        threading.Thread(target=self.scan, daemon=True).start()
+
 
 def main():
+    power_monitor = PowerMonitor()
+    power_monitor.start_scanning()
     while True:
-        power_monitor = PowerMonitor()
-
-        print(f"5V Rail Voltage: {power_monitor.voltage_5V():.2f}V")
-        print(f"12V Rail Voltage: {power_monitor.voltage_12V():.2f}V")
-        print(f"5V Rail Current: {power_monitor.current_5V():.2f}A")
-        print(f"12V Rail Current: {power_monitor.current_12V():.2f}A")
+        snapshot = power_monitor.snapshot
+        if snapshot is not None:
+            print(f"5V Rail Voltage: {snapshot.voltage_5V:.2f}V")
+            print(f"12V Rail Voltage: {snapshot.voltage_12V:.2f}V")
+            print(f"5V Rail Current: {snapshot.current_5V:.2f}A")
+            print(f"12V Rail Current: {snapshot.current_12V:.2f}A")
 
         time.sleep(0.1)
 
@@ -0,0 +1,208 @@
+import argparse
+import asyncio
+from controller import Controller, Readings, TickClock
+from flight_recorder import FLAG_AUTONOMOUS, FLAG_JOYSTICK, load_session
+import math
+from motors import MotorMixer
+import numpy as np
+from time import monotonic
+import websockets
+from ws_server import JOYSTICK_BUTTONS, WSServer
+
+# how far a replayed motor output can be from the recorded one before it counts as a
+# divergence. the recording stores float32, so they'll never match exactly
+DIVERGENCE_TOLERANCE = 1e-3
+# how often the replayed telemetry is sent to the web client, in replay time (Hz)
+TELEMETRY_RATE = 20
+
+
+def to_optional(value):
+    value = float(value)
+    return None if math.isnan(value) else value
+
+
+# fills in the readings the controller saw during a recorded tick
+def readings_from_record(record, readings: Readings):
+    readings.depth = to_optional(record["depth"])
+    readings.depth_rate = to_optional(record["depth_rate"])
+    readings.measured_depth = to_optional(record["measured_depth"])
+    readings.external_temp = to_optional(record["external_temp"])
+    readings.internal_temp = to_optional(record["internal_temp"])
+    readings.yaw = to_optional(record["yaw"])
+    readings.roll = to_optional(record["roll"])
+    readings.pitch = to_optional(record["pitch"])
+    attitude = record["attitude"]
+    readings.attitude = (
+        None if np.isnan(attitude[0]) else np.array(attitude, dtype=float)
+    )
+    readings.x_accel, readings.y_accel, readings.z_accel = (
+        to_optional(value) for value in record["linear_acceleration"]
+    )
+    readings.voltage_5V = to_optional(record["voltage_5V"])
+    readings.current_5V = to_optional(record["current_5V"])
+    readings.voltage_12V = to_optional(record["voltage_12V"])
+    readings.current_12V = to_optional(record["current_12V"])
+
+
+# rebuilds the joystick data the controller was given during a recorded tick
+def joystick_from_record(record):
+    if not record["flags"] & FLAG_JOYSTICK:
+        return None
+    axes = [float(axis) for axis in record["joystick_axes"]]
+    buttons = int(record["joystick_buttons"])
+    return {
+        "buttons": {
+            name: bool(buttons & (1 << bit)) for bit, name in enumerate(JOYSTICK_BUTTONS)
+        },
+        "left_stick": axes[0:2],
+        "right_stick": axes[2:4],
+        "dpad": axes[4:6],
+        "seq": int(record["joystick_seq"]),
+    }
+
+
+class ReplayResult:
+    def __init__(self, num_ticks: int):
+        self.num_ticks = num_ticks
+        self.motor_outputs = np.zeros((num_ticks, 8), dtype=np.float32)
+        # the ticks where the replayed motor outputs didn't match the recorded ones
+        self.divergent_ticks = []
+        self.max_error = 0
+        # autonomous mode depends on camera frames, which aren't recorded
+        self.autonomous_ticks = 0
+        self.wall_time = 0
+
+    @property
+    def diverged(self) -> bool:
+        return len(self.divergent_ticks) > 0
+
+    def summary(self) -> str:
+        lines = [
+            f"Replayed {self.num_ticks} ticks in {self.wall_time:.2f} s",
+            f"Max motor output error: {self.max_error:.6f}",
+        ]
+        if self.diverged:
+            lines.append(
+                f"DIVERGED on {len(self.divergent_ticks)} ticks, "
+                f"first at tick {self.divergent_ticks[0]}"
+            )
+        else:
+            lines.append("No divergence")
+        if self.autonomous_ticks:
+            lines.append(
+                f"{self.autonomous_ticks} ticks were in autonomous mode and can't be "
+                "replayed faithfully"
+            )
+        return "\n".join(lines)
+
+
+# feeds a recorded session through the same controller and mixer as main_server, on a
+# simulated clock
+class Replayer:
+    def __init__(self, records: np.ndarray, tolerance=DIVERGENCE_TOLERANCE):
+        self.records = records
+        self.tolerance = tolerance
+
+        start_time = float(records["time"][0]) if len(records) > 0 else 0
+        self.clock = TickClock(start_time)
+        self.controller = Controller(
+            has_depth_sensor=not np.all(np.isnan(records["depth"])),
+            has_imu=not np.all(np.isnan(records["yaw"])),
+            clock=self.clock,
+        )
+        self.mixer = MotorMixer()
+        self.readings = Readings()
+
+    # runs a single recorded tick, returns the replayed motor outputs
+    def step(self, record) -> list:
+        self.clock.now = float(record["time"])
+        readings_from_record(record, self.readings)
+        velocities = self.controller.step(joystick_from_record(record), self.readings)
+        return self.mixer.mix(*velocities)
+
+    def check(self, index: int, record, motor_outputs: list, result: ReplayResult):
+        result.motor_outputs[index] = motor_outputs
+        error = float(
+            np.max(np.abs(result.motor_outputs[index] - record["motor_outputs"]))
+        )
+        if error > result.max_error:
+            result.max_error = error
+        if error > self.tolerance:
+            result.divergent_ticks.append(index)
+        if record["flags"] & FLAG_AUTONOMOUS:
+            result.autonomous_ticks += 1
+
+    # replays the whole session as fast as possible
+    def run(self) -> ReplayResult:
+        result = ReplayResult(len(self.records))
+        start = monotonic()
+        for index, record in enumerate(self.records):
+            self.check(index, record, self.step(record), result)
+        result.wall_time = monotonic() - start
+        return result
+
+    # replays the session at a multiple of real time, sending the replayed telemetry to
+    # any connected web clients
+    async def stream(self, speed=1.0) -> ReplayResult:
+        result = ReplayResult(len(self.records))
+        if len(self.records) == 0:
+            return result
+        start = monotonic()
+        first_time = float(self.records["time"][0])
+        next_telemetry = first_time
+        for index, record in enumerate(self.records):
+            record_time = float(record["time"])
+            delay = (record_time - first_time) / speed - (monotonic() - start)
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+            self.check(index, record, self.step(record), result)
+
+            if record_time >= next_telemetry:
+                next_telemetry += 1 / TELEMETRY_RATE
+                if WSServer.subscribers:
+                    WSServer.publish(
+                        self.controller.status_info(self.readings), record_time
+                    )
+        result.wall_time = monotonic() - start
+        return result
+
+
+async def stream_session(records: np.ndarray, speed: float, port: int):
+    async with websockets.serve(WSServer.handler, "0.0.0.0", port, ping_interval=None):
+        print(f"Streaming replay at {speed}x on port {port}")
+        result = await Replayer(records).stream(speed)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Replay a flight recording through the control code"
+    )
+    parser.add_argument("session", help="session directory written by FlightRecorder")
+    parser.add_argument(
+        "--speed",
+        type=float,
+        default=None,
+        help="stream the replayed telemetry to the web client at this multiple of "
+        "real time (e.g. 1 to 50), otherwise replay as fast as possible",
+    )
+    parser.add_argument("--port", type=int, default=8765)
+    args = parser.parse_args()
+
+    records, _ = load_session(args.session)
+    if len(records) == 0:
+        print("Nothing to replay!")
+        return
+
+    if args.speed is None:
+        result = Replayer(records).run()
+    else:
+        result = asyncio.run(stream_session(records, args.speed, args.port))
+    print(result.summary())
+    if result.diverged:
+        exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,176 @@
+import asyncio
+import math
+from time import monotonic, sleep
+
+
+# upper edges of the jitter histogram buckets in microseconds, anything later than the
+# last edge ends up in the overflow bucket
+JITTER_BUCKETS_US = (50, 100, 250, 500, 1000, 2000, 5000, 10000, 20000)
+
+
+class JitterHistogram:
+    def __init__(self, buckets=JITTER_BUCKETS_US):
+        self.buckets = buckets
+        # one extra bucket for anything that doesn't fit in the others
+        self.counts = [0] * (len(buckets) + 1)
+        self.max_jitter = 0
+
+    def record(self, jitter: float):
+        jitter_us = jitter * 1e6
+        if jitter_us > self.max_jitter:
+            self.max_jitter = jitter_us
+        for i, edge in enumerate(self.buckets):
+            if jitter_us < edge:
+                self.counts[i] += 1
+                return
+        self.counts[-1] += 1
+
+    def as_dict(self) -> dict:
+        labels = [f"<{edge}us" for edge in self.buckets]
+        labels.append(f">={self.buckets[-1]}us")
+        return {
+            "buckets": dict(zip(labels, self.counts)),
+            "max_us": round(self.max_jitter),
+        }
+
+
+# a subsystem that should be run at a fixed rate, the callback is passed the time the
+# task was scheduled to run at (which is what the PIDs should use as their clock)
+class PeriodicTask:
+    def __init__(self, name: str, rate: float, callback):
+        self.name = name
+        self.rate = rate
+        self.period = 1 / rate
+        self.callback = callback
+
+        self.deadline = 0
+        self.runs = 0
+        # number of times the task was still running when it should have started again
+        self.overruns = 0
+        # number of releases that were skipped because of overruns
+        self.skipped = 0
+        self.last_runtime = 0
+        self.max_runtime = 0
+        self.total_runtime = 0
+        self.jitter = JitterHistogram()
+
+    def stats(self) -> dict:
+        return {
+            "rate": self.rate,
+            "runs": self.runs,
+            "overruns": self.overruns,
+            "skipped": self.skipped,
+            "last_runtime_us": round(self.last_runtime * 1e6),
+            "max_runtime_us": round(self.max_runtime * 1e6),
+            "mean_runtime_us": (
+                round(self.total_runtime / self.runs * 1e6) if self.runs else 0
+            ),
+            "jitter": self.jitter.as_dict(),
+        }
+
+
+# runs each subsystem at its own rate, always picking the task with the earliest
+# deadline rather than sleeping for a fixed amount of time after each loop
+class Scheduler:
+    # clock and sleep can be swapped out together to run on simulated time
+    def __init__(self, clock=monotonic, sleep=asyncio.sleep):
+        self.clock = clock
+        self.sleep = sleep
+        self.tasks = []
+        self.running = False
+        # jitter of every task release, regardless of which task it was
+        self.jitter = JitterHistogram()
+        self.start_time = None
+
+    def add_task(self, name: str, rate: float, callback) -> PeriodicTask:
+        task = PeriodicTask(name, rate, callback)
+        self.tasks.append(task)
+        return task
+
+    def next_task(self) -> PeriodicTask:
+        return min(self.tasks, key=lambda task: task.deadline)
+
+    # run a single release of the task, returns the time that it finished at
+    async def run_task(self, task: PeriodicTask) -> float:
+        start = self.clock()
+        jitter = start - task.deadline
+        task.jitter.record(jitter)
+        self.jitter.record(jitter)
+
+        result = task.callback(task.deadline)
+        if asyncio.iscoroutine(result):
+            await result
+
+        end = self.clock()
+        self.finish_task(task, end - start, end)
+        return end
+
+    def finish_task(self, task: PeriodicTask, runtime: float, end: float):
+        task.runs += 1
+        task.last_runtime = runtime
+        task.total_runtime += runtime
+        if runtime > task.max_runtime:
+            task.max_runtime = runtime
+
+        task.deadline += task.period
+        # if the task ran past its next release, skip the releases that were missed
+        # instead of running the task several times in a row to catch up
+        if end > task.deadline:
+            task.overruns += 1
+            missed = math.ceil((end - task.deadline) / task.period)
+            task.skipped += missed
+            task.deadline += missed * task.period
+
+    async def run(self):
+        self.start_time = self.clock()
+        for task in self.tasks:
+            task.deadline = self.start_time
+
+        self.running = True
+        while self.running:
+            task = self.next_task()
+            delay = task.deadline - self.clock()
+            if delay > 0:
+                await self.sleep(delay)
+            else:
+                # still give the websocket handlers a chance to run
+                await self.sleep(0)
+            await self.run_task(task)
+
+    # makes run() return after the task that's currently running
+    def stop(self):
+        self.running = False
+
+    def stats(self) -> dict:
+        return {
+            "uptime": (
+                round(self.clock() - self.start_time, 3)
+                if self.start_time is not None
+                else 0
+            ),
+            "jitter": self.jitter.as_dict(),
+            "tasks": {task.name: task.stats() for task in self.tasks},
+        }
+
+
+def main():
+    scheduler = Scheduler()
+
+    def fast_task(now):
+        pass
+
+    def slow_task(now):
+        # pretend to do some blocking work to cause an overrun
+        sleep(0.15)
+
+    async def print_stats(now):
+        print(scheduler.stats())
+
+    scheduler.add_task("fast", 100, fast_task)
+    scheduler.add_task("slow", 10, slow_task)
+    scheduler.add_task("stats", 1, print_stats)
+    asyncio.run(scheduler.run())
+
+
+if __name__ == "__main__":
+    main()
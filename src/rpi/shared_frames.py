@@ -0,0 +1,134 @@
+from multiprocessing import shared_memory
+import numpy as np
+
+# largest frame the camera sends (height, width, channels)
+MAX_FRAME_SHAPE = (480, 854, 3)
+# how many times a reader retries when the writer changed the data mid-read
+MAX_READ_ATTEMPTS = 5
+
+# both structures below are single writer, single reader and don't use any locks. the
+# writer bumps a version counter to an odd number before writing and back to an even
+# number afterwards, so a reader knows to retry if the version is odd or changed while
+# it was copying (a seqlock)
+
+
+# a ring of decoded frames in shared memory, the writer never waits for the reader.
+# each frame is stored packed in its own shape, so a grayscale frame only takes up (and
+# costs copying) a third of what a colour one does
+class FrameRing:
+    # per slot header: version, frame sequence number, height, width, channels (0 for a
+    # 2D grayscale frame)
+    SLOT_FIELDS = 5
+
+    def __init__(self, num_slots=3, max_shape=MAX_FRAME_SHAPE, name=None):
+        self.num_slots = num_slots
+        self.max_shape = max_shape
+        header_size = 8 * num_slots * self.SLOT_FIELDS
+        frames_size = num_slots * int(np.prod(max_shape))
+
+        if name is None:
+            self.shm = shared_memory.SharedMemory(
+                create=True, size=header_size + frames_size
+            )
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+        self.name = self.shm.name
+
+        self.header = np.ndarray(
+            (num_slots, self.SLOT_FIELDS), dtype=np.int64, buffer=self.shm.buf
+        )
+        self.frames = np.ndarray(
+            (num_slots, int(np.prod(max_shape))),
+            dtype=np.uint8,
+            buffer=self.shm.buf,
+            offset=header_size,
+        )
+        if name is None:
+            self.header[:] = 0
+            # no frame has been written to any of the slots yet
+            self.header[:, 1] = -1
+
+    def write(self, frame_seq: int, frame: np.ndarray):
+        height, width = frame.shape[:2]
+        channels = frame.shape[2] if frame.ndim == 3 else 0
+        slot = frame_seq % self.num_slots
+        header = self.header[slot]
+
+        header[0] += 1
+        self.frames[slot, : frame.size].reshape(frame.shape)[...] = frame
+        header[1] = frame_seq
+        header[2] = height
+        header[3] = width
+        header[4] = channels
+        header[0] += 1
+
+    # returns a copy of the frame with the given sequence number, or None if it has
+    # already been overwritten
+    def read(self, frame_seq: int):
+        slot = frame_seq % self.num_slots
+        header = self.header[slot]
+        for _ in range(MAX_READ_ATTEMPTS):
+            version = header[0]
+            if version % 2 == 1:
+                continue
+            if header[1] != frame_seq:
+                return None
+            height, width, channels = header[2], header[3], header[4]
+            shape = (height, width, channels) if channels else (height, width)
+            frame = self.frames[slot, : height * width * max(channels, 1)].copy()
+            frame = frame.reshape(shape)
+            if header[0] == version:
+                return frame
+        return None
+
+    def close(self):
+        self.shm.close()
+
+    def unlink(self):
+        self.shm.unlink()
+
+
+# the most recent detection result
+class ResultSlot:
+    # version, frame sequence number, x, y, width, height
+    FIELDS = 6
+
+    def __init__(self, name=None):
+        if name is None:
+            self.shm = shared_memory.SharedMemory(create=True, size=8 * self.FIELDS)
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+        self.name = self.shm.name
+
+        self.values = np.ndarray((self.FIELDS,), dtype=np.float64, buffer=self.shm.buf)
+        if name is None:
+            self.values[:] = np.nan
+            self.values[0] = 0
+            self.values[1] = -1
+
+    # the coordinates can be None when the square wasn't found
+    def write(self, frame_seq: int, x, y, width, height):
+        values = self.values
+        values[0] += 1
+        values[1] = frame_seq
+        values[2:6] = [np.nan if v is None else v for v in (x, y, width, height)]
+        values[0] += 1
+
+    # returns (frame sequence number, x, y, width, height)
+    def read(self) -> tuple:
+        for _ in range(MAX_READ_ATTEMPTS):
+            version = self.values[0]
+            if version % 2 == 1:
+                continue
+            values = self.values.copy()
+            if self.values[0] == version:
+                frame_seq = int(values[1])
+                coords = tuple(None if np.isnan(v) else int(v) for v in values[2:6])
+                return (frame_seq, *coords)
+        return (-1, None, None, None, None)
+
+    def close(self):
+        self.shm.close()
+
+    def unlink(self):
+        self.shm.unlink()
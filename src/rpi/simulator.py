@@ -0,0 +1,408 @@
+import argparse
+import asyncio
+from hal import FakeBackend
+from imu import BODY_TO_SENSOR, sensor_quaternion
+from main import main_server
+import math
+from motors import MOTOR_CHANNEL_TABLE, NEUTRAL_PULSE, PULSE_RANGE
+import numpy as np
+from orientation import quaternion_multiply, quaternion_to_matrix
+from scheduler import Scheduler
+import tempfile
+from time import monotonic
+import websockets
+from ws_server import WSServer
+
+G = 9.80665
+
+# everything is in the body frame, x forward, y right, z down, relative to the centre
+# of gravity. the world frame is x north, y east, z down (so z is the depth)
+
+# where the thrusters are (m) and which way they push for a positive output, worked out
+# from the signs in motors.ALLOCATION_MATRIX: 0-3 are the vectored horizontal
+# thrusters (front left, front right, back left, back right), 4-7 are the vertical ones
+# (back left, back right, front left, front right) and push down for a positive output
+_DIAGONAL = 1 / math.sqrt(2)
+THRUSTER_POSITIONS = np.array(
+    [
+        [0.15, -0.12, 0],
+        [0.15, 0.12, 0],
+        [-0.15, -0.12, 0],
+        [-0.15, 0.12, 0],
+        [-0.12, -0.15, -0.05],
+        [-0.12, 0.15, -0.05],
+        [0.12, -0.15, -0.05],
+        [0.12, 0.15, -0.05],
+    ]
+)
+THRUSTER_DIRECTIONS = np.array(
+    [
+        [-_DIAGONAL, -_DIAGONAL, 0],
+        [-_DIAGONAL, _DIAGONAL, 0],
+        [_DIAGONAL, -_DIAGONAL, 0],
+        [_DIAGONAL, _DIAGONAL, 0],
+        [0, 0, 1],
+        [0, 0, 1],
+        [0, 0, 1],
+        [0, 0, 1],
+    ]
+)
+
+# T200 thrusters at 12 V, thrust goes roughly with the square of the throttle
+MAX_FORWARD_THRUST = 3.71 * G  # N
+MAX_REVERSE_THRUST = 2.92 * G  # N
+MAX_THRUSTER_CURRENT = 17  # A
+# the ESCs ignore anything within 25 µs of the 1500 µs neutral pulse (out of 400 µs)
+ESC_DEADBAND = 25 / 400
+
+# rough estimates of JONA, tune these against recordings of the real thing
+MASS = 11.5  # kg
+# a little positively buoyant, so it floats back up if it loses power
+BUOYANCY = 1.02 * MASS * G  # N
+# the buoyancy acts above the centre of gravity, which keeps the ROV upright
+CENTRE_OF_BUOYANCY = np.array([0, 0, -0.03])
+INERTIA = np.array([0.25, 0.35, 0.40])  # kg m^2 around x, y, z
+# the water that has to be pushed along with the ROV
+ADDED_MASS = np.array([5.0, 8.0, 12.0, 0.10, 0.15, 0.10])
+# drag in surge, sway, heave, roll, pitch, yaw
+LINEAR_DRAG = np.array([6.0, 10.0, 12.0, 0.8, 1.0, 0.8])
+QUADRATIC_DRAG = np.array([30.0, 45.0, 55.0, 1.5, 1.5, 1.2])
+# how tall the ROV is (m), for working out how much of it is underwater at the surface
+HEIGHT = 0.25
+
+# the tether drags through the water along its whole length, which pulls on the top
+# back of the ROV
+TETHER_ATTACHMENT = np.array([-0.2, 0, -0.1])
+TETHER_ORIGIN = np.array([0, 0, 0])
+TETHER_SLACK = 1.0  # m of tether in the water beyond the straight line distance
+TETHER_DRAG = 0.6  # N per m of tether per (m/s)^2
+
+POOL_DEPTH = 4.0  # m
+WATER_TEMPERATURE = 18  # °C
+
+# the electrical side, as measured by the power monitor
+SUPPLY_VOLTAGE = 12.5  # V at the surface
+TETHER_RESISTANCE = 0.06  # Ω
+IDLE_CURRENT_12V = 0.4  # A
+VOLTAGE_5V = 5.05  # V
+CURRENT_5V = 1.6  # A
+
+# sensor noise (standard deviations)
+DEPTH_NOISE = 0.002  # m
+ANGLE_NOISE = 0.05  # °
+ACCEL_NOISE = 0.02  # m/s^2
+CURRENT_NOISE = 0.05  # A
+
+# longest step the physics is integrated over (s)
+STEP = 0.002
+# how often the physics is advanced and the fake sensors are updated (Hz)
+PHYSICS_RATE = 200
+# how often a camera frame is rendered when the camera is simulated (Hz)
+CAMERA_RATE = 10
+
+
+# rigid body simulation of JONA, driven by the 8 thruster outputs
+class Simulator:
+    def __init__(self, depth=0.5, yaw=0, seed=0):
+        self.time = None
+        self.position = np.array([0, 0, depth], dtype=float)
+        # body to world rotation (w, x, y, z)
+        self.quaternion = np.array(
+            [math.cos(math.radians(yaw) / 2), 0, 0, math.sin(math.radians(yaw) / 2)]
+        )
+        # surge, sway, heave velocity (m/s) and roll, pitch, yaw rate (rad/s)
+        self.velocity = np.zeros(6)
+        # what an accelerometer at the centre of gravity would measure, minus gravity
+        self.acceleration = np.zeros(3)
+        self.thruster_outputs = np.zeros(8)
+        self.rng = np.random.default_rng(seed)
+        # body to world rotation matrix, rewritten every step
+        self.rotation = np.eye(3)
+
+        # maps the 8 thruster forces onto the force and torque on the ROV
+        self.thrust_matrix = np.vstack(
+            (
+                THRUSTER_DIRECTIONS.T,
+                np.cross(THRUSTER_POSITIONS, THRUSTER_DIRECTIONS).T,
+            )
+        )
+        self.inertia = np.concatenate(([MASS] * 3, INERTIA))
+        self.inverse_mass = 1 / (self.inertia + ADDED_MASS)
+
+    # thruster outputs go from -1 to 1, like the motor velocities of MotorMixer
+    def set_thruster_outputs(self, outputs):
+        self.thruster_outputs[:] = outputs
+
+    # force of each thruster (N)
+    def thrusts(self) -> np.ndarray:
+        outputs = self.thruster_outputs
+        throttle = np.clip((np.abs(outputs) - ESC_DEADBAND) / (1 - ESC_DEADBAND), 0, 1)
+        max_thrust = np.where(outputs >= 0, MAX_FORWARD_THRUST, MAX_REVERSE_THRUST)
+        return np.sign(outputs) * max_thrust * throttle**2
+
+    # current of each thruster (A)
+    def currents(self) -> np.ndarray:
+        throttle = np.clip(
+            (np.abs(self.thruster_outputs) - ESC_DEADBAND) / (1 - ESC_DEADBAND), 0, 1
+        )
+        return MAX_THRUSTER_CURRENT * throttle**2.5
+
+    def step(self, dt: float):
+        rotation = quaternion_to_matrix(self.quaternion, self.rotation)
+        # which way is down, in the body frame
+        down = rotation[2]
+        linear_velocity = self.velocity[:3]
+        angular_velocity = self.velocity[3:]
+
+        # less buoyancy when the ROV is partly out of the water
+        submerged = min(max(0.5 + self.position[2] / HEIGHT, 0), 1)
+        buoyancy = BUOYANCY * submerged
+        force = (MASS * G - buoyancy) * down
+        torque = np.cross(CENTRE_OF_BUOYANCY, -buoyancy * down)
+
+        world_velocity = rotation @ linear_velocity
+        tether_length = TETHER_SLACK + np.linalg.norm(self.position - TETHER_ORIGIN)
+        tether_force = rotation.T @ (
+            -TETHER_DRAG
+            * tether_length
+            * np.linalg.norm(world_velocity)
+            * world_velocity
+        )
+        force = force + tether_force
+        torque = torque + np.cross(TETHER_ATTACHMENT, tether_force)
+
+        # rigid body coriolis and centripetal terms
+        force -= MASS * np.cross(angular_velocity, linear_velocity)
+        torque -= np.cross(angular_velocity, INERTIA * angular_velocity)
+
+        wrench = np.concatenate((force, torque))
+        wrench += self.thrust_matrix @ self.thrusts()
+        wrench -= (LINEAR_DRAG + QUADRATIC_DRAG * np.abs(self.velocity)) * self.velocity
+
+        acceleration = wrench * self.inverse_mass
+        self.acceleration = acceleration[:3] + np.cross(
+            angular_velocity, linear_velocity
+        )
+        self.velocity += acceleration * dt
+
+        self.position += rotation @ self.velocity[:3] * dt
+        spin = np.concatenate(([0], self.velocity[3:]))
+        self.quaternion += 0.5 * quaternion_multiply(self.quaternion, spin) * dt
+        self.quaternion /= np.linalg.norm(self.quaternion)
+
+        # the pool floor stops it from going any deeper
+        if self.position[2] > POOL_DEPTH:
+            self.position[2] = POOL_DEPTH
+            world_velocity = rotation @ self.velocity[:3]
+            world_velocity[2] = min(world_velocity[2], 0)
+            self.velocity[:3] = rotation.T @ world_velocity
+
+    # simulates up to the given time, in steps of at most STEP
+    def advance_to(self, time: float):
+        if self.time is None:
+            self.time = time
+            return
+        while self.time < time:
+            dt = min(STEP, time - self.time)
+            self.step(dt)
+            self.time += dt
+
+    @property
+    def depth(self) -> float:
+        return self.position[2]
+
+    # yaw, pitch, roll in degrees (z-y-x order). positive pitch is nose up and
+    # positive roll is right side down
+    def euler(self) -> (float, float, float):
+        rotation = quaternion_to_matrix(self.quaternion)
+        yaw = math.degrees(math.atan2(rotation[1, 0], rotation[0, 0]))
+        pitch = math.degrees(math.asin(max(min(-rotation[2, 0], 1), -1)))
+        roll = math.degrees(math.atan2(rotation[2, 1], rotation[2, 2]))
+        return yaw, pitch, roll
+
+    # reads the thruster outputs back from what Motors wrote to the PWM controller
+    def read_thruster_outputs(self, pwm):
+        for motor_num, channel in MOTOR_CHANNEL_TABLE.items():
+            pulse_width = pwm.pulse_width(channel)
+            self.thruster_outputs[motor_num] = (
+                0
+                if pulse_width is None
+                else (pulse_width - NEUTRAL_PULSE) / PULSE_RANGE
+            )
+
+    # sets the fake devices to what the real sensors would be reading right now
+    def update_devices(self, backend: FakeBackend):
+        noise = self.rng.normal
+        backend.depth_bus.set(self.depth + noise(0, DEPTH_NOISE), WATER_TEMPERATURE)
+
+        yaw, pitch, roll = self.euler()
+        current_12V = IDLE_CURRENT_12V + np.sum(self.currents())
+        rotation = quaternion_to_matrix(self.quaternion)
+        # the same noise on the quaternion, as a small rotation of the body
+        attitude = quaternion_multiply(
+            self.quaternion, (1, *noise(0, math.radians(ANGLE_NOISE) / 2, 3))
+        )
+        # the IMU is mounted so that a level ROV reads a pitch of 90°, and its roll
+        # goes the other way to the mixer's
+        backend.fake_imu.set(
+            gyro=np.degrees(self.velocity[3:]),
+            euler=(
+                (yaw + noise(0, ANGLE_NOISE)) % 360,
+                -roll + noise(0, ANGLE_NOISE),
+                pitch + 90 + noise(0, ANGLE_NOISE),
+            ),
+            quaternion=sensor_quaternion(attitude / np.linalg.norm(attitude)),
+            # the IMU measures in its own frame, see imu.BODY_TO_SENSOR
+            linear_acceleration=BODY_TO_SENSOR
+            @ (self.acceleration + noise(0, ACCEL_NOISE, 3)),
+            gravity=BODY_TO_SENSOR @ rotation[2] * G,
+            temperature=25 + current_12V * 0.2,
+        )
+
+        backend.fake_adc.set_rails(
+            voltage_5V=VOLTAGE_5V,
+            current_5V=CURRENT_5V + noise(0, CURRENT_NOISE),
+            voltage_12V=SUPPLY_VOLTAGE - TETHER_RESISTANCE * current_12V,
+            current_12V=current_12V + noise(0, CURRENT_NOISE),
+        )
+
+
+# simulated time that runs at a multiple of real time, or as fast as possible if speed
+# is None. passed to the Scheduler as both its clock and its sleep
+class SimulatedClock:
+    def __init__(self, speed=1.0):
+        self.speed = speed
+        self.now = 0.0
+        self.real_start = monotonic()
+
+    def __call__(self) -> float:
+        return self.now
+
+    async def sleep(self, delay: float):
+        if delay > 0:
+            self.now += delay
+        if self.speed is None:
+            # still give the websocket handlers a chance to run
+            await asyncio.sleep(0)
+        else:
+            real_delay = self.now / self.speed - (monotonic() - self.real_start)
+            await asyncio.sleep(max(real_delay, 0))
+
+
+# runs main_server closed loop against the simulator, duration is in simulated seconds.
+# camera is called with the simulator at CAMERA_RATE to stream what the camera sees.
+# the flight recorder's sessions go in recordings_dir, a new temporary directory by
+# default so simulated dives never mix with (or rotate out) the real ones
+async def run_simulation(
+    simulator: Simulator,
+    clock: SimulatedClock,
+    duration=None,
+    camera=None,
+    recordings_dir=None,
+):
+    if recordings_dir is None:
+        recordings_dir = tempfile.mkdtemp(prefix="jona-rov-simulation-")
+    print(f"Recording to {recordings_dir}")
+    backend = FakeBackend()
+    scheduler = Scheduler(clock=clock, sleep=clock.sleep)
+
+    def physics(now):
+        simulator.read_thruster_outputs(backend.fake_pwm)
+        simulator.advance_to(now)
+        simulator.update_devices(backend)
+        if duration is not None and now >= duration:
+            scheduler.stop()
+
+    # added before main_server's tasks so the sensors are updated first on every tick
+    scheduler.add_task("physics", PHYSICS_RATE, physics)
+    if camera is not None:
+        scheduler.add_task("camera", CAMERA_RATE, lambda now: camera(simulator))
+    simulator.advance_to(clock())
+    simulator.update_devices(backend)
+    await main_server(backend, scheduler, recordings_dir)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Run the ROV's control code against a simulated ROV"
+    )
+    parser.add_argument(
+        "--speed",
+        type=float,
+        default=1,
+        help="multiple of real time to run at, 0 to run as fast as possible",
+    )
+    parser.add_argument("--depth", type=float, default=0.5, help="starting depth (m)")
+    parser.add_argument(
+        "--duration", type=float, default=None, help="simulated seconds to run for"
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument(
+        "--camera",
+        action="store_true",
+        help="render the camera stream and run the vision process on it, so "
+        "autonomous mode can be tested",
+    )
+    parser.add_argument(
+        "--recordings",
+        default=None,
+        help="where the flight recorder keeps its sessions, a new temporary "
+        "directory by default",
+    )
+    args = parser.parse_args()
+
+    simulator = Simulator(depth=args.depth, seed=args.seed)
+    clock = SimulatedClock(args.speed if args.speed > 0 else None)
+
+    camera = None
+    if args.camera:
+        # synthetic_camera imports this module, so it's only imported when it's used
+        from autonomous import ImageHandler
+        from synthetic_camera import (
+            CAMERA_PORT,
+            CameraRenderer,
+            CameraServer,
+            RestorationSite,
+        )
+
+        renderer = CameraRenderer(RestorationSite(), seed=args.seed)
+
+        def camera(simulator: Simulator):
+            CameraServer.send_frame(
+                renderer.render_jpeg(simulator.position, simulator.quaternion)
+            )
+
+        # the vision process has to be started before any other threads are
+        ImageHandler.start_process(f"ws://localhost:{CAMERA_PORT}")
+
+    async def run():
+        async with websockets.serve(
+            WSServer.handler, "0.0.0.0", args.port, ping_interval=None
+        ):
+            if camera is None:
+                await run_simulation(
+                    simulator, clock, args.duration, recordings_dir=args.recordings
+                )
+                return
+            async with websockets.serve(
+                CameraServer.handler, "0.0.0.0", CAMERA_PORT, ping_interval=None
+            ):
+                await run_simulation(
+                    simulator, clock, args.duration, camera, args.recordings
+                )
+
+    asyncio.run(run())
+    yaw, pitch, roll = simulator.euler()
+    print(
+        f"Simulated {clock():.1f} s in {monotonic() - clock.real_start:.1f} s, "
+        f"ended at a depth of {simulator.depth:.2f} m, yaw: {yaw:.1f}° "
+        f"pitch: {pitch:.1f}° roll: {roll:.1f}°"
+    )
+
+
+if __name__ == "__main__":
+    try:
+        main()
+    except KeyboardInterrupt:
+        print("")
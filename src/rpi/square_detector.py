@@ -0,0 +1,158 @@
+try:
+    import ncnn
+except ImportError:
+    # decode_detections() and non_max_suppression() still work without it
+    print("Try pip install ncnn")
+import cv2
+import numpy as np
+import os
+
+# what the model was exported with (see metadata.yaml in the model's directory)
+INPUT_SIZE = 320
+INPUT_NAME = "in0"
+OUTPUT_NAME = "out0"
+# the same defaults as ultralytics' predict()
+CONFIDENCE_THRESHOLD = 0.25
+IOU_THRESHOLD = 0.7
+# the grey that the image is padded out to a square with
+PAD_VALUE = 114
+# the vision process shares the Pi with the control loop, so leave it a core
+NUM_THREADS = 3
+
+
+# turns the model's raw output into boxes, the output has a column per anchor holding
+# the box's centre x, centre y, width and height (in input pixels) and then a score
+# for each class. returns the boxes (x1, y1, x2, y2) and scores of the anchors whose
+# best score is at least confidence_threshold
+def decode_detections(
+    output: np.ndarray, confidence_threshold=CONFIDENCE_THRESHOLD
+) -> (np.ndarray, np.ndarray):
+    scores = output[4:].max(axis=0)
+    keep = np.flatnonzero(scores >= confidence_threshold)
+    centre_x, centre_y, width, height = output[:4, keep]
+    half_width = width / 2
+    half_height = height / 2
+    boxes = np.stack(
+        (
+            centre_x - half_width,
+            centre_y - half_height,
+            centre_x + half_width,
+            centre_y + half_height,
+        ),
+        axis=1,
+    )
+    return boxes, scores[keep]
+
+
+# the indices of the boxes to keep, best first. each pass keeps the best box left and
+# drops every other box overlapping it by more than iou_threshold, so there are only
+# ever as many passes as boxes kept
+def non_max_suppression(
+    boxes: np.ndarray, scores: np.ndarray, iou_threshold=IOU_THRESHOLD, max_detections=1
+) -> np.ndarray:
+    order = np.argsort(-scores)
+    areas = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+    keep = []
+    while order.size > 0 and len(keep) < max_detections:
+        best = order[0]
+        keep.append(best)
+        rest = order[1:]
+        overlap_width = np.minimum(boxes[best, 2], boxes[rest, 2]) - np.maximum(
+            boxes[best, 0], boxes[rest, 0]
+        )
+        overlap_height = np.minimum(boxes[best, 3], boxes[rest, 3]) - np.maximum(
+            boxes[best, 1], boxes[rest, 1]
+        )
+        intersection = np.maximum(overlap_width, 0) * np.maximum(overlap_height, 0)
+        union = areas[best] + areas[rest] - intersection
+        # boxes with no area don't overlap anything
+        iou = intersection / np.maximum(union, np.finfo(np.float32).tiny)
+        order = rest[iou <= iou_threshold]
+    return np.array(keep, dtype=int)
+
+
+# runs the YOLO square detection model with NCNN directly, rather than through
+# ultralytics, which does a lot of work on every frame that isn't needed here. the
+# model is loaded once and the input is letterboxed straight into a buffer that NCNN
+# reads from
+class SquareDetector:
+    def __init__(self, model_dir: str, input_size=INPUT_SIZE, num_threads=NUM_THREADS):
+        self.input_size = input_size
+        self.net = ncnn.Net()
+        self.net.opt.num_threads = num_threads
+        self.net.opt.use_vulkan_compute = False
+        self.net.load_param(os.path.join(model_dir, "model.ncnn.param"))
+        self.net.load_model(os.path.join(model_dir, "model.ncnn.bin"))
+
+        # RGB, channels first and scaled to 0..1, the Mat shares the array's memory
+        self.input = np.empty((3, input_size, input_size), dtype=np.float32)
+        self.input_mat = ncnn.Mat(self.input)
+        # where the last image went in the input (left, top, scale), the padding only
+        # has to be redrawn when the image's size changes
+        self.image_shape = None
+        self.resized_size = None
+        self.left = 0
+        self.top = 0
+        self.scale = 1
+
+    # scales the image down to fit in the input, keeping its aspect ratio, and pads it
+    # out to a square. the same as ultralytics' LetterBox. img is BGR or grayscale, a
+    # grayscale image goes into all three channels like it had been converted to BGR
+    def letterbox(self, img: np.ndarray):
+        if img.shape != self.image_shape:
+            height, width = img.shape[:2]
+            self.scale = min(self.input_size / height, self.input_size / width)
+            self.resized_size = (round(width * self.scale), round(height * self.scale))
+            pad_x = (self.input_size - self.resized_size[0]) / 2
+            pad_y = (self.input_size - self.resized_size[1]) / 2
+            self.left = round(pad_x - 0.1)
+            self.top = round(pad_y - 0.1)
+            self.input.fill(PAD_VALUE / 255)
+            self.image_shape = img.shape
+
+        resized = cv2.resize(img, self.resized_size, interpolation=cv2.INTER_LINEAR)
+        resized_width, resized_height = self.resized_size
+        region = self.input[
+            :,
+            self.top : self.top + resized_height,
+            self.left : self.left + resized_width,
+        ]
+        # BGR to RGB and HWC to CHW (or gray to all three channels) are all just views,
+        # so this is the only copy
+        if resized.ndim == 2:
+            pixels = resized[None]
+        else:
+            pixels = resized[:, :, ::-1].transpose(2, 0, 1)
+        np.multiply(pixels, 1 / 255, out=region)
+
+    # returns up to max_detections squares in the image as (x1, y1, x2, y2, score),
+    # best first, in the image's pixels
+    def detect(
+        self,
+        img: np.ndarray,
+        max_detections=1,
+        confidence_threshold=CONFIDENCE_THRESHOLD,
+        iou_threshold=IOU_THRESHOLD,
+    ) -> list:
+        self.letterbox(img)
+        with self.net.create_extractor() as extractor:
+            extractor.input(INPUT_NAME, self.input_mat)
+            _, output = extractor.extract(OUTPUT_NAME)
+        boxes, scores = decode_detections(np.array(output), confidence_threshold)
+        if len(scores) == 0:
+            return []
+        keep = non_max_suppression(boxes, scores, iou_threshold, max_detections)
+        boxes = boxes[keep]
+        scores = scores[keep]
+
+        # back to the image's pixels
+        boxes[:, [0, 2]] -= self.left
+        boxes[:, [1, 3]] -= self.top
+        boxes /= self.scale
+        height, width = img.shape[:2]
+        boxes[:, [0, 2]] = np.clip(boxes[:, [0, 2]], 0, width)
+        boxes[:, [1, 3]] = np.clip(boxes[:, [1, 3]], 0, height)
+        return [
+            (x1, y1, x2, y2, score)
+            for (x1, y1, x2, y2), score in zip(boxes.tolist(), scores.tolist())
+        ]
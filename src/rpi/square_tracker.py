@@ -0,0 +1,271 @@
+import cv2
+import numpy as np
+
+# the detector is run at least this often (frames), the box is tracked in between
+DETECTION_INTERVAL = 5
+# the detector is run again as soon as the track's confidence drops below this. the
+# confidence starts at the detection's score and is scaled by the fraction of points
+# that survive each tracked frame
+MIN_CONFIDENCE = 0.4
+# the points followed on and around the square, found with goodFeaturesToTrack
+MAX_POINTS = 50
+POINT_QUALITY = 0.01
+MIN_POINT_DISTANCE = 3
+# the square itself is mostly flat colour, so points are also looked for a little way
+# past its edges (fraction of the box's size) where its corners are
+POINT_MARGIN = 0.15
+# fewer points than this left and the track is lost
+MIN_POINTS = 6
+# points that don't come back to where they started when tracked backwards (px) are
+# dropped, which catches most of the points that slid off what they were on
+MAX_FORWARD_BACKWARD_ERROR = 1.0
+# pyramidal Lucas-Kanade optical flow
+FLOW_WINDOW_SIZE = (15, 15)
+FLOW_PYRAMID_LEVELS = 2
+FLOW_CRITERIA = (cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT, 10, 0.03)
+
+# once the square's been found, the detector only searches the part of the frame around
+# where it's expected to be, which the model sees without it being scaled down. the
+# margin on each side is this much of the box's size...
+ROI_MARGIN = 0.5
+# ...plus how far the square moves in this many frames at its recent velocity
+ROI_LOOKAHEAD = 3
+# the smallest region that's searched (px), so a far away square is scaled up at most
+# 2x to fill the model's input
+MIN_ROI_SIZE = 160
+# how much of each new measurement of the square's velocity is taken (0..1)
+VELOCITY_SMOOTHING = 0.5
+# the whole frame is searched again after this many searches around it in a row miss
+MAX_ROI_MISSES = 2
+
+
+# follows the square between detections so that its position is known for every frame,
+# rather than only for the frames the detector has time for. the box is moved and
+# scaled with the median motion of a few points on and around it, tracked from one
+# grayscale frame to the next with sparse optical flow (a median flow tracker). when the
+# detector is run, it's only given the region around where the square should be, until
+# it misses a few times in a row
+class SquareTracker:
+    # detect takes a frame, or a region of one, and returns the square in it as
+    # (x1, y1, x2, y2, score) or None. it's run every detection_interval frames, when
+    # the confidence drops below min_confidence and whenever the track is lost
+    def __init__(
+        self,
+        detect,
+        detection_interval=DETECTION_INTERVAL,
+        min_confidence=MIN_CONFIDENCE,
+    ):
+        self.detect = detect
+        self.detection_interval = detection_interval
+        self.min_confidence = min_confidence
+
+        # x1, y1, x2, y2 of the square in the last frame, None when it's not known
+        self.box = None
+        self.confidence = 0
+        self.frames_since_detection = 0
+        # the last frame and the points being tracked in it
+        self.last_gray = None
+        self.points = None
+        # where the points should be looked for, reused for every frame of the same size
+        self.mask = None
+
+        # the box the square was last seen at, which isn't forgotten until the whole
+        # frame's been searched for it, the frame it was seen in and how fast its
+        # center was moving then (px per frame)
+        self.frame_count = 0
+        self.last_box = None
+        self.last_seen = 0
+        self.velocity = np.zeros(2)
+        # searches around the last box that have missed the square since it was seen
+        self.misses = 0
+
+        # how many frames went to each, for working out the detect/track ratio
+        self.detections = 0
+        self.tracked_frames = 0
+
+    # returns the square in the grayscale frame as (x1, y1, x2, y2, score), or None if
+    # it can't be found
+    def update(self, gray: np.ndarray):
+        self.frame_count += 1
+        box = None
+        if (
+            self.box is not None
+            and self.points is not None
+            and self.frames_since_detection < self.detection_interval
+        ):
+            box = self.track(gray)
+        if box is None:
+            box = self.redetect(gray)
+        if box is not None:
+            self.remember(box)
+        self.last_gray = gray
+        return box
+
+    # forgets the square, e.g. when the vision process stops listening
+    def reset(self):
+        self.lose_track()
+        self.last_box = None
+        self.misses = 0
+
+    def lose_track(self):
+        self.box = None
+        self.confidence = 0
+        self.last_gray = None
+        self.points = None
+
+    def remember(self, box):
+        new_box = np.array(box[:4])
+        if self.last_box is not None:
+            frames = self.frame_count - self.last_seen
+            center = (new_box[:2] + new_box[2:]) / 2
+            last_center = (self.last_box[:2] + self.last_box[2:]) / 2
+            velocity = (center - last_center) / frames
+            self.velocity += VELOCITY_SMOOTHING * (velocity - self.velocity)
+        else:
+            self.velocity.fill(0)
+        self.last_box = new_box
+        self.last_seen = self.frame_count
+        self.misses = 0
+
+    # the region of the frame (x1, y1, x2, y2) the square should be in, None if the
+    # whole frame has to be searched
+    def search_region(self, shape: tuple):
+        if self.last_box is None or self.misses >= MAX_ROI_MISSES:
+            return None
+        height, width = shape[:2]
+        frames = self.frame_count - self.last_seen
+        x1, y1, x2, y2 = self.last_box
+        # where the square would be now if it had kept moving the same way
+        center_x = (x1 + x2) / 2 + self.velocity[0] * frames
+        center_y = (y1 + y2) / 2 + self.velocity[1] * frames
+        speed_x, speed_y = np.abs(self.velocity) * (frames + ROI_LOOKAHEAD)
+        half_width = max((x2 - x1) * (0.5 + ROI_MARGIN) + speed_x, MIN_ROI_SIZE / 2)
+        half_height = max((y2 - y1) * (0.5 + ROI_MARGIN) + speed_y, MIN_ROI_SIZE / 2)
+        if 2 * half_width >= width and 2 * half_height >= height:
+            return None
+        # moved back inside the frame rather than cut off, so it's never too small
+        left = round(min(max(center_x - half_width, 0), max(width - 2 * half_width, 0)))
+        top = round(
+            min(max(center_y - half_height, 0), max(height - 2 * half_height, 0))
+        )
+        right = min(left + round(2 * half_width), width)
+        bottom = min(top + round(2 * half_height), height)
+        return left, top, right, bottom
+
+    def redetect(self, gray: np.ndarray):
+        self.detections += 1
+        self.frames_since_detection = 0
+        region = self.search_region(gray.shape)
+        if region is None:
+            detection = self.detect(gray)
+        else:
+            left, top, right, bottom = region
+            detection = self.detect(gray[top:bottom, left:right])
+            if detection is not None:
+                x1, y1, x2, y2, score = detection
+                detection = (x1 + left, y1 + top, x2 + left, y2 + top, score)
+        if detection is None:
+            self.lose_track()
+            if region is None:
+                # it's nowhere in the frame
+                self.last_box = None
+            else:
+                self.misses += 1
+            return None
+        *box, score = detection
+        self.box = np.array(box, dtype=np.float32)
+        self.confidence = score
+        self.points = self.find_points(gray)
+        return detection
+
+    # the corners on and around the square worth following, None if there aren't enough
+    def find_points(self, gray: np.ndarray):
+        if self.mask is None or self.mask.shape != gray.shape:
+            self.mask = np.zeros(gray.shape, dtype=np.uint8)
+        else:
+            self.mask.fill(0)
+        x1, y1, x2, y2 = self.box
+        margin_x = (x2 - x1) * POINT_MARGIN
+        margin_y = (y2 - y1) * POINT_MARGIN
+        x1, y1, x2, y2 = (
+            max(round(value), 0)
+            for value in (x1 - margin_x, y1 - margin_y, x2 + margin_x, y2 + margin_y)
+        )
+        self.mask[y1:y2, x1:x2] = 255
+        points = cv2.goodFeaturesToTrack(
+            gray, MAX_POINTS, POINT_QUALITY, MIN_POINT_DISTANCE, mask=self.mask
+        )
+        if points is None or len(points) < MIN_POINTS:
+            return None
+        return points
+
+    # moves the box to where the points went in the new frame, None if it's been lost
+    def track(self, gray: np.ndarray):
+        if self.last_gray is None or self.last_gray.shape != gray.shape:
+            return None
+        points, status, _ = cv2.calcOpticalFlowPyrLK(
+            self.last_gray,
+            gray,
+            self.points,
+            None,
+            winSize=FLOW_WINDOW_SIZE,
+            maxLevel=FLOW_PYRAMID_LEVELS,
+            criteria=FLOW_CRITERIA,
+        )
+        back_points, back_status, _ = cv2.calcOpticalFlowPyrLK(
+            gray,
+            self.last_gray,
+            points,
+            None,
+            winSize=FLOW_WINDOW_SIZE,
+            maxLevel=FLOW_PYRAMID_LEVELS,
+            criteria=FLOW_CRITERIA,
+        )
+        forward_backward_error = np.linalg.norm(
+            (back_points - self.points).reshape(-1, 2), axis=1
+        )
+        good = (
+            (status.ravel() == 1)
+            & (back_status.ravel() == 1)
+            & (forward_backward_error < MAX_FORWARD_BACKWARD_ERROR)
+        )
+        num_good = np.count_nonzero(good)
+        if num_good < MIN_POINTS:
+            return None
+        old_points = self.points.reshape(-1, 2)[good]
+        new_points = points.reshape(-1, 2)[good]
+
+        # the box moves with the median of the points and grows or shrinks with the
+        # median change in their distances from their middle
+        shift = np.median(new_points - old_points, axis=0)
+        old_spread = np.linalg.norm(old_points - np.median(old_points, axis=0), axis=1)
+        new_spread = np.linalg.norm(new_points - np.median(new_points, axis=0), axis=1)
+        spread = old_spread > 0
+        scale = (
+            np.median(new_spread[spread] / old_spread[spread]) if spread.any() else 1
+        )
+
+        x1, y1, x2, y2 = self.box
+        centre_x = (x1 + x2) / 2 + shift[0]
+        centre_y = (y1 + y2) / 2 + shift[1]
+        half_width = (x2 - x1) * scale / 2
+        half_height = (y2 - y1) * scale / 2
+        height, width = gray.shape[:2]
+        # the square's gone out of view
+        if not (0 <= centre_x < width and 0 <= centre_y < height):
+            return None
+
+        self.confidence *= num_good / len(good)
+        if self.confidence < self.min_confidence:
+            return None
+        self.box[:] = (
+            centre_x - half_width,
+            centre_y - half_height,
+            centre_x + half_width,
+            centre_y + half_height,
+        )
+        self.points = new_points.reshape(-1, 1, 2)
+        self.frames_since_detection += 1
+        self.tracked_frames += 1
+        box = np.clip(self.box, 0, (width, height, width, height))
+        return (*box.tolist(), self.confidence)
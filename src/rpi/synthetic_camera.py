@@ -0,0 +1,300 @@
+import asyncio
+from autonomous import SQUARE_HEIGHT
+import cv2
+import math
+import numpy as np
+from orientation import quaternion_to_matrix
+from simulator import POOL_DEPTH
+from websockets import broadcast, serve
+
+# same as the camera stream from camera.py
+FRAME_WIDTH = 854
+FRAME_HEIGHT = 480
+CAMERA_PORT = 3000
+JPEG_QUALITY = 85
+# the rays are cast at a lower resolution and scaled up, the blur hides the difference
+RENDER_SCALE = 0.5
+# the camera's field of view is narrower underwater, looking through the flat port
+HORIZONTAL_FOV = 50  # °
+# where the camera is mounted (body frame, x forward, y right, z down) and how far it's
+# tilted down from looking straight ahead
+CAMERA_POSITION = np.array([0.2, 0, 0])
+CAMERA_TILT = 30  # °
+
+# how quickly blue, green and red light are absorbed by the water (per metre), red goes
+# first which is why the square gets darker the deeper and further away it is
+ATTENUATION = np.array([0.04, 0.06, 0.25], dtype=np.float32)
+# the colour of the light scattered back by the water itself (BGR)
+WATER_COLOUR = np.array([200, 160, 60], dtype=np.float32)
+# how bright the sunlight is just below the surface
+SURFACE_LIGHT = 1.0
+BLUR_SIGMA = 1.2
+NOISE = 4
+
+# the restoration site's dimensions (m) from coral-modeling/main.py. the left and right
+# pipes can be cut to any length
+PLATFORM_WIDTH = 0.36
+PLATFORM_THICKNESS = 0.008
+# the platforms are longer than the pipes to account for the ends
+PLATFORM_EXTRA_LENGTH = 0.058
+LEFT_END_HEIGHT = 0.160
+# the top of the velcro square on the right platform
+RIGHT_END_HEIGHT = SQUARE_HEIGHT - 0.002
+CENTER_BOX_SIZE = 0.36
+VELCRO_SQUARE_SIZE = 0.15
+VELCRO_SQUARE_THICKNESS = 0.002
+
+# BGR
+FLOOR_COLOUR = (170, 165, 150)
+TILE_LINE_COLOUR = (60, 60, 60)
+TILE_SIZE = 0.3
+TILE_LINE_WIDTH = 0.02
+PVC_COLOUR = (225, 225, 225)
+VELCRO_COLOUR = (40, 30, 200)
+
+
+# the coral restoration site, sitting on the pool floor. everything the camera looks
+# down on is a horizontal rectangle: the tops of the center box, the platforms and the
+# velcro square
+class RestorationSite:
+    def __init__(
+        self,
+        position=(2.0, 0.0),
+        yaw=90,
+        left_length=0.3,
+        right_length=0.3,
+        floor_depth=POOL_DEPTH,
+    ):
+        # the world position of the center box and which way the site's left to right
+        # axis points (°, clockwise from north)
+        self.position = np.array(position, dtype=np.float32)
+        self.yaw = math.radians(yaw)
+        self.floor_depth = floor_depth
+
+        half_box = CENTER_BOX_SIZE / 2
+        half_width = PLATFORM_WIDTH / 2
+        right_end = half_box + right_length + PLATFORM_EXTRA_LENGTH
+        # the square is pushed up against the right edge of the right platform
+        half_square = VELCRO_SQUARE_SIZE / 2
+        # (x0, x1, y0, y1) in the site's frame, height above the floor, colour
+        self.surfaces = [
+            (
+                (-half_box, half_box, -half_box, half_box),
+                LEFT_END_HEIGHT,
+                PVC_COLOUR,
+            ),
+            (
+                (
+                    -half_box - left_length - PLATFORM_EXTRA_LENGTH,
+                    -half_box,
+                    -half_width,
+                    half_width,
+                ),
+                LEFT_END_HEIGHT + PLATFORM_THICKNESS,
+                PVC_COLOUR,
+            ),
+            (
+                (half_box, right_end, -half_width, half_width),
+                RIGHT_END_HEIGHT - VELCRO_SQUARE_THICKNESS,
+                PVC_COLOUR,
+            ),
+            (
+                (right_end - VELCRO_SQUARE_SIZE, right_end, -half_square, half_square),
+                RIGHT_END_HEIGHT,
+                VELCRO_COLOUR,
+            ),
+        ]
+
+    # the world position of the middle of the velcro square
+    def square_position(self) -> np.ndarray:
+        (x0, x1, y0, y1), height, _ = self.surfaces[-1]
+        x = (x0 + x1) / 2
+        y = (y0 + y1) / 2
+        cos_yaw = math.cos(self.yaw)
+        sin_yaw = math.sin(self.yaw)
+        return np.array(
+            [
+                self.position[0] + x * cos_yaw - y * sin_yaw,
+                self.position[1] + x * sin_yaw + y * cos_yaw,
+                self.floor_depth - height,
+            ]
+        )
+
+    # world x, y to the site's frame
+    def to_site(self, x: np.ndarray, y: np.ndarray) -> (np.ndarray, np.ndarray):
+        x = x - self.position[0]
+        y = y - self.position[1]
+        cos_yaw = math.cos(self.yaw)
+        sin_yaw = math.sin(self.yaw)
+        return x * cos_yaw + y * sin_yaw, -x * sin_yaw + y * cos_yaw
+
+
+# renders what the ROV's camera would see of the pool and the restoration site by
+# casting a ray through every pixel
+class CameraRenderer:
+    def __init__(
+        self,
+        site: RestorationSite,
+        width=FRAME_WIDTH,
+        height=FRAME_HEIGHT,
+        fov=HORIZONTAL_FOV,
+        tilt=CAMERA_TILT,
+        scale=RENDER_SCALE,
+        seed=0,
+    ):
+        self.site = site
+        self.width = width
+        self.height = height
+        self.render_width = round(width * scale)
+        self.render_height = round(height * scale)
+        # numpy's normal() is several times slower than OpenCV's for a whole frame
+        cv2.setRNGSeed(seed)
+        self.noise = np.empty((height, width, 3), dtype=np.float32)
+
+        # the direction of each pixel's ray in the camera's frame (x right, y down,
+        # z forward), these never change so they're worked out once
+        focal_length = self.render_width / 2 / math.tan(math.radians(fov) / 2)
+        u, v = np.meshgrid(
+            np.arange(self.render_width, dtype=np.float32) - (self.render_width - 1) / 2,
+            np.arange(self.render_height, dtype=np.float32)
+            - (self.render_height - 1) / 2,
+        )
+        camera_rays = np.stack(
+            (u.ravel(), v.ravel(), np.full(u.size, focal_length, np.float32))
+        )
+        camera_rays /= np.linalg.norm(camera_rays, axis=0)
+
+        # from the camera's frame to the body frame, tilted down
+        tilt = math.radians(tilt)
+        camera_to_body = np.array(
+            [
+                [0, -math.sin(tilt), math.cos(tilt)],
+                [1, 0, 0],
+                [0, math.cos(tilt), math.sin(tilt)],
+            ],
+            dtype=np.float32,
+        )
+        self.body_rays = camera_to_body @ camera_rays
+
+    # position is in the world frame (z is the depth) and quaternion rotates the body
+    # frame into the world frame, like Simulator's
+    def render(self, position: np.ndarray, quaternion: np.ndarray) -> np.ndarray:
+        rotation = quaternion_to_matrix(quaternion).astype(np.float32)
+        origin = position + rotation @ CAMERA_POSITION
+        rays = rotation @ self.body_rays
+        ray_x, ray_y, ray_z = rays
+
+        # distance along each ray to whatever it hits and the colour of that
+        distance = np.full(ray_x.shape, np.inf, dtype=np.float32)
+        colour = np.empty((ray_x.size, 3), dtype=np.float32)
+        hit_depth = np.empty(ray_x.shape, dtype=np.float32)
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            # the pool floor, with the lines between the tiles
+            floor_distance = (self.site.floor_depth - origin[2]) / ray_z
+            hit = (floor_distance > 0) & np.isfinite(floor_distance)
+            floor_x = origin[0] + ray_x[hit] * floor_distance[hit]
+            floor_y = origin[1] + ray_y[hit] * floor_distance[hit]
+            on_line = (np.mod(floor_x, TILE_SIZE) < TILE_LINE_WIDTH) | (
+                np.mod(floor_y, TILE_SIZE) < TILE_LINE_WIDTH
+            )
+            distance[hit] = floor_distance[hit]
+            colour[hit] = np.where(on_line[:, None], TILE_LINE_COLOUR, FLOOR_COLOUR)
+            hit_depth[hit] = self.site.floor_depth
+
+            for (x0, x1, y0, y1), height, surface_colour in self.site.surfaces:
+                surface_depth = self.site.floor_depth - height
+                surface_distance = (surface_depth - origin[2]) / ray_z
+                site_x, site_y = self.site.to_site(
+                    origin[0] + ray_x * surface_distance,
+                    origin[1] + ray_y * surface_distance,
+                )
+                hit = (
+                    (surface_distance > 0)
+                    & (surface_distance < distance)
+                    & (site_x >= x0)
+                    & (site_x <= x1)
+                    & (site_y >= y0)
+                    & (site_y <= y1)
+                )
+                distance[hit] = surface_distance[hit]
+                colour[hit] = surface_colour
+                hit_depth[hit] = surface_depth
+
+        # the light reaching each surface has come down through the water from the
+        # surface, then the light off the surface fades into the water's own colour on
+        # its way to the camera
+        missed = ~np.isfinite(distance)
+        distance[missed] = 0
+        hit_depth[missed] = max(origin[2], 0)
+        light = SURFACE_LIGHT * np.exp(-np.outer(np.maximum(hit_depth, 0), ATTENUATION))
+        transmission = np.exp(-np.outer(distance, ATTENUATION))
+        camera_light = SURFACE_LIGHT * np.exp(-max(origin[2], 0) * ATTENUATION)
+        pixels = colour * light * transmission + WATER_COLOUR * camera_light * (
+            1 - transmission
+        )
+        # rays that don't hit anything just see the water
+        pixels[missed] = WATER_COLOUR * camera_light
+
+        img = pixels.reshape(self.render_height, self.render_width, 3)
+        img = cv2.resize(img, (self.width, self.height), interpolation=cv2.INTER_LINEAR)
+        img = cv2.GaussianBlur(img, (0, 0), BLUR_SIGMA)
+        cv2.randn(self.noise, (0, 0, 0), (NOISE, NOISE, NOISE))
+        img += self.noise
+        return np.clip(img, 0, 255).astype(np.uint8)
+
+    def render_jpeg(self, position: np.ndarray, quaternion: np.ndarray) -> bytes:
+        img = self.render(position, quaternion)
+        _, buffer = cv2.imencode(".jpg", img, (cv2.IMWRITE_JPEG_QUALITY, JPEG_QUALITY))
+        return buffer.tobytes()
+
+
+# streams the rendered frames the same way camera.py streams the real ones, each frame
+# is a JPEG sent as a single binary message to every client
+class CameraServer:
+    clients = set()
+
+    @classmethod
+    def send_frame(cls, frame: bytes):
+        broadcast(cls.clients, frame)
+
+    @classmethod
+    async def handler(cls, websocket, path=None):
+        print("Client connected!")
+        cls.clients.add(websocket)
+        try:
+            await websocket.wait_closed()
+        finally:
+            cls.clients.discard(websocket)
+            print("Client disconnected!")
+
+
+# streams a view of the ROV slowly flying over the velcro square, standing in for
+# camera.py when there's no camera
+async def fly_over(renderer: CameraRenderer, fps=15):
+    site = renderer.site
+    square = site.square_position()
+    height_above = 0.3
+    # start 2 m before the square and fly straight over it, heading north
+    quaternion = np.array([1, 0, 0, 0])
+    t = 0
+    while True:
+        x = square[0] - 2 + (0.2 * t) % 3
+        position = np.array([x, square[1], square[2] - height_above])
+        CameraServer.send_frame(renderer.render_jpeg(position, quaternion))
+        t += 1 / fps
+        await asyncio.sleep(1 / fps)
+
+
+def main():
+    renderer = CameraRenderer(RestorationSite(position=(0, 0)))
+    loop = asyncio.get_event_loop()
+    ws_server = serve(CameraServer.handler, "0.0.0.0", CAMERA_PORT, ping_interval=None)
+    print("Server started!")
+    asyncio.ensure_future(ws_server)
+    asyncio.ensure_future(fly_over(renderer))
+    loop.run_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,171 @@
+import math
+import struct
+from time import monotonic
+
+# bump whenever the layout below changes so old clients can tell they're out of date
+SCHEMA_ID = 2
+
+KEYFRAME = 0
+DELTA = 1
+
+# schema id, frame type, sequence number, monotonic timestamp (s), flags
+HEADER_FORMAT = "<BBIdH"
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+# a bitmask of the values that differ from the last keyframe
+DELTA_MASK_FORMAT = "<I"
+DELTA_MASK_SIZE = struct.calcsize(DELTA_MASK_FORMAT)
+
+# numeric values sent as 32-bit floats, in order. None is sent as NaN
+VALUE_FIELDS = (
+    "internal_temp",
+    "external_temp",
+    "depth",
+    "yaw",
+    "roll",
+    "pitch",
+    "x_accel",
+    "y_accel",
+    "z_accel",
+    "voltage_5V",
+    "current_5V",
+    "voltage_12V",
+    "current_12V",
+    "speed_multiplier",
+    "throttle_limit_factor",
+    # joystick to thruster latency in milliseconds (see latency.py)
+    "input_latency_p50",
+    "input_latency_p99",
+)
+VALUES_FORMAT = f"<{len(VALUE_FIELDS)}f"
+
+# boolean values packed into the flags of the header, by bit
+ANCHOR_FLAGS = (
+    "depth_anchor_enabled",
+    "yaw_anchor_enabled",
+    "roll_anchor_enabled",
+    "pitch_anchor_enabled",
+)
+MOTOR_LOCK_FLAGS = ("x", "y", "z", "yaw", "pitch", "roll")
+
+# how often a full frame is sent when delta encoding is used
+KEYFRAME_INTERVAL = 20
+
+
+def pack_flags(status_info: dict) -> int:
+    flags = 0
+    for bit, name in enumerate(ANCHOR_FLAGS):
+        if status_info[name]:
+            flags |= 1 << bit
+    motor_locks = status_info["motor_lock_enabled"]
+    for bit, name in enumerate(MOTOR_LOCK_FLAGS, start=len(ANCHOR_FLAGS)):
+        if motor_locks[name]:
+            flags |= 1 << bit
+    return flags
+
+
+def unpack_flags(flags: int) -> dict:
+    status_info = {}
+    for bit, name in enumerate(ANCHOR_FLAGS):
+        status_info[name] = bool(flags & (1 << bit))
+    status_info["motor_lock_enabled"] = {
+        name: bool(flags & (1 << bit))
+        for bit, name in enumerate(MOTOR_LOCK_FLAGS, start=len(ANCHOR_FLAGS))
+    }
+    return status_info
+
+
+# turns the status info dict sent to the web client into binary frames. every frame
+# has the same header, followed by either all the values (keyframe) or a mask and only
+# the values that changed since the last keyframe (delta)
+class TelemetryEncoder:
+    def __init__(self, use_delta=True, keyframe_interval=KEYFRAME_INTERVAL):
+        self.use_delta = use_delta
+        self.keyframe_interval = keyframe_interval
+        self.seq = 0
+        # packed values of the last keyframe
+        self.keyframe_values = None
+        self.frames_since_keyframe = 0
+
+    # the next frame will be a keyframe, needed whenever a new client connects
+    def reset(self):
+        self.keyframe_values = None
+
+    def encode(self, status_info: dict, timestamp=None) -> bytes:
+        if timestamp is None:
+            timestamp = monotonic()
+        values = struct.pack(
+            VALUES_FORMAT,
+            *(
+                math.nan if status_info.get(name) is None else status_info[name]
+                for name in VALUE_FIELDS
+            ),
+        )
+        flags = pack_flags(status_info)
+
+        if (
+            not self.use_delta
+            or self.keyframe_values is None
+            or self.frames_since_keyframe >= self.keyframe_interval
+        ):
+            frame_type = KEYFRAME
+            body = values
+            self.keyframe_values = values
+            self.frames_since_keyframe = 0
+        else:
+            frame_type = DELTA
+            mask = 0
+            changed = []
+            # compare the packed bytes so that NaN == NaN and float32 rounding doesn't
+            # show up as a change
+            for i in range(len(VALUE_FIELDS)):
+                value = values[i * 4 : i * 4 + 4]
+                if value != self.keyframe_values[i * 4 : i * 4 + 4]:
+                    mask |= 1 << i
+                    changed.append(value)
+            body = struct.pack(DELTA_MASK_FORMAT, mask) + b"".join(changed)
+            self.frames_since_keyframe += 1
+
+        header = struct.pack(
+            HEADER_FORMAT, SCHEMA_ID, frame_type, self.seq & 0xFFFFFFFF, timestamp, flags
+        )
+        self.seq += 1
+        return header + body
+
+
+# turns binary frames back into the status info dict, mostly for debugging since the
+# web client has its own decoder
+class TelemetryDecoder:
+    def __init__(self):
+        self.keyframe_values = None
+
+    def decode(self, frame: bytes):
+        schema_id, frame_type, seq, timestamp, flags = struct.unpack_from(
+            HEADER_FORMAT, frame
+        )
+        if schema_id != SCHEMA_ID:
+            print(f"Unknown telemetry schema: {schema_id}")
+            return None
+
+        if frame_type == KEYFRAME:
+            values = list(struct.unpack_from(VALUES_FORMAT, frame, HEADER_SIZE))
+            self.keyframe_values = values
+        elif self.keyframe_values is None:
+            # can't do anything with a delta until the first keyframe arrives
+            return None
+        else:
+            values = list(self.keyframe_values)
+            (mask,) = struct.unpack_from(DELTA_MASK_FORMAT, frame, HEADER_SIZE)
+            offset = HEADER_SIZE + DELTA_MASK_SIZE
+            for i in range(len(VALUE_FIELDS)):
+                if mask & (1 << i):
+                    (values[i],) = struct.unpack_from("<f", frame, offset)
+                    offset += 4
+
+        status_info = {
+            name: None if math.isnan(value) else value
+            for name, value in zip(VALUE_FIELDS, values)
+        }
+        status_info.update(unpack_flags(flags))
+        status_info["seq"] = seq
+        status_info["timestamp"] = timestamp
+        return status_info
@@ -1,25 +1,27 @@
 from time import time, sleep
 
 
+# clock is where the time comes from, e.g. the control tick's clock
 class Timer:
-    def __init__(self):
+    def __init__(self, clock=time):
+        self.clock = clock
         self.elapsed_time = 0
         self.start_time = 0
         self.stopped = True
 
     def start(self):
         if self.stopped:
-            self.start_time = time()
+            self.start_time = self.clock()
         self.stopped = False
 
     def stop(self) -> float:
-        self.elapsed_time += time() - self.start_time
+        self.elapsed_time += self.clock() - self.start_time
         self.stopped = True
         return self.elapsed_time
 
     def read(self) -> float:
         if not self.stopped:
-            return self.elapsed_time + time() - self.start_time
+            return self.elapsed_time + self.clock() - self.start_time
         else:
             return self.elapsed_time
 
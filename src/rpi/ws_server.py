@@ -1,43 +1,208 @@
 import asyncio
 import json
+import struct
+from telemetry import TelemetryEncoder
+from time import monotonic, time
 import websockets
 
 
+# binary joystick frames sent by the web client's gamepad script: schema id, sequence
+# number, client send time (seconds since the epoch), the left stick, right stick and
+# dpad axes scaled to int16, and a bitmask of the buttons
+JOYSTICK_SCHEMA_ID = 1
+JOYSTICK_FORMAT = "<BId6hH"
+JOYSTICK_AXIS_SCALE = 32767
+# in bit order
+JOYSTICK_BUTTONS = (
+    "north",
+    "east",
+    "south",
+    "west",
+    "left_bumper",
+    "right_bumper",
+    "left_trigger",
+    "right_trigger",
+    "select",
+    "start",
+    "mode",
+    "left_thumb",
+    "right_thumb",
+)
+
+
+# turns a joystick message (binary frame or the older JSON text) into the dict the
+# control loop expects
+def decode_joystick(message):
+    if isinstance(message, str):
+        return json.loads(message)
+
+    schema_id, seq, sent_time, *axes, buttons = struct.unpack(JOYSTICK_FORMAT, message)
+    if schema_id != JOYSTICK_SCHEMA_ID:
+        raise ValueError(f"Unknown joystick schema: {schema_id}")
+    axes = [axis / JOYSTICK_AXIS_SCALE for axis in axes]
+    return {
+        "buttons": {
+            name: bool(buttons & (1 << bit)) for bit, name in enumerate(JOYSTICK_BUTTONS)
+        },
+        "left_stick": axes[0:2],
+        "right_stick": axes[2:4],
+        "dpad": axes[4:6],
+        "seq": seq,
+        "sent_time": sent_time,
+    }
+
+
+# a web client receiving sensor data. only the newest snapshot is kept, so a slow
+# client skips snapshots instead of holding up the control loop or the other clients
+class Subscriber:
+    def __init__(self, websocket, data_format="json"):
+        self.websocket = websocket
+        # whether the client wants the sensor data as "json" or "binary" frames (see
+        # telemetry.py), JSON is kept around for debugging
+        self.data_format = data_format
+        # each client gets its own encoder so a dropped keyframe only affects it
+        self.encoder = TelemetryEncoder() if data_format == "binary" else None
+        self.queue = asyncio.Queue(1)
+
+        self.sent = 0
+        # snapshots that were replaced by a newer one before they could be sent
+        self.dropped = 0
+        # time from a snapshot being published to it being sent, in real time since
+        # the snapshot's own timestamp may be simulated or recorded time
+        self.last_lag = 0
+        self.max_lag = 0
+
+    # never blocks, replaces the snapshot waiting to be sent if there is one
+    def offer(self, status_info: dict, timestamp: float):
+        if self.queue.full():
+            self.queue.get_nowait()
+            self.dropped += 1
+        self.queue.put_nowait((status_info, timestamp, monotonic()))
+
+    async def run(self):
+        while True:
+            status_info, timestamp, offered_time = await self.queue.get()
+            if self.encoder is not None:
+                message = self.encoder.encode(status_info, timestamp)
+            else:
+                message = json.dumps(status_info)
+            await self.websocket.send(message)
+
+            self.sent += 1
+            self.last_lag = monotonic() - offered_time
+            if self.last_lag > self.max_lag:
+                self.max_lag = self.last_lag
+
+    def stats(self) -> dict:
+        return {
+            "format": self.data_format,
+            "sent": self.sent,
+            "dropped": self.dropped,
+            "last_lag_ms": round(self.last_lag * 1000, 2),
+            "max_lag_ms": round(self.max_lag * 1000, 2),
+        }
+
+
 # websocket server
 class WSServer:
     # registers the websocket objects of the clients to allow sending data to
     # the clients outside of the handler function
     joystick_client = None
-    # web client websocket object used to transmit non-image data (sensor data)
+    # the most recently connected web client, only kept for older scripts that send
+    # to it directly. main.py publishes to every client instead
     web_client_main = None
+    # all of the web clients receiving non-image data (sensor data)
+    subscribers = set()
 
-    # incoming joystick data, can be accessed outside of the handler function
+    # the newest joystick message and when it arrived. messages are only decoded when
+    # the control loop asks for them, so the ones in between are never parsed
+    joystick_message = None
+    joystick_message_time = None
+    # also in seconds since the epoch, to compare against the client's send time
+    joystick_message_wall_time = None
+    # the decoded joystick data and the message it came from
     joystick_data = None
+    decoded_joystick_message = None
+
+    # functions that return runtime statistics (e.g. the scheduler's overrun counters),
+    # keyed by name. a stats client gets all of them every time it sends a message
+    stats_providers = {}
 
     @classmethod
     def pump_joystick_data(cls):
+        message = cls.joystick_message
+        if message is not cls.decoded_joystick_message:
+            cls.decoded_joystick_message = message
+            try:
+                cls.joystick_data = decode_joystick(message)
+            except (ValueError, struct.error) as e:
+                print(f"Invalid joystick message: {e}")
         return cls.joystick_data
 
+    # how long ago the newest joystick message arrived in seconds, None if there
+    # hasn't been one yet
+    @classmethod
+    def joystick_age(cls):
+        if cls.joystick_message_time is None:
+            return None
+        return monotonic() - cls.joystick_message_time
+
     @classmethod
     async def joystick_handler(cls, websocket, path):
         cls.joystick_client = websocket
         print("Joystick client connected")
         async for message in websocket:
-            cls.joystick_data = json.loads(message)
+            cls.joystick_message = message
+            cls.joystick_message_time = monotonic()
+            cls.joystick_message_wall_time = time()
         cls.joystick_client = None
 
+    # hands the latest sensor data to every web client without waiting for any of
+    # them to actually send it
+    @classmethod
+    def publish(cls, status_info: dict, timestamp=None):
+        if timestamp is None:
+            timestamp = monotonic()
+        for subscriber in cls.subscribers:
+            subscriber.offer(status_info, timestamp)
+
     @classmethod
-    async def web_client_main_handler(cls, websocket, path):
+    def subscriber_stats(cls) -> dict:
+        return {
+            str(subscriber.websocket.remote_address): subscriber.stats()
+            for subscriber in cls.subscribers
+        }
+
+    @classmethod
+    async def web_client_main_handler(cls, websocket, path, data_format="json"):
+        subscriber = Subscriber(websocket, data_format)
+        cls.subscribers.add(subscriber)
         cls.web_client_main = websocket
         print("Web client connected!")
-        while True:
-            try:
-                await websocket.wait_closed()
-                print("Web client disconnected!")
+        try:
+            await subscriber.run()
+        except websockets.ConnectionClosed:
+            pass
+        finally:
+            cls.subscribers.discard(subscriber)
+            if cls.web_client_main is websocket:
                 cls.web_client_main = None
-                break
-            except websockets.ConnectionClosed:
-                print("Web client disconnected!")
+            print("Web client disconnected!")
+
+    @classmethod
+    def collect_stats(cls) -> dict:
+        return {name: provider() for name, provider in cls.stats_providers.items()}
+
+    @classmethod
+    async def stats_handler(cls, websocket, path):
+        print("Stats client connected!")
+        try:
+            # reply to every request with a fresh copy of the stats
+            async for _ in websocket:
+                await websocket.send(json.dumps(cls.collect_stats()))
+        except websockets.ConnectionClosed:
+            pass
+        print("Stats client disconnected!")
 
     @classmethod
     async def handler(cls, websocket, path):
@@ -58,4 +223,8 @@ class WSServer:
         if client_type == "joystick":
             await cls.joystick_handler(websocket, path)
         elif client_type == "web_client_main":
-            await cls.web_client_main_handler(websocket, path)
+            await cls.web_client_main_handler(
+                websocket, path, client_info.get("format", "json")
+            )
+        elif client_type == "stats":
+            await cls.stats_handler(websocket, path)